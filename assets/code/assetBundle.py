@@ -0,0 +1,280 @@
+# This file builds the client's fonts and sounds into one file that loads without decoding anything
+# Each font is rendered once into a glyph atlas, a strip holding every character it is used for at the
+# size the game draws it, one byte per pixel. Each sound is converted to the samples the mixer plays
+# (16 bit signed stereo at MIXER_FREQUENCY). The client maps the file and makes its surfaces and sounds
+# straight from the mapped bytes, so starting a match opens no TTF or WAV file.
+#
+# The bundle is rebuilt by itself when it is missing or any source file changed, or by hand with
+# python -m assets.code.assetBundle
+#
+#   file      = header, one entry per asset, then the data of every asset
+#   header    = magic, version, stamp of the source files, entry count
+#   entry     = name, kind, width, height, glyph count or frequency, data offset, data size
+#   atlas     = (character, x, width) per glyph, then width*height bytes, 1 where a glyph pixel is lit
+#   sound     = the samples, in this machine's byte order like the mixer wants them
+import mmap
+import os
+import struct
+import sys
+import threading
+import wave
+import zlib
+from array import array
+from typing import Dict, Optional, Tuple
+
+import pygame
+
+MAGIC = b"PONGAST"
+VERSION = 1
+BUNDLE_PATH = "./assets/pong.assets"
+
+# The mixer format the sounds are converted to, what playGame asked pygame.mixer.pre_init for
+MIXER_FREQUENCY = 44100
+MIXER_SIZE = -16
+MIXER_CHANNELS = 2
+MIXER_BUFFER = 2048
+
+KIND_ATLAS = 1
+KIND_SOUND = 2
+
+DIGITS = "0123456789 "
+PRINTABLE = "".join(chr(code) for code in range(32, 127))
+# Name, source, point size and the characters drawn with it
+FONTS = (("score", "./assets/fonts/pong-score.ttf", 32, DIGITS),
+         ("win", "./assets/fonts/visitor.ttf", 48, PRINTABLE))
+SOUNDS = (("point", "./assets/sounds/point.wav"),
+          ("bounce", "./assets/sounds/bounce.wav"))
+
+HEADER = struct.Struct("!7sBIH")
+ENTRY = struct.Struct("!16sBHHIQQ")
+GLYPH = struct.Struct("!HHH")
+
+
+class AssetError(Exception):
+    pass
+
+
+# Changes whenever a source file, the bundle layout or pygame (which renders the glyphs) does
+def sourceStamp() -> int:
+    parts = [f"{VERSION} {pygame.version.ver} {sys.byteorder}"]
+    for _, path, size, characters in FONTS:
+        info = os.stat(path)
+        parts.append(f"{path} {info.st_size} {info.st_mtime_ns} {size} {characters}")
+    for _, path in SOUNDS:
+        info = os.stat(path)
+        parts.append(f"{path} {info.st_size} {info.st_mtime_ns}")
+    return zlib.crc32("\n".join(parts).encode())
+
+
+# Render every character of a font into one strip, returns the glyph table and the pixels
+def buildAtlas(path:str, size:int, characters:str) -> Tuple[int, int, bytes]:
+    if not pygame.font.get_init():
+        pygame.font.init()
+    font = pygame.font.Font(path, size)
+    # Without antialiasing the pixels are palette index 0 (background) or 1 (the glyph)
+    strip = font.render(characters, False, (255,255,255))
+    width, height = strip.get_size()
+    pixels = bytes(1 if value else 0 for value in pygame.image.tobytes(strip, "P"))
+    glyphs = []
+    x = 0
+    for character in characters:
+        advance = font.size(character)[0]
+        glyphs.append(GLYPH.pack(ord(character), x, advance))
+        x += advance
+    return width, height, b"".join(glyphs) + pixels
+
+
+# Read a WAV file and convert it to the mixer's format, returns the samples
+def buildSound(path:str) -> bytes:
+    with wave.open(path, "rb") as source:
+        channels, sampleWidth, frequency = source.getnchannels(), source.getsampwidth(), source.getframerate()
+        frames = source.readframes(source.getnframes())
+    if sampleWidth == 1:
+        samples = array("h", bytes(len(frames)*2))
+        for i, value in enumerate(frames):
+            samples[i] = (value - 128) << 8
+    elif sampleWidth == 2:
+        samples = array("h", frames)
+        if sys.byteorder == "big":
+            samples.byteswap()
+    else:
+        raise AssetError(f"{path}: {sampleWidth*8} bit samples aren't supported")
+    if channels == 1:
+        stereo = array("h", bytes(len(samples)*4))
+        stereo[0::2] = samples
+        stereo[1::2] = samples
+        samples = stereo
+    elif channels != 2:
+        raise AssetError(f"{path}: {channels} channels aren't supported")
+    if frequency != MIXER_FREQUENCY:
+        # Nearest sample, the sounds are short beeps
+        count = len(samples)//2 * MIXER_FREQUENCY//frequency
+        resampled = array("h", bytes(count*4))
+        for i in range(count):
+            j = i*frequency//MIXER_FREQUENCY*2
+            resampled[2*i], resampled[2*i + 1] = samples[j], samples[j + 1]
+        samples = resampled
+    return samples.tobytes()
+
+
+# Build the whole bundle, returns its bytes
+def buildBundle() -> bytes:
+    entries = []
+    data = []
+    offset = HEADER.size + ENTRY.size*(len(FONTS) + len(SOUNDS))
+    for name, path, size, characters in FONTS:
+        width, height, atlas = buildAtlas(path, size, characters)
+        entries.append(ENTRY.pack(name.encode(), KIND_ATLAS, width, height, len(characters), offset, len(atlas)))
+        data.append(atlas)
+        offset += len(atlas)
+    for name, path in SOUNDS:
+        samples = buildSound(path)
+        entries.append(ENTRY.pack(name.encode(), KIND_SOUND, 0, 0, MIXER_FREQUENCY, offset, len(samples)))
+        data.append(samples)
+        offset += len(samples)
+    header = HEADER.pack(MAGIC, VERSION, sourceStamp(), len(entries))
+    return header + b"".join(entries) + b"".join(data)
+
+
+# Replace the file in one step, so a client starting at the same time never maps half of it
+def writeBundle(path:str = BUNDLE_PATH) -> bytes:
+    bundle = buildBundle()
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(bundle)
+    os.replace(temporary, path)
+    return bundle
+
+
+# Draws text from a glyph atlas, render takes the same arguments as pygame.font.Font.render
+class GlyphAtlas:
+    def __init__(self, pixels, width:int, height:int, glyphs:Dict[str, Tuple[int, int]]) -> None:
+        # The surface uses the bundle's bytes as its pixels, index 1 is recolored for every render
+        self.surface = pygame.image.frombuffer(pixels, (width, height), "P")
+        self.surface.set_palette([(0,0,0), (255,255,255)])
+        self.surface.set_colorkey(0)
+        self.height = height
+        self.glyphs = glyphs
+
+    def size(self, text:str) -> Tuple[int, int]:
+        return sum(self.glyphs[character][1] for character in text), self.height
+
+    def render(self, text:str, antialias:bool, color, background=None) -> pygame.Surface:
+        textSurface = pygame.Surface(self.size(text))
+        if background is None:
+            key = (0,0,0) if tuple(color)[:3] != (0,0,0) else (255,255,255)
+            textSurface.fill(key)
+            textSurface.set_colorkey(key)
+        else:
+            textSurface.fill(background)
+        self.surface.set_palette_at(1, color)
+        x = 0
+        for character in text:
+            glyphX, advance = self.glyphs[character]
+            textSurface.blit(self.surface, (x, 0), (glyphX, 0, advance, self.height))
+            x += advance
+        return textSurface
+
+
+# Opening the mixer can take a good part of a second, so it is opened on a thread of its own while the
+# client waits for an opponent. Sounds are skipped until it is open, and on a machine without a sound device
+mixerLock = threading.Lock()
+mixerState = {"started": False, "ready": False}
+
+
+def openMixer() -> None:
+    try:
+        # No format changes allowed, SDL converts to whatever the device wants so the samples stay valid
+        pygame.mixer.init(MIXER_FREQUENCY, MIXER_SIZE, MIXER_CHANNELS, MIXER_BUFFER, allowedchanges=0)
+    except pygame.error:
+        return
+    with mixerLock:
+        mixerState["ready"] = True
+
+
+# Start opening the mixer in the background unless it already was, returns straight away
+def startMixer() -> None:
+    with mixerLock:
+        if mixerState["started"]:
+            return
+        mixerState["started"] = True
+    threading.Thread(target=openMixer, daemon=True).start()
+
+
+def mixerReady() -> bool:
+    with mixerLock:
+        return mixerState["ready"]
+
+
+class LazySound:
+    def __init__(self, samples) -> None:
+        self.samples = samples
+        self.sound: Optional[pygame.mixer.Sound] = None
+
+    def play(self) -> None:
+        if self.sound is None:
+            if not mixerReady():
+                return
+            self.sound = pygame.mixer.Sound(buffer=self.samples)
+        self.sound.play()
+
+
+class AssetBundle:
+    def __init__(self, data) -> None:
+        self.data = data
+        if len(data) < HEADER.size:
+            raise AssetError("Asset bundle is too short")
+        magic, version, self.stamp, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise AssetError("Not an asset bundle of this version")
+        view = memoryview(data)
+        self.fonts: Dict[str, GlyphAtlas] = {}
+        self.sounds: Dict[str, LazySound] = {}
+        for i in range(count):
+            name, kind, width, height, extra, offset, size = ENTRY.unpack_from(data, HEADER.size + i*ENTRY.size)
+            name = name.rstrip(b"\0").decode()
+            if offset + size > len(data):
+                raise AssetError(f"Asset {name} runs past the end of the bundle")
+            if kind == KIND_ATLAS:
+                glyphs = {}
+                for j in range(extra):
+                    code, x, advance = GLYPH.unpack_from(data, offset + j*GLYPH.size)
+                    glyphs[chr(code)] = (x, advance)
+                start = offset + extra*GLYPH.size
+                self.fonts[name] = GlyphAtlas(view[start:offset + size], width, height, glyphs)
+            elif kind == KIND_SOUND:
+                self.sounds[name] = LazySound(view[offset:offset + size])
+
+    def font(self, name:str) -> GlyphAtlas:
+        return self.fonts[name]
+
+    def sound(self, name:str) -> LazySound:
+        return self.sounds[name]
+
+
+# Map the bundle, building it first when it is missing or out of date
+# Where the assets directory can't be written the bundle is built in memory instead
+def loadBundle(path:str = BUNDLE_PATH) -> AssetBundle:
+    stamp = sourceStamp()
+    try:
+        with open(path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) >= HEADER.size and HEADER.unpack_from(data)[:3] == (MAGIC, VERSION, stamp):
+            return AssetBundle(data)
+        data.close()
+    except (OSError, ValueError):
+        pass
+    try:
+        writeBundle(path)
+        with open(path, "rb") as file:
+            return AssetBundle(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    except OSError:
+        return AssetBundle(buildBundle())
+
+
+# Build the bundle
+# Usage: python -m assets.code.assetBundle [PATH]
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else BUNDLE_PATH
+    bundle = writeBundle(path)
+    print(f"wrote {path}, {len(bundle)} bytes")
@@ -0,0 +1,212 @@
+# This file runs many games at once with NumPy, for hosting lots of rooms on one core or training bots
+# Every game is one index into a set of arrays (structure of arrays) and step advances all of them
+# together. The rules are the same as GameEngine.step, tick for tick, so a game can be moved between
+# the two with getState/setState and keep playing exactly the same.
+import numpy as np
+from typing import Optional
+
+from assets.code.gameEngine import (GameEngine, GameState, PADDLE_HEIGHT, PADDLE_SPEED, BALL_SPEED, WALL_THICKNESS,
+                                    WIN_SCORE, EVENT_BOUNCE, EVENT_POINT)
+from assets.code.sweptCollision import TIME_ONE, MAX_BOUNCES, NEVER
+
+# Paddle directions are stored as these codes, the same ones the wire protocol uses
+MOVE_NONE = 0
+MOVE_UP = 1
+MOVE_DOWN = 2
+MOVE_CODES = {"": MOVE_NONE, "up": MOVE_UP, "down": MOVE_DOWN}
+MOVE_NAMES = ("", "up", "down")
+
+
+class BatchSimulator:
+    def __init__(self, count:int, screenWidth:int, screenHeight:int) -> None:
+        self.count = count
+        self.engine = GameEngine(screenWidth, screenHeight)
+        self.tick = np.zeros(count, dtype=np.int64)
+        self.ballX = np.empty(count, dtype=np.int32)
+        self.ballY = np.empty(count, dtype=np.int32)
+        self.ballXVel = np.empty(count, dtype=np.int32)
+        self.ballYVel = np.empty(count, dtype=np.int32)
+        self.leftY = np.empty(count, dtype=np.int32)
+        self.rightY = np.empty(count, dtype=np.int32)
+        self.leftMoving = np.zeros(count, dtype=np.int8)
+        self.rightMoving = np.zeros(count, dtype=np.int8)
+        self.lScore = np.zeros(count, dtype=np.int32)
+        self.rScore = np.zeros(count, dtype=np.int32)
+        self.reset()
+
+    # Put the selected games (all of them when mask is None) back to the start of a match
+    def reset(self, mask:Optional[np.ndarray] = None) -> None:
+        if mask is None:
+            mask = np.ones(self.count, dtype=bool)
+        engine = self.engine
+        self.tick[mask] = 0
+        self.ballX[mask] = engine.ballStartX
+        self.ballY[mask] = engine.ballStartY
+        self.ballXVel[mask] = -BALL_SPEED
+        self.ballYVel[mask] = 0
+        self.leftY[mask] = engine.paddleStartY
+        self.rightY[mask] = engine.paddleStartY
+        self.leftMoving[mask] = MOVE_NONE
+        self.rightMoving[mask] = MOVE_NONE
+        self.lScore[mask] = 0
+        self.rScore[mask] = 0
+
+    def isOver(self) -> np.ndarray:
+        return (self.lScore >= WIN_SCORE) | (self.rScore >= WIN_SCORE)
+
+    def movePaddles(self, y:np.ndarray, moving:np.ndarray) -> None:
+        down = (moving == MOVE_DOWN) & (y + PADDLE_HEIGHT < self.engine.screenHeight - WALL_THICKNESS)
+        up = (moving == MOVE_UP) & (y > WALL_THICKNESS)
+        y += PADDLE_SPEED * down
+        y -= PADDLE_SPEED * up
+
+    # sweptCollision.sweepBall for every game at once, games not in active keep their ball where it is
+    # Returns the number of bounces of each game
+    def sweepBalls(self, active:np.ndarray) -> np.ndarray:
+        field = self.engine.field
+        one = TIME_ONE
+        ballSize = field.ballSize*one
+        paddleHeight = field.paddleHeight*one
+        top = field.topY*one
+        bottom = field.bottomY*one - ballSize
+        leftFace = field.leftFace*one
+        rightFace = field.rightFace*one - ballSize
+
+        # Most balls move the whole tick without reaching anything, they are moved in one go. The sweep only
+        # runs on the few whose path crosses a wall or a paddle face, and after that on the ones still bouncing
+        ballX, ballY, xVel, yVel = self.ballX, self.ballY, self.ballXVel, self.ballYVel
+        endX = ballX + xVel
+        endY = ballY + yVel
+        crossing = active & (((yVel < 0) & (endY < field.topY)) |
+                             ((yVel > 0) & (endY > field.bottomY - field.ballSize)) |
+                             ((xVel < 0) & (ballX >= field.leftFace) & (endX < field.leftFace)) |
+                             ((xVel > 0) & (ballX <= field.rightFace - field.ballSize) &
+                              (endX > field.rightFace - field.ballSize)))
+        games = np.flatnonzero(crossing)
+        free = active & ~crossing
+        ballX += xVel*free
+        ballY += yVel*free
+        allBounces = np.zeros(self.count, dtype=np.int32)
+        if not len(games):
+            return allBounces
+
+        # Fixed point needs 64 bits
+        x = self.ballX[games].astype(np.int64)*one
+        y = self.ballY[games].astype(np.int64)*one
+        xVel = self.ballXVel[games].astype(np.int64)
+        yVel = self.ballYVel[games].astype(np.int64)
+        leftY = self.leftY[games].astype(np.int64)*one
+        rightY = self.rightY[games].astype(np.int64)*one
+        time = np.zeros(len(games), dtype=np.int64)
+        bounces = np.zeros(len(games), dtype=np.int32)
+        bouncing = np.arange(len(games))
+
+        for _ in range(MAX_BOUNCES):
+            if not len(bouncing):
+                break
+            bx, by, bxVel, byVel = x[bouncing], y[bouncing], xVel[bouncing], yVel[bouncing]
+            rest = one - time[bouncing]
+            endY = by + byVel*rest
+            topHit = (byVel < 0) & (endY < top)
+            bottomHit = (byVel > 0) & (endY > bottom)
+            wait = np.full(len(bouncing), NEVER, dtype=np.int64)
+            wait[topHit] = np.maximum(0, (by - top)[topHit]//-byVel[topHit])
+            wait[bottomHit] = np.maximum(0, (bottom - by)[bottomHit]//byVel[bottomHit])
+
+            # A wall reached at the same time as a paddle goes first
+            endX = bx + bxVel*rest
+            leftCross = (bxVel < 0) & (bx >= leftFace) & (endX < leftFace)
+            rightCross = (bxVel > 0) & (bx <= rightFace) & (endX > rightFace)
+            paddleWait = np.full(len(bouncing), NEVER, dtype=np.int64)
+            paddleWait[leftCross] = (bx - leftFace)[leftCross]//-bxVel[leftCross]
+            paddleWait[rightCross] = (rightFace - bx)[rightCross]//bxVel[rightCross]
+            paddleY = np.where(leftCross, leftY[bouncing], rightY[bouncing])
+            ballY = by + byVel*paddleWait
+            paddleHit = (paddleWait < wait) & (ballY < paddleY + paddleHeight) & (paddleY < ballY + ballSize)
+            wallHit = (topHit | bottomHit) & ~paddleHit
+            contact = wallHit | paddleHit
+
+            # Keep only the games that bounced and move them to where they did
+            wait = np.where(paddleHit, paddleWait, wait)[contact]
+            paddleHit, wallHit, paddleY = paddleHit[contact], wallHit[contact], paddleY[contact]
+            bouncing = bouncing[contact]
+            bx = bx[contact] + bxVel[contact]*wait
+            by = by[contact] + byVel[contact]*wait
+            x[bouncing] = bx
+            y[bouncing] = by
+            time[bouncing] += wait
+            bounces[bouncing] += 1
+
+            yVel[bouncing[wallHit]] *= -1
+            xVel[bouncing[paddleHit]] *= -1
+            deflection = ((by + one//2)//one + field.ballSize//2 - (paddleY//one + field.paddleHeight//2))//2
+            yVel[bouncing[paddleHit]] = deflection[paddleHit]
+
+        rest = one - time
+        self.ballX[games] = (x + xVel*rest + one//2)//one
+        self.ballY[games] = (y + yVel*rest + one//2)//one
+        self.ballXVel[games] = xVel
+        self.ballYVel[games] = yVel
+        allBounces[games] = bounces
+        return allBounces
+
+    # Advance every game by one tick, the optional arrays of MOVE_ codes replace the paddle directions first
+    # Returns the EVENT_ flags of each game
+    def step(self, leftMoving:Optional[np.ndarray] = None, rightMoving:Optional[np.ndarray] = None) -> np.ndarray:
+        engine = self.engine
+        if leftMoving is not None:
+            self.leftMoving[:] = leftMoving
+        if rightMoving is not None:
+            self.rightMoving[:] = rightMoving
+        events = np.zeros(self.count, dtype=np.uint8)
+        self.tick += 1
+
+        self.movePaddles(self.leftY, self.leftMoving)
+        self.movePaddles(self.rightY, self.rightMoving)
+
+        # Finished games keep moving their paddles but the ball stays where it is
+        active = ~self.isOver()
+        events[self.sweepBalls(active) > 0] |= EVENT_BOUNCE
+
+        # If the ball makes it past the edge of the screen, update score, etc.
+        leftPoint = active & (self.ballX > engine.screenWidth)
+        rightPoint = active & ~leftPoint & (self.ballX < 0)
+        scored = leftPoint | rightPoint
+        self.lScore += leftPoint
+        self.rScore += rightPoint
+        events[scored] |= EVENT_POINT
+        self.ballX[scored] = engine.ballStartX
+        self.ballY[scored] = engine.ballStartY
+        self.ballXVel[leftPoint] = -BALL_SPEED
+        self.ballXVel[rightPoint] = BALL_SPEED
+        self.ballYVel[scored] = 0
+        return events
+
+    # Copy game index out as a GameState, for handing it to GameEngine or the wire protocol
+    def getState(self, index:int) -> GameState:
+        state = self.engine.newState()
+        state.tick = int(self.tick[index])
+        state.ballX = int(self.ballX[index])
+        state.ballY = int(self.ballY[index])
+        state.ballXVel = int(self.ballXVel[index])
+        state.ballYVel = int(self.ballYVel[index])
+        state.leftY = int(self.leftY[index])
+        state.rightY = int(self.rightY[index])
+        state.leftMoving = MOVE_NAMES[self.leftMoving[index]]
+        state.rightMoving = MOVE_NAMES[self.rightMoving[index]]
+        state.lScore = int(self.lScore[index])
+        state.rScore = int(self.rScore[index])
+        return state
+
+    def setState(self, index:int, state:GameState) -> None:
+        self.tick[index] = state.tick
+        self.ballX[index] = state.ballX
+        self.ballY[index] = state.ballY
+        self.ballXVel[index] = state.ballXVel
+        self.ballYVel[index] = state.ballYVel
+        self.leftY[index] = state.leftY
+        self.rightY[index] = state.rightY
+        self.leftMoving[index] = MOVE_CODES[state.leftMoving]
+        self.rightMoving[index] = MOVE_CODES[state.rightMoving]
+        self.lScore[index] = state.lScore
+        self.rScore[index] = state.rScore
@@ -0,0 +1,190 @@
+# This file moves the client's network I/O off the render loop
+# A receiver thread per transport drains its socket as fast as data arrives and leaves only the newest
+# snapshot in a single slot mailbox, and a sender thread writes the newest input, so a slow or silent
+# server never holds up drawing or reading the keyboard.
+#
+# A player given its session id reconnects by itself when the connection drops: the receiver thread dials
+# the server again and sends RESUME, and the game carries on from the server's next snapshot. Inputs made
+# while it is away are dropped, the server holds the match until the player is back.
+import socket
+import threading
+import time
+from typing import Optional, Tuple
+
+from assets.code.wireProtocol import (FrameDecoder, ProtocolError, encodeInput, encodeResume, decodeSnapshot,
+                                      decodeUdpOffer, frameType, MSG_SNAPSHOT, MSG_START, MSG_UDP_OFFER)
+from assets.code.udpTransport import UdpClientChannel
+
+# Inputs sent over UDP between the copies sent over TCP to keep the connection alive
+KEEPALIVE_INPUTS = 30
+UDP_POLL_TIMEOUT = 0.5
+RESUME_TIMEOUT = 30     # How long to keep trying to resume, the server holds a match this long (RESUME_GRACE)
+RESUME_RETRY = 0.25     # Seconds between attempts while the server can't be reached
+
+
+class NetworkClient:
+    def __init__(self, client:socket.socket, decoder:FrameDecoder, udp:Optional[UdpClientChannel] = None,
+                 sessionId:Optional[int] = None) -> None:
+        self.client = client
+        self.decoder = decoder
+        self.udp = udp
+        self.connected = True
+        self.running = False
+        # Where and as what to resume after the connection drops, None for a client that doesn't resume
+        self.serverAddress = client.getpeername() if sessionId is not None else None
+        self.sessionId = sessionId
+        self.resuming = False
+
+        # Single slot mailbox: the newest snapshot, when it arrived, and the event flags of every snapshot
+        # since the last take
+        self.mailboxLock = threading.Lock()
+        self.snapshot = None
+        self.receivedAt = 0.0
+        self.events = 0
+
+        # Outbound slot: only the newest input is sent if the sender falls behind
+        self.outbound = threading.Condition()
+        self.pendingInput: Optional[Tuple[int, str]] = None
+        self.sequence = 0
+
+    def start(self) -> None:
+        self.running = True
+        threading.Thread(target=self.receiveTcp, daemon=True).start()
+        if self.udp is not None:
+            threading.Thread(target=self.receiveUdp, daemon=True).start()
+        threading.Thread(target=self.sendInputs, daemon=True).start()
+
+    def stop(self) -> None:
+        self.running = False
+        with self.outbound:
+            self.outbound.notify()
+        if self.udp is not None:
+            self.udp.close()
+
+    # Queue this frame's input, returns the sequence number it was given
+    def sendInput(self, direction:str) -> int:
+        with self.outbound:
+            self.sequence += 1
+            self.pendingInput = (self.sequence, direction)
+            self.outbound.notify()
+        return self.sequence
+
+    # Take the newest snapshot (or None if nothing new arrived), the time.monotonic() it arrived at, the
+    # event flags since the last take and whether the server is still connected
+    def take(self) -> Tuple[Optional[Tuple], float, int, bool]:
+        with self.mailboxLock:
+            snapshot, receivedAt, events = self.snapshot, self.receivedAt, self.events
+            self.snapshot = None
+            self.events = 0
+        return snapshot, receivedAt, events, self.connected
+
+    def publish(self, snapshot:Tuple, events:int) -> None:
+        now = time.monotonic()
+        with self.mailboxLock:
+            self.events |= events
+            if self.snapshot is None or snapshot[0] > self.snapshot[0]:
+                self.snapshot = snapshot
+                self.receivedAt = now
+
+    def receiveTcp(self) -> None:
+        while self.running:
+            try:
+                data = self.client.recv(4096)
+                if not data:
+                    raise ConnectionError("Server closed the connection")
+                for frame in self.decoder.feed(data):
+                    if frameType(frame) == MSG_SNAPSHOT:
+                        snapshot = decodeSnapshot(frame)
+                        self.publish(snapshot, snapshot[11])
+            except (OSError, ProtocolError):
+                # The server also closes both players once the game is over, a resume then just fails
+                if self.serverAddress is None or not self.running or not self.resume():
+                    break
+        self.connected = False
+
+    #=============================================================================================================
+    # Purpose: The purpose of this function is to reconnect to the server and resume the session after the
+    #          connection dropped, trying again until RESUME_TIMEOUT runs out while the server can't be reached
+    # Preconditions: This function is called by the receiver thread of a client that has a session id
+    # Postconditions: Returns True with the new connection in place, or False if the server no longer holds the
+    #                 match or couldn't be reached in time
+    #=============================================================================================================
+    def resume(self) -> bool:
+        self.resuming = True
+        deadline = time.monotonic() + RESUME_TIMEOUT
+        try:
+            while self.running and time.monotonic() < deadline:
+                try:
+                    sock = socket.create_connection(self.serverAddress, timeout=RESUME_RETRY * 4)
+                except OSError:
+                    time.sleep(RESUME_RETRY)
+                    continue
+                try:
+                    # Sent without waiting for the HELLO, the server reads it right after sending that
+                    sock.sendall(encodeResume(self.sessionId))
+                    decoder = FrameDecoder()
+                    started = False
+                    while not started:
+                        data = sock.recv(4096)
+                        if not data:
+                            # The server doesn't hold the match anymore
+                            sock.close()
+                            return False
+                        for frame in decoder.feed(data):
+                            kind = frameType(frame)
+                            if kind == MSG_UDP_OFFER and self.udp is not None:
+                                self.udp.token = decodeUdpOffer(frame)[1]
+                            elif kind == MSG_START:
+                                started = True
+                            elif kind == MSG_SNAPSHOT:
+                                snapshot = decodeSnapshot(frame)
+                                self.publish(snapshot, snapshot[11])
+                except (OSError, ProtocolError):
+                    sock.close()
+                    time.sleep(RESUME_RETRY)
+                    continue
+                sock.settimeout(None)
+                self.client.close()
+                self.client = sock
+                self.decoder = decoder
+                return True
+            return False
+        finally:
+            self.resuming = False
+
+    def receiveUdp(self) -> None:
+        while self.running and self.connected:
+            try:
+                snapshot, events = self.udp.poll(UDP_POLL_TIMEOUT)
+            except OSError:
+                # stop closed the socket
+                return
+            if snapshot is not None:
+                self.publish(snapshot, events)
+
+    def sendInputs(self) -> None:
+        sinceKeepalive = 0
+        while True:
+            with self.outbound:
+                while self.running and self.pendingInput is None:
+                    self.outbound.wait()
+                if not self.running:
+                    return
+                sequence, direction = self.pendingInput
+                self.pendingInput = None
+            if self.resuming:
+                # The match is paused until the receiver thread has resumed, the input would be lost anyway
+                continue
+            try:
+                if self.udp is not None:
+                    self.udp.sendInput(direction, sequence)
+                    sinceKeepalive += 1
+                    if sinceKeepalive < KEEPALIVE_INPUTS:
+                        continue
+                    sinceKeepalive = 0
+                self.client.sendall(encodeInput(direction, sequence))
+            except OSError:
+                # The receiver thread notices the same broken connection and resumes if it can
+                if self.serverAddress is None:
+                    self.connected = False
+                    return
@@ -0,0 +1,130 @@
+# This file times every frame of playGame phase by phase, to find where a stutter comes from
+# playGame calls mark(phase) as each part of the frame finishes and the time since the previous mark is
+# charged to that phase. The last WINDOW frames are kept in ring buffers for rolling percentiles, shown
+# in an overlay toggled with F3, and every frame is kept for the trace written when the game closes.
+#
+# Set PONG_PROFILE to a file path before starting the client to turn it on, the trace is written there
+# as JSON when the path ends in .json and as CSV otherwise. Set PONG_PROFILE_HUD=1 to show the overlay
+# from the start.
+import json
+import os
+import time
+from array import array
+from typing import Dict, List, Optional
+
+import pygame
+
+# In the order they happen in a frame
+# events       pygame.event.get and the key handling
+# simulate     the steps due this frame: queueing inputs for the network thread and predicting them
+# network      taking what the network threads received
+# reconcile    correcting the prediction from a snapshot and starting its sounds
+# interpolate  placing the ball and paddles for this frame
+# draw         the renderer patching the screen and rendering a new score
+# present      pygame.display.update or flip
+# wait         clock.tick sleeping until the next frame is due
+# gameOver     the win message and the sleeps before the game closes
+PHASES = ("events", "simulate", "network", "reconcile", "interpolate", "draw", "present", "wait", "gameOver")
+WINDOW = 600            # Frames the percentiles are taken over, a few seconds
+HUD_REFRESH = 30        # Frames between redraws of the overlay
+MAX_TRACE_FRAMES = 1000000
+PERCENTILES = (50, 95, 99)
+HUD_POSITION = (15, 15)
+HUD_FONT_SIZE = 16
+
+
+class FrameProfiler:
+    def __init__(self, path:str, showHud:bool = False) -> None:
+        self.path = path
+        self.showHud = showHud
+        self.index = {phase: i for i, phase in enumerate(PHASES)}
+        self.window = [array("d", [0.0])*WINDOW for _ in PHASES]
+        self.totals = array("d", [0.0])*WINDOW
+        self.frames = 0
+        # Frame start followed by the time of every phase, one row per frame
+        self.trace = array("d")
+        self.current = [0.0]*len(PHASES)
+        self.started: Optional[float] = None
+        self.last = 0.0
+        self.origin = time.perf_counter()
+        self.font: Optional[pygame.font.Font] = None
+        self.hud: Optional[pygame.Surface] = None
+
+    def begin(self) -> None:
+        self.started = self.last = time.perf_counter()
+        current = self.current
+        for i in range(len(current)):
+            current[i] = 0.0
+
+    # Charge the time since the previous mark to phase
+    def mark(self, phase:str) -> None:
+        now = time.perf_counter()
+        self.current[self.index[phase]] += now - self.last
+        self.last = now
+
+    def end(self) -> None:
+        if self.started is None:
+            return
+        slot = self.frames % WINDOW
+        for i, value in enumerate(self.current):
+            self.window[i][slot] = value
+        self.totals[slot] = self.last - self.started
+        if self.frames < MAX_TRACE_FRAMES:
+            self.trace.append(self.started - self.origin)
+            self.trace.extend(self.current)
+        self.frames += 1
+        self.started = None
+        if self.showHud and self.frames % HUD_REFRESH == 0:
+            self.hud = None
+
+    # The given percentiles of every phase and of the whole frame over the window, in seconds
+    def percentiles(self) -> Dict[str, List[float]]:
+        count = min(self.frames, WINDOW)
+        result = {}
+        for name, values in zip(PHASES + ("frame",), self.window + [self.totals]):
+            ordered = sorted(values[:count])
+            result[name] = [ordered[min(count - 1, count*p//100)] if count else 0.0 for p in PERCENTILES]
+        return result
+
+    # The overlay to draw this frame, None when it is hidden
+    def overlay(self) -> Optional[pygame.Surface]:
+        if not self.showHud:
+            return None
+        if self.hud is None:
+            if self.font is None:
+                if not pygame.font.get_init():
+                    pygame.font.init()
+                self.font = pygame.font.Font(None, HUD_FONT_SIZE)
+            heading = "ms      " + "  ".join(f"p{p:<5}" for p in PERCENTILES)
+            lines = [heading] + [f"{name:<12}" + "  ".join(f"{value*1000:6.2f}" for value in values)
+                                 for name, values in self.percentiles().items()]
+            rendered = [self.font.render(line, False, (255,255,255), (0,0,0)) for line in lines]
+            lineHeight = self.font.get_linesize()
+            self.hud = pygame.Surface((max(line.get_width() for line in rendered), lineHeight*len(rendered)))
+            for i, line in enumerate(rendered):
+                self.hud.blit(line, (0, i*lineHeight))
+        return self.hud
+
+    # Write every frame of the trace and the current percentiles, finishing a frame that is still open
+    def dump(self) -> None:
+        self.end()
+        columns = len(PHASES) + 1
+        rows = [self.trace[i:i + columns] for i in range(0, len(self.trace), columns)]
+        if self.path.endswith(".json"):
+            with open(self.path, "w") as file:
+                json.dump({"phases": list(PHASES), "percentiles": list(PERCENTILES),
+                           "window": self.percentiles(), "frames": [list(row) for row in rows]}, file)
+        else:
+            with open(self.path, "w") as file:
+                file.write("frame,start," + ",".join(PHASES) + ",total\n")
+                for frame, row in enumerate(rows):
+                    file.write(f"{frame},{row[0]:.6f}," + ",".join(f"{value:.6f}" for value in row[1:]) +
+                               f",{sum(row[1:]):.6f}\n")
+
+
+# The profiler asked for with PONG_PROFILE, None when profiling is off
+def profilerFromEnv() -> Optional[FrameProfiler]:
+    path = os.environ.get("PONG_PROFILE") or None
+    if path is None:
+        return None
+    return FrameProfiler(path, os.environ.get("PONG_PROFILE_HUD") == "1")
@@ -0,0 +1,131 @@
+# This file holds the rules of the game without any pygame so the server can run them headless
+# Every tick it moves the paddles, sweeps the ball through the tick bouncing off the walls and paddles
+# at the moment it reaches them (see sweptCollision.py), then scores a ball that made it off the screen.
+import time
+from typing import Optional
+
+from assets.code.sweptCollision import Field, sweepBall
+
+# Sizes and speeds, the same numbers playGame and helperCode use
+PADDLE_WIDTH = 10
+PADDLE_HEIGHT = 50
+PADDLE_SPEED = 5
+PADDLE_MARGIN = 10      # Gap between the screen edge and a paddle
+BALL_SIZE = 5
+BALL_SPEED = 5
+WALL_THICKNESS = 10
+WIN_SCORE = 5
+TICK_RATE = 60
+
+# Event flags reported by GameEngine.step so clients know which sound to play
+EVENT_BOUNCE = 1
+EVENT_POINT = 2
+
+
+class GameState:
+    __slots__ = ("tick", "ballX", "ballY", "ballXVel", "ballYVel", "leftY", "rightY",
+                 "leftMoving", "rightMoving", "lScore", "rScore")
+
+    def __init__(self, ballX:int, ballY:int, paddleY:int) -> None:
+        self.tick = 0
+        self.ballX = ballX
+        self.ballY = ballY
+        self.ballXVel = -BALL_SPEED
+        self.ballYVel = 0
+        self.leftY = paddleY
+        self.rightY = paddleY
+        self.leftMoving = ""
+        self.rightMoving = ""
+        self.lScore = 0
+        self.rScore = 0
+
+
+class GameEngine:
+    def __init__(self, screenWidth:int, screenHeight:int) -> None:
+        self.screenWidth = screenWidth
+        self.screenHeight = screenHeight
+        self.ballStartX = int(screenWidth/2)
+        self.ballStartY = int(screenHeight/2)
+        self.paddleStartY = int((screenHeight/2)-(PADDLE_HEIGHT/2))
+        self.leftX = PADDLE_MARGIN
+        self.rightX = screenWidth - PADDLE_MARGIN - PADDLE_WIDTH
+        self.bottomWallY = screenHeight - WALL_THICKNESS
+        # The walls hang past each side of the screen like playGame's, so only their inner edges matter
+        self.field = Field(WALL_THICKNESS, self.bottomWallY, self.leftX + PADDLE_WIDTH, self.rightX,
+                           PADDLE_HEIGHT, BALL_SIZE)
+
+    def newState(self) -> GameState:
+        return GameState(self.ballStartX, self.ballStartY, self.paddleStartY)
+
+    def isOver(self, state:GameState) -> bool:
+        return state.lScore >= WIN_SCORE or state.rScore >= WIN_SCORE
+
+    def movePaddle(self, y:int, moving:str) -> int:
+        if moving == "down":
+            if y + PADDLE_HEIGHT < self.screenHeight - WALL_THICKNESS:
+                y += PADDLE_SPEED
+        elif moving == "up":
+            if y > WALL_THICKNESS:
+                y -= PADDLE_SPEED
+        return y
+
+    def resetBall(self, state:GameState, nowGoing:str) -> None:
+        state.ballX = self.ballStartX
+        state.ballY = self.ballStartY
+        state.ballXVel = -BALL_SPEED if nowGoing == "left" else BALL_SPEED
+        state.ballYVel = 0
+
+    # Advance the game by one tick using the moving direction stored for each paddle
+    # Returns the EVENT_ flags for anything that happened during the tick
+    def step(self, state:GameState) -> int:
+        events = 0
+        state.tick += 1
+        state.leftY = self.movePaddle(state.leftY, state.leftMoving)
+        state.rightY = self.movePaddle(state.rightY, state.rightMoving)
+        if self.isOver(state):
+            return events
+
+        state.ballX, state.ballY, state.ballXVel, state.ballYVel, bounces = sweepBall(
+            self.field, state.ballX, state.ballY, state.ballXVel, state.ballYVel, state.leftY, state.rightY)
+        if bounces:
+            events |= EVENT_BOUNCE
+
+        # If the ball makes it past the edge of the screen, update score, etc.
+        if state.ballX > self.screenWidth:
+            state.lScore += 1
+            events |= EVENT_POINT
+            self.resetBall(state, "left")
+        elif state.ballX < 0:
+            state.rScore += 1
+            events |= EVENT_POINT
+            self.resetBall(state, "right")
+
+        return events
+
+
+# Decides when fixed length ticks are due so the game runs at the same speed however the caller is woken up
+class TickScheduler:
+    def __init__(self, tickRate:int = TICK_RATE, maxCatchUp:int = 5) -> None:
+        self.interval = 1/tickRate
+        self.maxCatchUp = maxCatchUp
+        self.nextTick: Optional[float] = None
+
+    def start(self, now:Optional[float] = None) -> None:
+        self.nextTick = (time.monotonic() if now is None else now) + self.interval
+
+    # How many ticks should run now, a caller that fell far behind skips ahead instead of running a burst
+    def due(self, now:float) -> int:
+        if self.nextTick is None or now < self.nextTick:
+            return 0
+        count = int((now - self.nextTick) / self.interval) + 1
+        if count > self.maxCatchUp:
+            self.nextTick = now + self.interval
+            return self.maxCatchUp
+        self.nextTick += count * self.interval
+        return count
+
+    # How far now is from the last tick to the next one (0 to 1), for drawing between the two
+    def alpha(self, now:float) -> float:
+        if self.nextTick is None:
+            return 1.0
+        return min(1.0, max(0.0, 1 - (self.nextTick - now)/self.interval))
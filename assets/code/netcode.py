@@ -0,0 +1,98 @@
+# This file hides network latency on the client
+# The player's own paddle is predicted: every input moves it right away and is kept until the server
+# acknowledges it, then the server's position is taken and the inputs it hasn't seen yet are replayed
+# on top. The ball and the opponent's paddle are drawn a little in the past, interpolated between the
+# two snapshots around that moment, so they move smoothly instead of jumping from snapshot to snapshot.
+from collections import deque
+from typing import Optional, Tuple
+
+from assets.code.gameEngine import GameEngine, TICK_RATE
+
+INPUT_BUFFER_SIZE = 128     # Unacknowledged inputs kept for replay, about two seconds at 60 FPS
+SNAPSHOT_BUFFER_SIZE = 32
+INTERP_DELAY_TICKS = 3      # How far in the past remote objects are drawn
+SNAP_DISTANCE = 60          # The ball is moved straight to a snapshot that is further away than this
+CLOCK_DRIFT = 0.0005        # Seconds per snapshot the server clock estimate may slip back by
+
+
+class InputPredictor:
+    def __init__(self, engine:GameEngine, startY:int) -> None:
+        self.engine = engine
+        self.pending = deque(maxlen=INPUT_BUFFER_SIZE)    # (sequence, direction) not acknowledged yet
+        self.predictedY = startY
+
+    # Apply an input the moment it is sent, returns the paddle's predicted position
+    def record(self, sequence:int, direction:str) -> int:
+        self.pending.append((sequence, direction))
+        self.predictedY = self.engine.movePaddle(self.predictedY, direction)
+        return self.predictedY
+
+    # Take the server's position for the paddle and replay the inputs it hadn't applied yet
+    def reconcile(self, serverY:int, ackSequence:int) -> int:
+        pending = self.pending
+        while pending and pending[0][0] <= ackSequence:
+            pending.popleft()
+        y = serverY
+        for _, direction in pending:
+            y = self.engine.movePaddle(y, direction)
+        self.predictedY = y
+        return y
+
+
+class SnapshotInterpolator:
+    def __init__(self, tickRate:int = TICK_RATE, delayTicks:int = INTERP_DELAY_TICKS) -> None:
+        self.interval = 1/tickRate
+        self.delayTicks = delayTicks
+        self.snapshots = deque(maxlen=SNAPSHOT_BUFFER_SIZE)
+        # Local time at which the server was at tick 0, taken from the snapshot that arrived the quickest
+        self.clockOffset: Optional[float] = None
+
+    # Add a snapshot (the tuple from decodeSnapshot) received at local time now
+    def push(self, snapshot:Tuple, now:float) -> None:
+        if self.snapshots and snapshot[0] <= self.snapshots[-1][0]:
+            return
+        self.snapshots.append(snapshot)
+        offset = now - snapshot[0]*self.interval
+        if self.clockOffset is None:
+            self.clockOffset = offset
+        else:
+            self.clockOffset = min(offset, self.clockOffset + CLOCK_DRIFT)
+
+    # The ball position and both paddle positions to draw at local time now, or None before any snapshot
+    # Returns (ballX, ballY, leftY, rightY)
+    def sample(self, now:float) -> Optional[Tuple[int, int, int, int]]:
+        snapshots = self.snapshots
+        if not snapshots:
+            return None
+        renderTick = (now - self.clockOffset)/self.interval - self.delayTicks
+        newer = snapshots[-1]
+        if renderTick >= newer[0]:
+            return newer[1], newer[2], newer[5], newer[6]
+        older = snapshots[0]
+        if renderTick <= older[0]:
+            return older[1], older[2], older[5], older[6]
+        for snapshot in reversed(snapshots):
+            if snapshot[0] <= renderTick:
+                older = snapshot
+                break
+            newer = snapshot
+        t = (renderTick - older[0])/(newer[0] - older[0])
+        leftY = round(older[5] + (newer[5] - older[5])*t)
+        rightY = round(older[6] + (newer[6] - older[6])*t)
+        # A point was scored or the ball went a long way in between, don't slide it across the screen
+        if (older[9], older[10]) != (newer[9], newer[10]) or \
+                abs(newer[1] - older[1]) + abs(newer[2] - older[2]) > SNAP_DISTANCE*(newer[0] - older[0]):
+            return older[1], older[2], leftY, rightY
+        return round(older[1] + (newer[1] - older[1])*t), round(older[2] + (newer[2] - older[2])*t), leftY, rightY
+
+
+# Draw between the (ballX, ballY, leftY, rightY) of the last two steps, alpha from TickScheduler.alpha
+# A ball that went a long way in one step was reset after a point and isn't slid across the screen
+def blend(previous:Tuple[int, int, int, int], current:Tuple[int, int, int, int],
+          alpha:float) -> Tuple[int, int, int, int]:
+    leftY = round(previous[2] + (current[2] - previous[2])*alpha)
+    rightY = round(previous[3] + (current[3] - previous[3])*alpha)
+    if abs(current[0] - previous[0]) + abs(current[1] - previous[1]) > SNAP_DISTANCE:
+        return current[0], current[1], leftY, rightY
+    return (round(previous[0] + (current[0] - previous[0])*alpha), round(previous[1] + (current[1] - previous[1])*alpha),
+            leftY, rightY)
@@ -0,0 +1,112 @@
+# This file draws the game by only touching the pixels that change between frames
+# The walls and the center line never move, so they are drawn once onto a background surface. Each frame
+# the places the ball and paddles were drawn last frame are patched from that background, the objects are
+# drawn at their new places, and only those rects are sent to the display.
+import pygame
+from typing import Dict, List, Optional, Tuple
+
+BLACK = (0,0,0)
+WHITE = (255,255,255)
+# Frames per second drawn when pygame can't tell the display's refresh rate
+DEFAULT_REFRESH_RATE = 144
+
+
+# The refresh rate of the display the game is on, frames are drawn this often
+def displayRefreshRate() -> int:
+    # Only some pygame builds can ask SDL for it
+    getRates = getattr(pygame.display, "get_desktop_refresh_rates", None)
+    if getRates is not None:
+        try:
+            rates = [rate for rate in getRates() if rate > 0]
+            if rates:
+                return max(rates)
+        except pygame.error:
+            pass
+    return DEFAULT_REFRESH_RATE
+
+
+class Renderer:
+    def __init__(self, screen:pygame.Surface, scoreFont:pygame.font.Font, color=WHITE, profiler=None) -> None:
+        self.screen = screen
+        self.scoreFont = scoreFont
+        self.color = color
+        self.profiler = profiler    # A frameProfiler.FrameProfiler, the update of the display is timed apart
+        screenWidth, screenHeight = screen.get_size()
+
+        # Static layer: the dotted center line and both walls, the same shapes playGame used to draw every frame
+        self.background = pygame.Surface((screenWidth, screenHeight)).convert()
+        self.background.fill(BLACK)
+        for i in range(0, screenHeight, 10):
+            self.background.fill(color, pygame.Rect((screenWidth/2)-5, i, 5, 5))
+        self.background.fill(color, pygame.Rect(-10, 0, screenWidth+20, 10))
+        self.background.fill(color, pygame.Rect(-10, screenHeight-10, screenWidth+20, 10))
+
+        self.scoreCache: Dict[Tuple[int, int], Tuple[pygame.Surface, pygame.Rect]] = {}
+        self.score: Optional[Tuple[int, int]] = None
+        self.scoreRect = pygame.Rect(0,0,0,0)
+        self.previous: List[pygame.Rect] = []
+        self.redrawAll()
+
+    # Put the whole background back, for the first frame or after something else drew over the screen
+    def redrawAll(self) -> None:
+        self.screen.blit(self.background, (0,0))
+        self.previous = []
+        self.score = None
+        pygame.display.flip()
+
+    # The score text is only rendered the first time each score is seen, placed like helperCode.updateScore
+    def scoreSurface(self, lScore:int, rScore:int) -> Tuple[pygame.Surface, pygame.Rect]:
+        cached = self.scoreCache.get((lScore, rScore))
+        if cached is None:
+            textSurface = self.scoreFont.render(f"{lScore}   {rScore}", False, self.color)
+            textRect = textSurface.get_rect()
+            textRect.center = ((self.screen.get_width()/2)+5, 50)
+            cached = self.scoreCache[(lScore, rScore)] = (textSurface, textRect)
+        return cached
+
+    # Draw the moving objects (the ball and paddle rects) and the score, returns the rects sent to the display
+    # An overlay surface is drawn on top at overlayPosition and patched away next frame like the objects
+    def draw(self, objects:List[pygame.Rect], lScore:int, rScore:int, overlay:Optional[pygame.Surface] = None,
+             overlayPosition:Tuple[int, int] = (0,0)) -> List[pygame.Rect]:
+        screen = self.screen
+        background = self.background
+        dirty = []
+
+        # Patch where everything was last frame from the background
+        for rect in self.previous:
+            screen.blit(background, rect, rect)
+            dirty.append(rect)
+
+        # The score needs drawing when it changed or when something moved over it
+        textSurface, textRect = self.scoreSurface(lScore, rScore)
+        if (lScore, rScore) != self.score:
+            screen.blit(background, self.scoreRect, self.scoreRect)
+            dirty.append(self.scoreRect)
+            self.score = (lScore, rScore)
+            self.scoreRect = textRect
+            dirty.append(textRect)
+            screen.blit(textSurface, textRect)
+        elif textRect.collidelist(self.previous) != -1:
+            screen.blit(textSurface, textRect)
+
+        drawn = []
+        for rect in objects:
+            rect = rect.clip(screen.get_rect())
+            screen.fill(self.color, rect)
+            drawn.append(rect)
+        if overlay is not None:
+            drawn.append(screen.blit(overlay, overlayPosition))
+
+        # One update rect per object covering where it was and where it is, when the two overlap
+        for rect in drawn:
+            for j, old in enumerate(dirty):
+                if old.colliderect(rect):
+                    dirty[j] = old.union(rect)
+                    break
+            else:
+                dirty.append(rect)
+        self.previous = drawn
+        if self.profiler is not None:
+            self.profiler.mark("draw")
+        pygame.display.update(dirty)
+        return dirty
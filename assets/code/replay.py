@@ -0,0 +1,226 @@
+# This file records matches to a compact binary log and plays them back
+# The engine is deterministic, so a match is fully described by its starting state and which way each
+# paddle was moving on every tick. The log stores one byte per tick for the two directions, with a
+# keyframe (the whole GameState) every KEYFRAME_INTERVAL ticks so playback can start close to any tick
+# instead of at the beginning. Closing the recorder appends an index of the keyframes, a log that was
+# never closed (the server died) is still readable, the index is rebuilt by scanning it.
+#
+#   file      = header, then one record per tick, then the optional index
+#   header    = magic, version, screen width, screen height, keyframe interval
+#   record    = input byte (left direction | right direction << 2 | KEYFRAME_FLAG), followed by a
+#               keyframe of the state before that tick's step when KEYFRAME_FLAG is set
+#   index     = keyframe count, (tick, record offset) per keyframe, index offset, INDEX_MAGIC
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from assets.code.gameEngine import GameEngine, GameState, TICK_RATE
+from assets.code.wireProtocol import DIRECTIONS, DIRECTION_CODES
+
+MAGIC = b"PONGRPL"
+VERSION = 2
+KEYFRAME_INTERVAL = 600     # Ten seconds at 60 ticks per second
+KEYFRAME_FLAG = 0x80
+INDEX_MAGIC = b"RPLINDEX"
+
+HEADER = struct.Struct("!7sBHHH")
+KEYFRAME = struct.Struct("!IhhhhhhBBBB")
+INDEX_ENTRY = struct.Struct("!IQ")
+INDEX_COUNT = struct.Struct("!I")
+INDEX_TRAILER = struct.Struct("!Q8s")
+
+
+class ReplayError(Exception):
+    pass
+
+
+def packKeyframe(state:GameState) -> bytes:
+    return KEYFRAME.pack(state.tick, state.ballX, state.ballY, state.ballXVel, state.ballYVel, state.leftY,
+                         state.rightY, DIRECTION_CODES[state.leftMoving], DIRECTION_CODES[state.rightMoving],
+                         state.lScore, state.rScore)
+
+
+def unpackKeyframe(engine:GameEngine, data, offset:int) -> GameState:
+    state = engine.newState()
+    (state.tick, state.ballX, state.ballY, state.ballXVel, state.ballYVel, state.leftY, state.rightY,
+     leftMoving, rightMoving, state.lScore, state.rScore) = KEYFRAME.unpack_from(data, offset)
+    state.leftMoving = DIRECTIONS[leftMoving]
+    state.rightMoving = DIRECTIONS[rightMoving]
+    return state
+
+
+# Appends a match to a replay file as it is played, one record call per tick
+class ReplayRecorder:
+    def __init__(self, path:str, engine:GameEngine, keyframeInterval:int = KEYFRAME_INTERVAL) -> None:
+        self.path = path
+        self.keyframeInterval = keyframeInterval
+        self.file: Optional[BinaryIO] = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, engine.screenWidth, engine.screenHeight, keyframeInterval))
+        self.file.flush()
+        self.offset = HEADER.size
+        self.index: List[Tuple[int, int]] = []
+
+    # Call with the state just before engine.step, once its paddle directions for the tick are set
+    def record(self, state:GameState) -> None:
+        if self.file is None:
+            return
+        code = DIRECTION_CODES[state.leftMoving] | DIRECTION_CODES[state.rightMoving] << 2
+        if state.tick % self.keyframeInterval == 0:
+            self.index.append((state.tick, self.offset))
+            record = bytes((code | KEYFRAME_FLAG,)) + packKeyframe(state)
+        else:
+            record = bytes((code,))
+        self.file.write(record)
+        self.offset += len(record)
+
+    # Hand the records written so far to the OS, the server calls it after each batch of ticks so a server
+    # that dies loses at most the ticks of the batch it was in
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+
+    # Write the keyframe index and close the file, safe to call more than once
+    def close(self) -> None:
+        if self.file is None:
+            return
+        file = self.file
+        self.file = None
+        file.write(INDEX_COUNT.pack(len(self.index)))
+        file.write(b"".join(INDEX_ENTRY.pack(tick, offset) for tick, offset in self.index))
+        file.write(INDEX_TRAILER.pack(self.offset, INDEX_MAGIC))
+        file.close()
+
+
+# Where the server writes replays, None when recording is off
+# Set PONG_REPLAY_DIR to a directory to record every match played on the server into it
+def replayDirFromEnv() -> Optional[str]:
+    return os.environ.get("PONG_REPLAY_DIR") or None
+
+
+def recorderFromEnv(roomId:int, engine:GameEngine) -> Optional[ReplayRecorder]:
+    directory = replayDirFromEnv()
+    if directory is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-room{roomId}.pongreplay"
+    return ReplayRecorder(os.path.join(directory, name), engine)
+
+
+# Reads a replay file through mmap and re-simulates it from the nearest keyframe
+class ReplayPlayer:
+    def __init__(self, path:str) -> None:
+        self.file = open(path, "rb")
+        if os.fstat(self.file.fileno()).st_size == 0:
+            self.file.close()
+            raise ReplayError("Replay file is empty")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < HEADER.size:
+            self.close()
+            raise ReplayError("Replay file is too short")
+        magic, version, screenWidth, screenHeight, self.keyframeInterval = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ReplayError("Not a replay file of this version")
+        self.engine = GameEngine(screenWidth, screenHeight)
+        self.end, self.index = self.readIndex()
+        if not self.index:
+            self.close()
+            raise ReplayError("Replay has no keyframe")
+
+    # Returns the offset the records end at and the keyframe index, from the file or by scanning it
+    def readIndex(self) -> Tuple[int, List[Tuple[int, int]]]:
+        data = self.data
+        if len(data) >= HEADER.size + INDEX_COUNT.size + INDEX_TRAILER.size:
+            end, magic = INDEX_TRAILER.unpack_from(data, len(data) - INDEX_TRAILER.size)
+            if magic == INDEX_MAGIC and HEADER.size <= end <= len(data) - INDEX_TRAILER.size - INDEX_COUNT.size:
+                count, = INDEX_COUNT.unpack_from(data, end)
+                if end + INDEX_COUNT.size + count*INDEX_ENTRY.size + INDEX_TRAILER.size == len(data):
+                    return end, [INDEX_ENTRY.unpack_from(data, end + INDEX_COUNT.size + i*INDEX_ENTRY.size)
+                                 for i in range(count)]
+
+        # No index, the recorder never got to close the file. A record cut short at the end is dropped
+        index = []
+        offset = HEADER.size
+        while offset < len(data):
+            size = 1 + KEYFRAME.size if data[offset] & KEYFRAME_FLAG else 1
+            if offset + size > len(data):
+                break
+            if size > 1:
+                index.append((KEYFRAME.unpack_from(data, offset + 1)[0], offset))
+            offset += size
+        return offset, index
+
+    # The last tick the replay reaches
+    def lastTick(self) -> int:
+        tick, offset = self.index[-1]
+        data = self.data
+        while offset < self.end:
+            offset += 1 + KEYFRAME.size if data[offset] & KEYFRAME_FLAG else 1
+            tick += 1
+        return tick
+
+    # The nearest keyframe at or before tick, binary searched in the index
+    def keyframeBefore(self, tick:int) -> Tuple[int, int]:
+        index = self.index
+        low, high = 0, len(index) - 1
+        if tick < index[0][0]:
+            raise ReplayError(f"Tick {tick} is before the first keyframe")
+        while low < high:
+            middle = (low + high + 1)//2
+            if index[middle][0] <= tick:
+                low = middle
+            else:
+                high = middle - 1
+        return index[low]
+
+    # Yields the state after every tick from the nearest keyframe up to and including until (or the end)
+    # The same GameState object is yielded every time, copy what needs to be kept
+    def play(self, start:int = 0, until:Optional[int] = None) -> Iterator[GameState]:
+        keyframeTick, offset = self.keyframeBefore(start)
+        data = self.data
+        engine = self.engine
+        state = unpackKeyframe(engine, data, offset + 1)
+        if state.tick >= start:
+            yield state
+        end = self.end
+        while offset < end and (until is None or state.tick < until):
+            code = data[offset]
+            offset += 1 + KEYFRAME.size if code & KEYFRAME_FLAG else 1
+            state.leftMoving = DIRECTIONS[code & 3]
+            state.rightMoving = DIRECTIONS[code >> 2 & 3]
+            engine.step(state)
+            if state.tick >= start:
+                yield state
+
+    # The state after the given tick, or the last state if the replay ends before it
+    def seek(self, tick:int) -> GameState:
+        start = min(tick, self.lastTick())
+        state = None
+        for state in self.play(start, start):
+            if state.tick >= start:
+                break
+        return state
+
+    def close(self) -> None:
+        self.data.close()
+        self.file.close()
+
+
+# Print the state at a tick and how fast the whole replay re-simulates
+# Usage: python -m assets.code.replay FILE [TICK]
+if __name__ == '__main__':
+    player = ReplayPlayer(sys.argv[1])
+    last = player.lastTick()
+    tick = min(int(sys.argv[2]), last) if len(sys.argv) > 2 else last
+    state = player.seek(tick)
+    print(f"tick {state.tick} of {last}: ball ({state.ballX}, {state.ballY}) velocity ({state.ballXVel}, "
+          f"{state.ballYVel}), paddles {state.leftY} {state.rightY}, score {state.lScore} - {state.rScore}")
+    start = time.perf_counter()
+    for _ in player.play(0):
+        pass
+    elapsed = time.perf_counter() - start
+    print(f"replayed {last} ticks in {elapsed:.3f}s, {last/max(elapsed, 1e-9)/TICK_RATE:.0f}x real time")
+    player.close()
@@ -0,0 +1,112 @@
+# This file is the client's rollback mode
+# Instead of drawing the ball and the opponent a few ticks in the past (netcode.SnapshotInterpolator),
+# the client runs the whole game itself, one tick per input it sends, guessing that the opponent keeps
+# moving the way the last snapshot said. Every predicted tick is saved to a ring buffer. When the server's
+# snapshot for one of those inputs arrives it is compared with the saved tick, a match means the guess
+# was right and nothing happens, otherwise the game is rewound to the server's state and every tick after
+# it is simulated again with the inputs kept in the ring, all within the frame the snapshot arrived in.
+#
+# The ring is a flat array.array of ints, saving a tick copies eleven numbers into it and checking one
+# compares them in place, nothing is allocated or pickled.
+from array import array
+from typing import Tuple
+
+from assets.code.gameEngine import GameEngine, GameState
+from assets.code.wireProtocol import DIRECTIONS, DIRECTION_CODES
+
+ROLLBACK_WINDOW = 128   # Ticks that can be rewound, about two seconds at 60 ticks per second
+FIELD_COUNT = 11        # tick, ball x/y/xVel/yVel, left/right y, left/right moving, scores
+
+
+class StateRing:
+    def __init__(self, size:int = ROLLBACK_WINDOW) -> None:
+        self.size = size
+        self.values = array("i", bytes(4 * size * FIELD_COUNT))
+        self.keys = array("q", [-1]) * size
+
+    def save(self, key:int, state:GameState) -> None:
+        slot = key % self.size
+        base = slot * FIELD_COUNT
+        values = self.values
+        values[base] = state.tick
+        values[base + 1] = state.ballX
+        values[base + 2] = state.ballY
+        values[base + 3] = state.ballXVel
+        values[base + 4] = state.ballYVel
+        values[base + 5] = state.leftY
+        values[base + 6] = state.rightY
+        values[base + 7] = DIRECTION_CODES[state.leftMoving]
+        values[base + 8] = DIRECTION_CODES[state.rightMoving]
+        values[base + 9] = state.lScore
+        values[base + 10] = state.rScore
+        self.keys[slot] = key
+
+    def has(self, key:int) -> bool:
+        return key >= 0 and self.keys[key % self.size] == key
+
+    # Whether the saved tick has the same ball, paddles and score as a snapshot from decodeSnapshot
+    # The tick numbers aren't compared, the client counts its inputs and the server counts its ticks
+    def matches(self, key:int, snapshot:Tuple) -> bool:
+        base = key % self.size * FIELD_COUNT
+        values = self.values
+        return (values[base + 1] == snapshot[1] and values[base + 2] == snapshot[2] and
+                values[base + 3] == snapshot[3] and values[base + 4] == snapshot[4] and
+                values[base + 5] == snapshot[5] and values[base + 6] == snapshot[6] and
+                values[base + 9] == snapshot[9] and values[base + 10] == snapshot[10])
+
+
+class RollbackSession:
+    def __init__(self, engine:GameEngine, side:str) -> None:
+        self.engine = engine
+        self.side = side
+        self.state = engine.newState()
+        self.ring = StateRing()
+        self.directions = array("b", [0]) * ROLLBACK_WINDOW     # This player's direction for every input
+        self.sequence = 0       # Newest input simulated
+        self.confirmed = 0      # Newest input the server acknowledged
+        self.remoteMoving = ""  # What the opponent is guessed to keep doing
+        # How often the guess was wrong and how many ticks were simulated again because of it
+        self.rollbacks = 0
+        self.resimulated = 0
+
+    def stepWith(self, direction:str) -> None:
+        state = self.state
+        if self.side == "left":
+            state.leftMoving, state.rightMoving = direction, self.remoteMoving
+        else:
+            state.leftMoving, state.rightMoving = self.remoteMoving, direction
+        self.engine.step(state)
+
+    # Simulate the tick of a newly sent input, returns the predicted state to draw
+    def advance(self, sequence:int, direction:str) -> GameState:
+        self.stepWith(direction)
+        self.directions[sequence % ROLLBACK_WINDOW] = DIRECTION_CODES[direction]
+        self.ring.save(sequence, self.state)
+        self.sequence = sequence
+        return self.state
+
+    # Check a snapshot from the server against the prediction and roll back if they differ
+    # Returns True if the game was rewound and simulated again
+    def confirm(self, snapshot:Tuple) -> bool:
+        self.remoteMoving = snapshot[8] if self.side == "left" else snapshot[7]
+        ack = snapshot[12] if self.side == "left" else snapshot[13]
+        # A snapshot without a newer input of ours in it has nothing to check the prediction against
+        if ack <= self.confirmed and self.confirmed:
+            return False
+        self.confirmed = ack
+        if self.ring.has(ack) and self.ring.matches(ack, snapshot):
+            return False
+
+        # Rewind to the server's state, then simulate the inputs it hadn't seen yet again
+        state = self.state
+        (state.tick, state.ballX, state.ballY, state.ballXVel, state.ballYVel, state.leftY, state.rightY,
+         state.leftMoving, state.rightMoving, state.lScore, state.rScore) = snapshot[:11]
+        first = max(ack + 1, self.sequence - ROLLBACK_WINDOW + 1)
+        if ack > 0:
+            self.ring.save(ack, state)
+        for sequence in range(first, self.sequence + 1):
+            self.stepWith(DIRECTIONS[self.directions[sequence % ROLLBACK_WINDOW]])
+            self.ring.save(sequence, state)
+        self.rollbacks += 1
+        self.resimulated += max(0, self.sequence - first + 1)
+        return True
@@ -0,0 +1,246 @@
+# This file keeps track of which clients are playing each other so one server can host many matches
+# A member is whatever the server uses to identify a client (a socket for ThreadedServer, a Connection
+# for EventLoopServer), it only needs to be hashable.
+#
+# Every player also has a session token, sent to it in the HELLO. A player that drops out of a running
+# match is parked instead of ending the match: its room waits (with the player's slot empty) until it
+# reconnects with the token and takes the slot back, or the server's grace period runs out.
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class Room:
+    __slots__ = ("roomId", "left", "right", "ready", "started", "closed", "state", "scheduler", "events",
+                 "leftSeq", "rightSeq", "history", "recorder", "spectators", "away",
+                 "inputLock")
+
+    def __init__(self, roomId:int, left:Any) -> None:
+        self.roomId = roomId
+        self.left = left
+        self.right = None
+        self.ready = set()      # Players of the room that sent READY
+        self.started = False
+        self.closed = False
+        # Filled in by the server when the match starts: a gameEngine.GameState, its TickScheduler and
+        # the event flags gathered since the last snapshot was sent
+        self.state = None
+        self.scheduler = None
+        self.events = 0
+        # Newest input sequence number applied for each side, inputs can arrive late or twice over UDP
+        self.leftSeq = 0
+        self.rightSeq = 0
+        # udpTransport.SnapshotHistory of recent snapshots, created once a player plays over UDP
+        self.history = None
+        # replay.ReplayRecorder the match is written to, None unless the server records replays
+        self.recorder = None
+        # spectators.Spectator watching the match, None once the match is over and takes no more viewers
+        self.spectators = []
+        # Players parked until they resume, the game is paused while there are any
+        self.away = 0
+        # Held by ThreadedServer while an input is applied and while a tick is recorded and stepped, so the
+        # replay holds the inputs the tick was stepped with. EventLoopServer does both on one thread
+        self.inputLock = threading.Lock()
+
+    def members(self) -> List[Any]:
+        return [member for member in (self.left, self.right) if member is not None]
+
+    def sideOf(self, member:Any) -> str:
+        return "left" if member is self.left else "right"
+
+    def peerOf(self, member:Any) -> Any:
+        return self.right if member is self.left else self.left
+
+    # Apply a player's input unless a newer one was already applied, the engine reads it on the next tick
+    def applyInput(self, member:Any, direction:str, sequence:int) -> bool:
+        if self.state is None:
+            return False
+        if member is self.left:
+            if sequence <= self.leftSeq:
+                return False
+            self.leftSeq = sequence
+            self.state.leftMoving = direction
+        else:
+            if sequence <= self.rightSeq:
+                return False
+            self.rightSeq = sequence
+            self.state.rightMoving = direction
+        return True
+
+
+class RoomRegistry:
+    # Room ids count up from firstRoomId in steps of roomIdStep, so workers of a sharded server never hand out
+    # the same id
+    def __init__(self, firstRoomId:int = 1, roomIdStep:int = 1) -> None:
+        self.rooms: Dict[int, Room] = {}
+        self.roomByMember: Dict[Any, Room] = {}
+        # Rooms with a left player waiting for an opponent, oldest first
+        self.lobby: "OrderedDict[int, Room]" = OrderedDict()
+        self.roomIds = itertools.count(firstRoomId, roomIdStep)
+        # Spectators waiting for the next match to start because none was being played
+        self.waitingSpectators: List[Any] = []
+        # Session token of every player, and (room, side, deadline) of the parked ones by token
+        self.tokens: Dict[Any, int] = {}
+        self.parked: Dict[int, Tuple[Room, str, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self.rooms)
+
+    # Put a new client in the empty slot of the oldest waiting room, or open a room for it if nobody is waiting
+    # Returns the room and the side the client plays
+    def join(self, member:Any, token:Optional[int] = None) -> Tuple[Room, str]:
+        if self.lobby:
+            _, room = self.lobby.popitem(last=False)
+            if room.left is None:
+                room.left = member
+                side = "left"
+            else:
+                room.right = member
+                side = "right"
+        else:
+            room = Room(next(self.roomIds), member)
+            self.rooms[room.roomId] = room
+            self.lobby[room.roomId] = room
+            side = "left"
+        self.roomByMember[member] = room
+        if token is not None:
+            self.tokens[member] = token
+        return room, side
+
+    # Undo the join of a client that turned out to be resuming a session instead, or that left before its match
+    # started. A room it opened or filled goes back to the front of the lobby with its slot empty, an opponent
+    # that joined it in the meantime keeps its side (its HELLO already told it) and whether it is ready, and the
+    # next client to join takes the slot
+    def cancelJoin(self, member:Any) -> None:
+        room = self.roomByMember.pop(member, None)
+        self.tokens.pop(member, None)
+        if room is None or room.started:
+            return
+        if room.left is member:
+            room.left = None
+        else:
+            room.right = None
+        room.ready.discard(member)
+        if room.left is None and room.right is None:
+            self.rooms.pop(room.roomId, None)
+            self.lobby.pop(room.roomId, None)
+            return
+        self.lobby[room.roomId] = room
+        self.lobby.move_to_end(room.roomId, last=False)
+
+    # Take a player that dropped out of its running match out of the room until deadline (a time.monotonic())
+    # Returns the room, or None when the player had no room
+    def park(self, member:Any, deadline:float) -> Optional[Room]:
+        room = self.roomByMember.pop(member, None)
+        token = self.tokens.pop(member, None)
+        if room is None:
+            return None
+        side = room.sideOf(member)
+        if side == "left":
+            room.left = None
+        else:
+            room.right = None
+        room.away += 1
+        if token is not None:
+            self.parked[token] = (room, side, deadline)
+        return room
+
+    # Put a reconnected player back in the slot of its parked session, returns (room, side) or None when the
+    # token isn't parked (unknown, expired, or the match ended in the meantime)
+    def resume(self, token:int, member:Any) -> Optional[Tuple[Room, str]]:
+        entry = self.parked.pop(token, None)
+        if entry is None:
+            return None
+        room, side, _ = entry
+        if room.closed:
+            return None
+        if side == "left":
+            room.left = member
+        else:
+            room.right = member
+        room.away -= 1
+        self.roomByMember[member] = room
+        self.tokens[member] = token
+        return room, side
+
+    # End the matches of players whose grace period ran out, returns their rooms so the server can close the
+    # players still in them
+    def expire(self, now:float) -> List[Room]:
+        expired = []
+        for token, (room, _, deadline) in list(self.parked.items()):
+            if deadline <= now and token in self.parked:
+                self.closeRoom(room)
+                expired.append(room)
+        return expired
+
+    def roomOf(self, member:Any) -> Optional[Room]:
+        return self.roomByMember.get(member)
+
+    def peerOf(self, member:Any) -> Any:
+        room = self.roomByMember.get(member)
+        return room.peerOf(member) if room is not None else None
+
+    # Record that a client is ready, returns the room once both of its players are ready
+    def markReady(self, member:Any) -> Optional[Room]:
+        room = self.roomByMember.get(member)
+        if room is None:
+            return None
+        room.ready.add(member)
+        if room.left in room.ready and room.right in room.ready and not room.started:
+            room.started = True
+            room.spectators.extend(self.waitingSpectators)
+            self.waitingSpectators = []
+            return room
+        return None
+
+    # Add a spectator to the match with roomId, or the newest match being played when that isn't one
+    # Returns the room, or None when nothing is being played and the spectator waits for the next match
+    def watch(self, spectator:Any, roomId:Optional[int] = None) -> Optional[Room]:
+        room = self.rooms.get(roomId) if roomId is not None else None
+        if room is None or not room.started or room.spectators is None:
+            room = None
+            for candidate in reversed(self.rooms.values()):
+                if candidate.started and candidate.spectators is not None:
+                    room = candidate
+                    break
+        if room is None:
+            self.waitingSpectators.append(spectator)
+            return None
+        room.spectators.append(spectator)
+        return room
+
+    # Stop a room taking spectators, returns the ones it had so the server can close them
+    def endSpectating(self, room:Room) -> List[Any]:
+        spectators = room.spectators or []
+        room.spectators = None
+        return spectators
+
+    # Take out a client that left. An opponent still waiting for the match to start goes back to the lobby, but
+    # a match that started can't go on with one player and is torn down
+    # Returns the other members of the room that have to be closed
+    def leave(self, member:Any) -> List[Any]:
+        room = self.roomByMember.get(member)
+        if room is not None and not room.started:
+            self.cancelJoin(member)
+            return []
+        self.roomByMember.pop(member, None)
+        self.tokens.pop(member, None)
+        if room is None:
+            return []
+        return [other for other in self.closeRoom(room) if other is not member]
+
+    # Tear down a room and forget its players and parked sessions, returns the players still in it
+    def closeRoom(self, room:Room) -> List[Any]:
+        room.closed = True
+        self.rooms.pop(room.roomId, None)
+        self.lobby.pop(room.roomId, None)
+        if room.away:
+            for token, entry in list(self.parked.items()):
+                if entry[0] is room:
+                    del self.parked[token]
+        members = room.members()
+        for member in members:
+            self.roomByMember.pop(member, None)
+            self.tokens.pop(member, None)
+        return members
@@ -0,0 +1,234 @@
+# This file counts what the server does for every connection and room and writes it out for Prometheus
+# Everything is plain integer counters and fixed bucket histograms updated by the thread that already
+# handles the connection, so leaving it on costs a few additions per message. Rates (messages per
+# second and so on) come from Prometheus taking the rate() of the counters.
+#
+# Set PONG_METRICS_FILE to a path to have the server rewrite that file in the Prometheus text format
+# every PONG_METRICS_INTERVAL seconds (default 5), for node_exporter's textfile collector or a cat.
+import bisect
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+# Seconds, for the relay latency and round trip histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SENT_TIMES = 64     # Send times of the last snapshots kept per room, to time the round trip of UDP acks
+DEFAULT_INTERVAL = 5.0
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value:float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def add(self, other:"Histogram") -> None:
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.count += other.count
+
+
+# The counters of one client connection
+class ConnectionMetrics:
+    __slots__ = ("room", "side", "messagesIn", "bytesIn", "messagesOut", "bytesOut", "inputTick", "pendingSince",
+                 "ackTick", "relayLatency", "rtt")
+
+    def __init__(self, room, side:str) -> None:
+        self.room = room
+        self.side = side
+        self.messagesIn = 0
+        self.bytesIn = 0
+        self.messagesOut = 0
+        self.bytesOut = 0
+        self.inputTick = 0          # Room tick the newest input arrived at
+        self.pendingSince = None    # When the oldest input not yet sent out in a snapshot arrived
+        self.ackTick = 0
+        self.relayLatency = Histogram()
+        self.rtt = Histogram()
+
+    # Inputs arrived from the client
+    def received(self, messages:int, size:int, now:float) -> None:
+        self.messagesIn += messages
+        self.bytesIn += size
+        if self.room.state is not None:
+            self.inputTick = self.room.state.tick
+        if self.pendingSince is None:
+            self.pendingSince = now
+
+    def sent(self, size:int) -> None:
+        self.messagesOut += 1
+        self.bytesOut += size
+
+    def add(self, other:"ConnectionMetrics") -> None:
+        self.messagesIn += other.messagesIn
+        self.bytesIn += other.bytesIn
+        self.messagesOut += other.messagesOut
+        self.bytesOut += other.bytesOut
+        self.relayLatency.add(other.relayLatency)
+        self.rtt.add(other.rtt)
+
+
+# Bytes the kernel still holds in a TCP socket's send queue, None where that can't be asked (not Linux)
+def kernelSendQueue(sock) -> Optional[int]:
+    try:
+        import fcntl
+        import struct
+        import termios
+        return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+    except (ImportError, AttributeError, OSError, ValueError):
+        return None
+
+
+class ServerMetrics:
+    def __init__(self) -> None:
+        # Adding and removing connections happens on several threads in ThreadedServer, the counters of a
+        # connection are only written by the threads handling that connection and its room
+        self.lock = threading.Lock()
+        self.connections: Dict[Any, ConnectionMetrics] = {}
+        # Totals of connections that are gone, so the server wide counters never go down
+        self.closed = ConnectionMetrics(None, "")
+        self.connectionsTotal = 0
+        self.sentTimes: Dict[int, List[float]] = {}
+
+    def add(self, member:Any, room, side:str) -> ConnectionMetrics:
+        metrics = ConnectionMetrics(room, side)
+        with self.lock:
+            self.connections[member] = metrics
+            self.connectionsTotal += 1
+        return metrics
+
+    def remove(self, member:Any) -> None:
+        with self.lock:
+            metrics = self.connections.pop(member, None)
+            if metrics is None:
+                return
+            self.closed.add(metrics)
+            if all(other not in self.connections for other in metrics.room.members()):
+                self.sentTimes.pop(metrics.room.roomId, None)
+
+    def of(self, member:Any) -> Optional[ConnectionMetrics]:
+        return self.connections.get(member)
+
+    # A snapshot of the room went out to every player at time now, which relays every input that was waiting
+    def snapshotSent(self, room, now:float) -> None:
+        times = self.sentTimes.get(room.roomId)
+        if times is None:
+            times = self.sentTimes[room.roomId] = [0.0] * SENT_TIMES
+        times[room.state.tick % SENT_TIMES] = now
+        for member in room.members():
+            metrics = self.connections.get(member)
+            if metrics is not None and metrics.pendingSince is not None:
+                metrics.relayLatency.observe(now - metrics.pendingSince)
+                metrics.pendingSince = None
+
+    # A UDP client says it has the snapshot of ackTick, the time since that snapshot was sent is a round trip
+    def acked(self, metrics:ConnectionMetrics, ackTick:int, now:float) -> None:
+        if ackTick <= metrics.ackTick or metrics.room.state is None:
+            return
+        metrics.ackTick = ackTick
+        times = self.sentTimes.get(metrics.room.roomId)
+        if times is not None and metrics.room.state.tick - ackTick < SENT_TIMES:
+            metrics.rtt.observe(now - times[ackTick % SENT_TIMES])
+
+    #=============================================================================================================
+    # Render every metric in the Prometheus text format
+    # backlog(member) returns the bytes waiting to be sent to a client, or None if that isn't known
+    #=============================================================================================================
+    def render(self, backlog:Callable[[Any], Optional[int]]) -> str:
+        with self.lock:
+            connections = list(self.connections.items())
+        lines = []
+
+        def metric(name:str, kind:str, help:str, samples) -> None:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        def labels(metrics:ConnectionMetrics) -> str:
+            return f'{{room="{metrics.room.roomId}",side="{metrics.side}"}}'
+
+        rooms = {}
+        for member, metrics in connections:
+            rooms.setdefault(metrics.room.roomId, []).append(metrics)
+        metric("pong_connections", "gauge", "Clients connected", [("", len(connections))])
+        metric("pong_connections_total", "counter", "Clients accepted", [("", self.connectionsTotal)])
+        metric("pong_rooms", "gauge", "Rooms with a client connected", [("", len(rooms))])
+
+        # Per connection counters, then the same over every connection the server ever had
+        totals = ConnectionMetrics(None, "")
+        totals.add(self.closed)
+        for _, metrics in connections:
+            totals.add(metrics)
+        for name, attr, help in (("messages_in", "messagesIn", "Inputs received"),
+                                 ("bytes_in", "bytesIn", "Bytes received"),
+                                 ("messages_out", "messagesOut", "Snapshots sent"),
+                                 ("bytes_out", "bytesOut", "Bytes sent")):
+            metric(f"pong_connection_{name}_total", "counter", f"{help} from or to one client",
+                   [(labels(metrics), getattr(metrics, attr)) for _, metrics in connections])
+            metric(f"pong_{name}_total", "counter", f"{help} over every client", [("", getattr(totals, attr))])
+
+        backlogs = []
+        for member, metrics in connections:
+            queued = backlog(member)
+            if queued is not None:
+                backlogs.append((labels(metrics), queued))
+        metric("pong_connection_send_backlog_bytes", "gauge", "Bytes waiting to be sent to the client", backlogs)
+
+        # Ticks since each player's newest input arrived, and how far apart the two players of a room are,
+        # a player whose inputs stall falls behind its opponent
+        lags = {}
+        for _, metrics in connections:
+            state = metrics.room.state
+            if state is not None:
+                lags[id(metrics)] = state.tick - metrics.inputTick
+        metric("pong_connection_input_lag_ticks", "gauge", "Ticks since the client's newest input arrived",
+               [(labels(metrics), lags[id(metrics)]) for _, metrics in connections if id(metrics) in lags])
+        gaps = []
+        for roomId, players in rooms.items():
+            if len(players) == 2 and id(players[0]) in lags and id(players[1]) in lags:
+                gaps.append((f'{{room="{roomId}"}}', abs(lags[id(players[0])] - lags[id(players[1])])))
+        metric("pong_room_sync_gap_ticks", "gauge", "Difference between the input lag of a room's players", gaps)
+
+        for name, attr, help in (("relay_latency_seconds", "relayLatency",
+                                  "Time from an input arriving to the snapshot with it being sent"),
+                                 ("rtt_seconds", "rtt", "Time from a snapshot being sent to a UDP client acking it")):
+            histogram = getattr(totals, attr)
+            samples = []
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                samples.append((f'_bucket{{le="{bound}"}}', cumulative))
+            lines.append(f"# HELP pong_{name} {help}")
+            lines.append(f"# TYPE pong_{name} histogram")
+            lines.extend(f"pong_{name}{suffix} {value}" for suffix, value in samples)
+            lines.append(f"pong_{name}_sum {histogram.total}")
+            lines.append(f"pong_{name}_count {histogram.count}")
+            metric(f"pong_connection_{name}_sum", "counter", help + ", summed for one client",
+                   [(labels(metrics), getattr(metrics, attr).total) for _, metrics in connections])
+            metric(f"pong_connection_{name}_count", "counter", help + ", counted for one client",
+                   [(labels(metrics), getattr(metrics, attr).count) for _, metrics in connections])
+        return "\n".join(lines) + "\n"
+
+
+# Where and how often the server writes its metrics, (None, interval) when it doesn't
+def metricsFileFromEnv():
+    path = os.environ.get("PONG_METRICS_FILE") or None
+    interval = float(os.environ.get("PONG_METRICS_INTERVAL") or DEFAULT_INTERVAL)
+    return path, interval
+
+
+# Replace the file in one step, so whatever reads it never sees half of it
+def writeMetricsFile(path:str, text:str) -> None:
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        file.write(text)
+    os.replace(temporary, path)
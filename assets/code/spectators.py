@@ -0,0 +1,92 @@
+# This file sends a match to the clients watching it
+# Every tick's snapshot is encoded once and the same bytes go to every spectator of the room. Spectator
+# sockets are non-blocking: when one can't take a whole snapshot, the part that is left is kept as a
+# memoryview into the shared bytes (nothing is copied) and newer snapshots are skipped for that spectator
+# until it has caught up, so a slow viewer just sees fewer updates and never holds up the players. One
+# that stays stuck for MAX_SKIPPED snapshots in a row is dropped.
+import socket
+from typing import List, Optional, Tuple
+
+from assets.code.wireProtocol import encodeStart
+
+# Spectators connect to the game port plus this, the handshake is the same as a player's with the side
+# "spectator", and the room id in the client's READY says which match to watch (0 for the newest)
+SPECTATOR_PORT_OFFSET = 1
+MAX_SKIPPED = 120       # Two seconds of snapshots at 60 ticks per second
+# Kernel send buffer of a spectator socket, small so a viewer that stops reading is noticed in seconds
+# instead of after the kernel queued megabytes for it
+SEND_BUFFER = 8192
+
+
+class Spectator:
+    __slots__ = ("sock", "address", "pending", "skipped")
+
+    def __init__(self, sock:socket.socket, address:Tuple[str, int]) -> None:
+        sock.setblocking(False)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        except OSError:
+            pass
+        self.sock = sock
+        self.address = address
+        # The start message goes out ahead of the first snapshot like any other leftover bytes
+        self.pending: Optional[memoryview] = memoryview(encodeStart())
+        self.skipped = 0
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# Send as much of the buffers as the socket takes right now in one system call, returns the bytes sent
+def sendBuffers(sock:socket.socket, buffers:List[memoryview]) -> int:
+    try:
+        if hasattr(sock, "sendmsg"):
+            return sock.sendmsg(buffers)
+        # Windows has no sendmsg, send them one at a time and stop at the first that doesn't fit
+        sent = 0
+        for buffer in buffers:
+            count = sock.send(buffer)
+            sent += count
+            if count < len(buffer):
+                break
+        return sent
+    except (BlockingIOError, InterruptedError):
+        return 0
+
+
+# Send one encoded frame to every spectator, returns the spectators that were dropped (already closed)
+# A spectator that still has part of an older frame left gets that first, and this frame only if the
+# older one went out completely
+def broadcast(spectators:List[Spectator], frame:bytes) -> List[Spectator]:
+    view = memoryview(frame)
+    dropped = []
+    for spectator in spectators:
+        pending = spectator.pending
+        buffers = [view] if pending is None else [pending, view]
+        try:
+            sent = sendBuffers(spectator.sock, buffers)
+        except OSError:
+            # The viewer went away
+            spectator.close()
+            dropped.append(spectator)
+            continue
+        if pending is not None and sent < len(pending):
+            spectator.pending = pending[sent:]
+            spectator.skipped += 1
+            if spectator.skipped > MAX_SKIPPED:
+                spectator.close()
+                dropped.append(spectator)
+            continue
+        sent -= 0 if pending is None else len(pending)
+        spectator.pending = view[sent:] if sent < len(view) else None
+        spectator.skipped = 0
+    return dropped
+
+
+def closeAll(spectators:List[Spectator]) -> None:
+    for spectator in spectators:
+        spectator.close()
+
@@ -0,0 +1,342 @@
+# This file runs the server as several worker processes so the matches use every CPU core
+# One Python process is held to a single core by the GIL however its I/O is done. The supervisor accepts
+# every connection itself and passes the socket to one of its worker processes over a Unix socket, each
+# worker being a server of its own that owns the rooms of the clients it was handed. SO_REUSEPORT would
+# let the kernel spread the connections without the supervisor, but the kernel picks a worker for each
+# connection on its own, so the two players of a match would usually end up in different processes.
+# Routing here keeps them together: the client after one that opened a room goes to the same worker.
+#
+# Workers report their rooms, connections and players waiting for an opponent every HEARTBEAT_INTERVAL
+# seconds and whenever they take or lose a client. A worker that exits or goes quiet for HEALTH_TIMEOUT
+# seconds is replaced. SIGTERM or SIGINT drains the server: it stops accepting, the workers close players
+# still waiting for an opponent and exit once their matches are over. SIGHUP starts a fresh set of workers
+# for new clients and drains the old ones, to restart on new code without cutting matches short.
+# A client that reconnects to resume its match lands on whichever worker the supervisor picks. That worker
+# sees from the session id which worker holds the match and hands the socket back up to be passed on.
+#
+# Passing sockets between processes needs Unix and Python 3.9 or newer (socket.send_fds).
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import struct
+import time
+from typing import Callable, List, Optional, Tuple
+
+from assets.code.spectators import SPECTATOR_PORT_OFFSET
+
+HEARTBEAT_INTERVAL = 1.0
+HEALTH_TIMEOUT = 5.0        # A worker that hasn't reported for this long is stuck and gets replaced
+DRAIN_TIMEOUT = 600.0       # A draining worker exits after this long even if a match is still going
+
+# Messages on the Unix socket between the supervisor and a worker, a client's socket rides along with
+# CONTROL_CLIENT and CONTROL_SPECTATOR
+#   kind, then four numbers that only CONTROL_STATUS uses: clients received, rooms, connections, lobby
+CONTROL = struct.Struct("!BIIII")
+CONTROL_CLIENT = 1      # Supervisor -> worker, a player to serve
+CONTROL_SPECTATOR = 2   # Supervisor -> worker, a spectator to serve
+CONTROL_DRAIN = 3       # Supervisor -> worker, take no new matches and exit once the running ones are over
+CONTROL_STATUS = 4      # Worker -> supervisor, the heartbeat
+# Either way, a client resuming a session (its id split in two numbers) that belongs to another worker
+CONTROL_RESUME = 5
+# Session ids start with the slot of the worker that issued them, so a resuming client can be sent back to it
+SLOT_SHIFT = 56
+
+
+def sendControl(control:socket.socket, kind:int, values:Tuple[int, ...] = (0, 0, 0, 0),
+                sock:Optional[socket.socket] = None) -> None:
+    message = CONTROL.pack(kind, *values)
+    if sock is None:
+        control.send(message)
+    else:
+        socket.send_fds(control, [message], [sock.fileno()])
+
+
+# Returns (kind, values, socket passed along or None), or None when no message is waiting
+def receiveControl(control:socket.socket) -> Optional[Tuple[int, Tuple[int, ...], Optional[socket.socket]]]:
+    try:
+        data, fds, _, _ = socket.recv_fds(control, CONTROL.size, 1)
+    except (BlockingIOError, InterruptedError):
+        return None
+    sock = socket.socket(fileno=fds[0]) if fds else None
+    if len(data) != CONTROL.size:
+        if sock is not None:
+            sock.close()
+        return None
+    kind, *values = CONTROL.unpack(data)
+    return kind, tuple(values), sock
+
+
+def splitSessionId(sessionId:int) -> Tuple[int, int, int, int]:
+    return sessionId >> 32, sessionId & 0xFFFFFFFF, 0, 0
+
+
+def joinSessionId(values:Tuple[int, ...]) -> int:
+    return values[0] << 32 | values[1]
+
+
+# Where a worker writes its metrics when PONG_METRICS_FILE is set, every worker gets a file of its own
+def workerMetricsPath(path:str, slot:int) -> str:
+    root, extension = os.path.splitext(path)
+    return f"{root}-worker{slot}{extension}"
+
+
+# What the supervisor knows about one worker process
+class WorkerHandle:
+    __slots__ = ("slot", "process", "control", "sent", "rooms", "connections", "lobby", "lastSeen")
+
+    def __init__(self, slot:int, process, control:socket.socket) -> None:
+        self.slot = slot
+        self.process = process
+        self.control = control
+        self.sent = 0           # Clients passed to the worker
+        self.rooms = 0
+        self.connections = 0
+        self.lobby = 0          # Rooms with a player waiting for an opponent
+        self.lastSeen = time.monotonic()
+
+    # Take in a heartbeat, a report from before the newest client reached the worker doesn't count that
+    # client yet, so the supervisor's own count of its connections and lobby is kept until one that does
+    def update(self, received:int, rooms:int, connections:int, lobby:int) -> None:
+        self.lastSeen = time.monotonic()
+        self.rooms = rooms
+        if received == self.sent:
+            self.connections = connections
+            self.lobby = lobby
+
+
+# Runs in the new process: drop what it inherited from the supervisor and start the worker's server
+def runChild(target:Callable, inherited:List[socket.socket], host:str, slot:int, slots:int,
+             control:socket.socket) -> None:
+    for sock in inherited:
+        sock.close()
+    # Ctrl+C and a closed terminal reach every process of the group, only the supervisor acts on them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(host, slot, slots, control)
+
+
+class Supervisor:
+    # target(host, slot, slots, control) runs a worker's server, slot numbers the worker among the slots a
+    # server can have at once (used to keep room ids apart) and control is its end of the Unix socket
+    def __init__(self, host:str, port:int, workers:int, target:Callable) -> None:
+        if not hasattr(socket, "send_fds"):
+            raise RuntimeError("The sharded server needs Unix and Python 3.9 or newer")
+        self.host = host
+        self.port = port
+        self.workerCount = workers
+        self.target = target
+        self.context = multiprocessing.get_context("fork")
+        self.selector = selectors.DefaultSelector()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.spectatorSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.spectatorSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.spectatorSock.bind((host, port + SPECTATOR_PORT_OFFSET if port else 0))
+        self.spectatorSock.setblocking(False)
+        self.workers: List[WorkerHandle] = []       # Taking new clients
+        self.draining: List[WorkerHandle] = []      # Finishing their matches before they exit
+        # Each SIGHUP switches between two sets of slots, so new workers never share room ids with the old
+        self.generation = 0
+        self.lastMatch: Optional[WorkerHandle] = None   # Spectators go to the worker of the newest match
+        self.signalled = None
+        self.accepting = True
+
+    def startWorker(self, slot:int) -> WorkerHandle:
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        inherited = [self.sock, self.spectatorSock, ours]
+        inherited += [worker.control for worker in self.workers + self.draining]
+        process = self.context.Process(target=runChild, args=(self.target, inherited, self.host, slot,
+                                                              self.workerCount * 2, theirs))
+        process.start()
+        theirs.close()
+        ours.setblocking(False)
+        worker = WorkerHandle(slot, process, ours)
+        self.selector.register(ours, selectors.EVENT_READ, worker)
+        return worker
+
+    # Forget a worker whose process has exited or been killed
+    def retire(self, worker:WorkerHandle) -> None:
+        self.selector.unregister(worker.control)
+        worker.control.close()
+        worker.process.join(1)
+        if self.lastMatch is worker:
+            self.lastMatch = None
+
+    def drain(self, worker:WorkerHandle) -> None:
+        try:
+            sendControl(worker.control, CONTROL_DRAIN)
+        except OSError:
+            pass
+        self.draining.append(worker)
+
+    #=============================================================================================================
+    # Purpose: The purpose of this function is to start the workers and pass them every client that connects
+    #          until the supervisor is told to stop, then wait for the workers to drain
+    # Preconditions: This function expects to be called from the main thread, it installs signal handlers
+    # Postconditions: The function returns once every worker has exited after SIGTERM or SIGINT
+    #=============================================================================================================
+    def listen(self) -> None:
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.onSignal)
+        self.sock.listen(socket.SOMAXCONN)
+        self.spectatorSock.listen(socket.SOMAXCONN)
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.selector.register(self.spectatorSock, selectors.EVENT_READ, self.spectatorSock)
+        self.workers = [self.startWorker(slot) for slot in range(self.workerCount)]
+        print(f"Supervisor started {self.workerCount} workers")
+
+        nextCheck = time.monotonic() + HEARTBEAT_INTERVAL
+        while self.workers or self.draining:
+            for key, _ in self.selector.select(HEARTBEAT_INTERVAL):
+                if key.data is None:
+                    self.acceptClients()
+                elif key.data is self.spectatorSock:
+                    self.acceptSpectators()
+                else:
+                    self.readWorker(key.data)
+            if self.signalled is not None:
+                self.handleSignal(self.signalled)
+                self.signalled = None
+            now = time.monotonic()
+            if now >= nextCheck:
+                self.checkWorkers(now)
+                nextCheck = now + HEARTBEAT_INTERVAL
+        print("All workers drained")
+
+    # Signal handlers only note the signal, the loop acts on it between selects
+    def onSignal(self, signum, frame) -> None:
+        self.signalled = signum
+
+    def handleSignal(self, signum:int) -> None:
+        if signum == signal.SIGHUP and self.accepting:
+            print("Restarting workers, the old ones finish their matches first")
+            self.generation += 1
+            offset = self.workerCount * (self.generation % 2)
+            old = self.workers
+            self.workers = []
+            for worker in old:
+                self.drain(worker)
+            self.workers = [self.startWorker(offset + slot) for slot in range(self.workerCount)]
+            self.lastMatch = None
+        elif signum != signal.SIGHUP and self.accepting:
+            print("Draining, waiting for the running matches to finish")
+            self.accepting = False
+            for sock in (self.sock, self.spectatorSock):
+                self.selector.unregister(sock)
+                sock.close()
+            for worker in self.workers:
+                self.drain(worker)
+            self.workers = []
+
+    #=============================================================================================================
+    # Purpose: The purpose of this function is to pass every waiting client to a worker. A client goes to the
+    #          worker with a player waiting for an opponent if there is one, so the two land in the same room,
+    #          otherwise to the worker with the fewest connections where it opens a room
+    # Preconditions: This function expects the listening socket to be readable
+    # Postconditions: Each client's socket now belongs to a worker and is closed in the supervisor
+    #=============================================================================================================
+    def acceptClients(self) -> None:
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print("Error accepting client:", e)
+                return
+            worker = self.route()
+            try:
+                sendControl(worker.control, CONTROL_CLIENT, sock=sock)
+                worker.sent += 1
+            except OSError as e:
+                # The worker is gone, the health check replaces it and the client can join again
+                print("Error passing client to worker:", e)
+            sock.close()
+
+    def route(self) -> WorkerHandle:
+        for worker in self.workers:
+            if worker.lobby > 0:
+                worker.lobby -= 1
+                worker.connections += 1
+                self.lastMatch = worker
+                return worker
+        worker = min(self.workers, key=lambda worker: worker.connections)
+        worker.lobby += 1
+        worker.connections += 1
+        return worker
+
+    # Spectators can't be routed by the room they ask for, that only arrives after the HELLO, so they watch
+    # on the worker that started the newest match
+    def acceptSpectators(self) -> None:
+        while True:
+            try:
+                sock, _ = self.spectatorSock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print("Error accepting spectator:", e)
+                return
+            worker = self.lastMatch or max(self.workers, key=lambda worker: worker.rooms)
+            try:
+                sendControl(worker.control, CONTROL_SPECTATOR, sock=sock)
+            except OSError as e:
+                print("Error passing spectator to worker:", e)
+            sock.close()
+
+    def readWorker(self, worker:WorkerHandle) -> None:
+        while True:
+            message = receiveControl(worker.control)
+            if message is None:
+                return
+            kind, values, sock = message
+            if kind == CONTROL_STATUS:
+                worker.update(*values)
+            elif kind == CONTROL_RESUME and sock is not None:
+                self.passResume(values, sock)
+                continue
+            if sock is not None:
+                sock.close()
+
+    # Pass a resuming client to the worker holding its match, a worker that is gone took the match with it
+    def passResume(self, values:Tuple[int, ...], sock:socket.socket) -> None:
+        slot = joinSessionId(values) >> SLOT_SHIFT
+        for worker in self.workers + self.draining:
+            if worker.slot == slot:
+                try:
+                    sendControl(worker.control, CONTROL_RESUME, values, sock)
+                except OSError as e:
+                    print("Error passing resuming client to worker:", e)
+                break
+        sock.close()
+
+    #=============================================================================================================
+    # Purpose: The purpose of this function is to replace workers that have exited or stopped reporting, and to
+    #          forget draining workers once they have exited
+    # Preconditions: This function is called by listen every HEARTBEAT_INTERVAL seconds
+    # Postconditions: self.workers holds workerCount live workers unless the supervisor is draining
+    #=============================================================================================================
+    def checkWorkers(self, now:float) -> None:
+        for i, worker in enumerate(self.workers):
+            alive = worker.process.is_alive()
+            if alive and now - worker.lastSeen <= HEALTH_TIMEOUT:
+                continue
+            if alive:
+                print(f"Worker {worker.slot} stopped responding, restarting it")
+                worker.process.kill()
+            else:
+                print(f"Worker {worker.slot} exited with code {worker.process.exitcode}, restarting it")
+            self.retire(worker)
+            self.workers[i] = self.startWorker(worker.slot)
+        for worker in list(self.draining):
+            if worker.process.is_alive() and now - worker.lastSeen > HEALTH_TIMEOUT:
+                print(f"Draining worker {worker.slot} stopped responding, killing it")
+                worker.process.kill()
+            elif worker.process.is_alive():
+                continue
+            self.retire(worker)
+            self.draining.remove(worker)
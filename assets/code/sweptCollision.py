@@ -0,0 +1,91 @@
+# This file moves the ball through a tick without letting it pass through anything
+# Instead of moving the ball a whole tick and then checking whether it overlaps a wall or paddle, the
+# ball is swept along its path: the moment within the tick it reaches the first surface in its way is
+# worked out, it bounces there and carries on for the rest of the tick, possibly bouncing again. However
+# fast it goes it can't skip past a paddle or a wall, and it never sits inside one to bounce twice.
+#
+# Time within a tick is counted in TIME_ONE steps and the ball's position in pixels times TIME_ONE, so
+# position + velocity*time is exact integer arithmetic. The engine, the rollback client and
+# batchSimulator (which does the same with NumPy) all get the same answer to the last bit.
+#
+# The walls are half planes, a ball inside one moving further in bounces straight away. The paddles are
+# only hit on the face that looks at the middle of the screen, a ball that got past a face goes on to score.
+from typing import Tuple
+
+TIME_ONE = 1 << 16      # One tick
+MAX_BOUNCES = 8         # Bounces worked out per tick, the rest of a tick after that is moved without any
+NEVER = TIME_ONE + 1
+
+CONTACT_NONE = 0
+CONTACT_TOP = 1
+CONTACT_BOTTOM = 2
+CONTACT_LEFT = 3
+CONTACT_RIGHT = 4
+
+
+# Where the ball can go, in pixels
+class Field:
+    __slots__ = ("topY", "bottomY", "leftFace", "rightFace", "paddleHeight", "ballSize")
+
+    def __init__(self, topY:int, bottomY:int, leftFace:int, rightFace:int, paddleHeight:int, ballSize:int) -> None:
+        self.topY = topY            # Bottom edge of the top wall
+        self.bottomY = bottomY      # Top edge of the bottom wall
+        self.leftFace = leftFace    # Right edge of the left paddle
+        self.rightFace = rightFace  # Left edge of the right paddle
+        self.paddleHeight = paddleHeight
+        self.ballSize = ballSize
+
+
+# Move the ball one tick with both paddles at leftY and rightY
+# Returns the ball's new position and velocity and how many times it bounced
+def sweepBall(field:Field, x:int, y:int, xVel:int, yVel:int, leftY:int, rightY:int) -> Tuple[int, int, int, int, int]:
+    one = TIME_ONE
+    ballSize = field.ballSize*one
+    paddleHeight = field.paddleHeight*one
+    # Limits of the ball's top left corner
+    top = field.topY*one
+    bottom = field.bottomY*one - ballSize
+    leftFace = field.leftFace*one
+    rightFace = field.rightFace*one - ballSize
+
+    x *= one
+    y *= one
+    time = 0
+    bounces = 0
+    while bounces < MAX_BOUNCES:
+        rest = one - time
+        wait = NEVER
+        contact = CONTACT_NONE
+        if yVel < 0 and y + yVel*rest < top:
+            wait, contact = max(0, (y - top)//-yVel), CONTACT_TOP
+        elif yVel > 0 and y + yVel*rest > bottom:
+            wait, contact = max(0, (bottom - y)//yVel), CONTACT_BOTTOM
+
+        # A paddle is hit when the ball crosses its face while level with it, a wall reached at the same
+        # time goes first and the paddle is hit right after
+        paddleWait = NEVER
+        if xVel < 0 and x >= leftFace and x + xVel*rest < leftFace:
+            paddleWait, paddleY, paddleContact = (x - leftFace)//-xVel, leftY*one, CONTACT_LEFT
+        elif xVel > 0 and x <= rightFace and x + xVel*rest > rightFace:
+            paddleWait, paddleY, paddleContact = (rightFace - x)//xVel, rightY*one, CONTACT_RIGHT
+        if paddleWait < wait:
+            ballY = y + yVel*paddleWait
+            if ballY < paddleY + paddleHeight and paddleY < ballY + ballSize:
+                wait, contact = paddleWait, paddleContact
+
+        if contact == CONTACT_NONE:
+            break
+        x += xVel*wait
+        y += yVel*wait
+        time += wait
+        bounces += 1
+        if contact == CONTACT_TOP or contact == CONTACT_BOTTOM:
+            yVel = -yVel
+        else:
+            # The further from the paddle's center the steeper it leaves, like Ball.hitPaddle
+            xVel = -xVel
+            yVel = ((y + one//2)//one + field.ballSize//2 - (paddleY//one + field.paddleHeight//2))//2
+
+    x += xVel*(one - time)
+    y += yVel*(one - time)
+    return (x + one//2)//one, (y + one//2)//one, xVel, yVel, bounces
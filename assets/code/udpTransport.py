@@ -0,0 +1,338 @@
+# This file is the optional UDP transport used once a game has started
+# The TCP connection still does the handshake, but then inputs and snapshots go over UDP so one lost
+# packet only loses that packet instead of holding up everything behind it.
+#
+#   input datagram     = version, type, session token, newest input sequence, newest snapshot tick the
+#                        client has, then the directions of the last few inputs sent (oldest first) so
+#                        a lost datagram is covered by the next one
+#   snapshot datagram  = version, type, tick, base tick, changed field mask, event flags, then only the
+#                        fields that differ from the base tick's snapshot (the newest one the client
+#                        acknowledged), base tick 0 means every field is sent
+import heapq
+import os
+import random
+import secrets
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from assets.code.wireProtocol import PROTOCOL_VERSION, DIRECTIONS, DIRECTION_CODES, encodeUdpOffer
+
+UDP_INPUT = 1
+UDP_SNAPSHOT = 2
+
+INPUT_REDUNDANCY = 8        # How many past inputs every input datagram repeats
+HISTORY_SIZE = 64           # Snapshots kept on each side to delta encode against
+MAX_DATAGRAM = 512
+
+INPUT_HEADER = struct.Struct("!BBQIIB")
+SNAPSHOT_HEADER = struct.Struct("!BBIIHB")
+
+# Snapshot fields in the order decodeSnapshot returns them after the tick, leaving out the events
+SNAPSHOT_FIELDS = ("ballX", "ballY", "ballXVel", "ballYVel", "leftY", "rightY",
+                   "leftMoving", "rightMoving", "lScore", "rScore", "leftAck", "rightAck")
+FIELD_FORMATS = "hhhhhhBBBBII"
+FULL_MASK = (1 << len(SNAPSHOT_FIELDS)) - 1
+
+# One struct per combination of changed fields, built the first time a mask is seen
+deltaStructs: Dict[int, struct.Struct] = {}
+
+
+def deltaStruct(mask:int) -> struct.Struct:
+    packer = deltaStructs.get(mask)
+    if packer is None:
+        fmt = "".join(FIELD_FORMATS[i] for i in range(len(SNAPSHOT_FIELDS)) if mask >> i & 1)
+        packer = deltaStructs[mask] = struct.Struct("!" + fmt)
+    return packer
+
+
+# The snapshot fields of a gameEngine.GameState and the input sequences applied for it as a tuple of ints
+def stateFields(state, leftAck:int, rightAck:int) -> Tuple[int, ...]:
+    return (state.ballX, state.ballY, state.ballXVel, state.ballYVel, state.leftY, state.rightY,
+            DIRECTION_CODES[state.leftMoving], DIRECTION_CODES[state.rightMoving], state.lScore, state.rScore,
+            leftAck, rightAck)
+
+
+def encodeInputDatagram(token:int, sequence:int, ackTick:int, directions) -> bytes:
+    codes = bytes(DIRECTION_CODES[direction] for direction in directions)
+    return INPUT_HEADER.pack(PROTOCOL_VERSION, UDP_INPUT, token, sequence, ackTick, len(codes)) + codes
+
+
+# Returns (token, sequence, ackTick, directions) or None for anything that isn't a valid input datagram
+def decodeInputDatagram(data:bytes) -> Optional[Tuple[int, int, int, List[str]]]:
+    if len(data) < INPUT_HEADER.size:
+        return None
+    version, msgType, token, sequence, ackTick, count = INPUT_HEADER.unpack_from(data)
+    codes = data[INPUT_HEADER.size:]
+    if version != PROTOCOL_VERSION or msgType != UDP_INPUT or len(codes) != count:
+        return None
+    if any(code >= len(DIRECTIONS) for code in codes):
+        return None
+    return token, sequence, ackTick, [DIRECTIONS[code] for code in codes]
+
+
+def encodeSnapshotDatagram(tick:int, fields:Tuple[int, ...], baseTick:int, base:Optional[Tuple[int, ...]],
+                           events:int) -> bytes:
+    if base is None:
+        mask = FULL_MASK
+        baseTick = 0
+    else:
+        mask = 0
+        for i in range(len(fields)):
+            if fields[i] != base[i]:
+                mask |= 1 << i
+    changed = [fields[i] for i in range(len(fields)) if mask >> i & 1]
+    return SNAPSHOT_HEADER.pack(PROTOCOL_VERSION, UDP_SNAPSHOT, tick, baseTick, mask, events) + \
+        deltaStruct(mask).pack(*changed)
+
+
+# Keeps the snapshot fields of the last HISTORY_SIZE ticks, a ring indexed by tick
+class SnapshotHistory:
+    def __init__(self) -> None:
+        self.ticks = [-1] * HISTORY_SIZE
+        self.fields: List[Optional[Tuple[int, ...]]] = [None] * HISTORY_SIZE
+
+    def put(self, tick:int, fields:Tuple[int, ...]) -> None:
+        slot = tick % HISTORY_SIZE
+        self.ticks[slot] = tick
+        self.fields[slot] = fields
+
+    def get(self, tick:int) -> Optional[Tuple[int, ...]]:
+        slot = tick % HISTORY_SIZE
+        return self.fields[slot] if self.ticks[slot] == tick else None
+
+
+# Wraps a UDP socket and drops, delays and reorders what is sent through it, for testing over loopback
+class LossShim:
+    def __init__(self, sock:socket.socket, loss:float = 0.0, latency:float = 0.0, jitter:float = 0.0,
+                 seed:Optional[int] = None) -> None:
+        self.sock = sock
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.queue = []
+        self.order = 0
+        self.wakeUp = threading.Condition()
+        if latency or jitter:
+            threading.Thread(target=self.deliver, daemon=True).start()
+
+    def __getattr__(self, name:str) -> Any:
+        return getattr(self.sock, name)
+
+    def sendto(self, data:bytes, address:Tuple[str, int]) -> int:
+        if self.random.random() < self.loss:
+            return len(data)
+        if not (self.latency or self.jitter):
+            return self.sock.sendto(data, address)
+        due = time.monotonic() + self.latency + self.random.uniform(0, self.jitter)
+        with self.wakeUp:
+            self.order += 1
+            heapq.heappush(self.queue, (due, self.order, bytes(data), address))
+            self.wakeUp.notify()
+        return len(data)
+
+    def deliver(self) -> None:
+        while True:
+            with self.wakeUp:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    self.wakeUp.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                _, _, data, address = heapq.heappop(self.queue)
+            try:
+                self.sock.sendto(data, address)
+            except OSError:
+                pass
+
+
+# Wrap sock in a LossShim when PONG_UDP_SHIM is set, e.g. PONG_UDP_SHIM="loss=0.1,latency=0.05,jitter=0.02"
+def shimFromEnv(sock:socket.socket):
+    setting = os.environ.get("PONG_UDP_SHIM")
+    if not setting:
+        return sock
+    options = {}
+    for part in setting.split(","):
+        name, _, value = part.partition("=")
+        options[name.strip()] = float(value)
+    seed = options.pop("seed", None)
+    return LossShim(sock, seed=None if seed is None else int(seed), **options)
+
+
+# What the server knows about one client playing over UDP
+class UdpPeer:
+    __slots__ = ("member", "token", "address", "ackTick")
+
+    def __init__(self, member:Any, token:int) -> None:
+        self.member = member
+        self.token = token
+        self.address = None
+        self.ackTick = 0
+
+
+# The server's side of the UDP transport, one socket shared by every room
+class UdpGameChannel:
+    def __init__(self, host:str, port:int) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        self.port = sock.getsockname()[1]
+        self.rawSock = sock
+        self.sock = shimFromEnv(sock)
+        self.peersByToken: Dict[int, UdpPeer] = {}
+        self.peersByMember: Dict[Any, UdpPeer] = {}
+
+    # Create a token for a client, returns the frame offering UDP to it over TCP
+    def offer(self, member:Any) -> bytes:
+        token = secrets.randbits(64)
+        peer = UdpPeer(member, token)
+        self.peersByToken[token] = peer
+        self.peersByMember[member] = peer
+        return encodeUdpOffer(self.port, token)
+
+    def forget(self, member:Any) -> None:
+        peer = self.peersByMember.pop(member, None)
+        if peer is not None:
+            self.peersByToken.pop(peer.token, None)
+
+    # Handle one datagram, returns (member, sequence, directions, ackTick, size) for a valid input datagram
+    # The address the datagram came from becomes where the client's snapshots are sent
+    def receive(self, data:bytes, address:Tuple[str, int]) -> Optional[Tuple[Any, int, List[str], int, int]]:
+        decoded = decodeInputDatagram(data)
+        if decoded is None:
+            return None
+        token, sequence, ackTick, directions = decoded
+        peer = self.peersByToken.get(token)
+        if peer is None:
+            return None
+        peer.address = address
+        if ackTick > peer.ackTick:
+            peer.ackTick = ackTick
+        return peer.member, sequence, directions, ackTick, len(data)
+
+    # Read datagrams forever from a thread of its own, calling handleInput with what receive returns for each
+    def serveForever(self, handleInput) -> None:
+        while True:
+            try:
+                data, address = self.rawSock.recvfrom(MAX_DATAGRAM)
+            except OSError:
+                continue
+            received = self.receive(data, address)
+            if received is not None:
+                handleInput(*received)
+
+    # Read every datagram waiting on the (non-blocking) socket
+    def receiveAll(self) -> List[Tuple[Any, int, List[str], int, int]]:
+        inputs = []
+        while True:
+            try:
+                data, address = self.rawSock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return inputs
+            except OSError:
+                # ICMP errors from a client that went away show up here on some systems
+                continue
+            received = self.receive(data, address)
+            if received is not None:
+                inputs.append(received)
+
+    # Record the room's current state so later snapshots can be encoded against it
+    def record(self, room) -> Tuple[int, ...]:
+        if room.history is None:
+            room.history = SnapshotHistory()
+        fields = stateFields(room.state, room.leftSeq, room.rightSeq)
+        room.history.put(room.state.tick, fields)
+        return fields
+
+    # Send a snapshot to member over UDP, returns the datagram's size or 0 if it hasn't sent a UDP datagram yet
+    def sendSnapshot(self, member:Any, room, fields:Tuple[int, ...], events:int) -> int:
+        peer = self.peersByMember.get(member)
+        if peer is None or peer.address is None:
+            return 0
+        base = room.history.get(peer.ackTick) if peer.ackTick else None
+        datagram = encodeSnapshotDatagram(room.state.tick, fields, peer.ackTick, base, events)
+        try:
+            self.sock.sendto(datagram, peer.address)
+        except OSError:
+            pass
+        return len(datagram)
+
+
+# The client's side of the UDP transport
+class UdpClientChannel:
+    def __init__(self, serverAddress:Tuple[str, int], token:int) -> None:
+        self.serverAddress = serverAddress
+        self.token = token
+        self.rawSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rawSock.setblocking(False)
+        self.sock = shimFromEnv(self.rawSock)
+        self.sequence = 0
+        self.recent = deque(maxlen=INPUT_REDUNDANCY)
+        self.history = SnapshotHistory()
+        self.ackTick = 0
+
+    # Send the paddle direction for this frame along with the last few directions sent before it
+    # The next sequence number is used unless the caller numbers its inputs itself
+    def sendInput(self, direction:str, sequence:Optional[int] = None) -> None:
+        self.sequence = self.sequence + 1 if sequence is None else sequence
+        self.recent.append(direction)
+        datagram = encodeInputDatagram(self.token, self.sequence, self.ackTick, self.recent)
+        try:
+            self.sock.sendto(datagram, self.serverAddress)
+        except OSError:
+            pass
+
+    # Decode one snapshot datagram, returns the same tuple as wireProtocol.decodeSnapshot or None when it is
+    # older than what the client has or its base snapshot is no longer known
+    def decodeSnapshot(self, data:bytes) -> Optional[Tuple]:
+        if len(data) < SNAPSHOT_HEADER.size:
+            return None
+        version, msgType, tick, baseTick, mask, events = SNAPSHOT_HEADER.unpack_from(data)
+        if version != PROTOCOL_VERSION or msgType != UDP_SNAPSHOT or tick <= self.ackTick or mask > FULL_MASK:
+            return None
+        if baseTick:
+            base = self.history.get(baseTick)
+            if base is None:
+                return None
+            fields = list(base)
+        else:
+            if mask != FULL_MASK:
+                return None
+            fields = [0] * len(SNAPSHOT_FIELDS)
+        packer = deltaStruct(mask)
+        if len(data) != SNAPSHOT_HEADER.size + packer.size:
+            return None
+        values = iter(packer.unpack_from(data, SNAPSHOT_HEADER.size))
+        for i in range(len(fields)):
+            if mask >> i & 1:
+                fields[i] = next(values)
+        if fields[6] >= len(DIRECTIONS) or fields[7] >= len(DIRECTIONS):
+            return None
+        fields = tuple(fields)
+        self.history.put(tick, fields)
+        self.ackTick = tick
+        return (tick,) + fields[:6] + (DIRECTIONS[fields[6]], DIRECTIONS[fields[7]]) + fields[8:10] + (events,) + \
+            fields[10:]
+
+    # Read every waiting datagram, returns the newest snapshot and the event flags of all of them
+    # Waits up to timeout seconds for the first datagram
+    def poll(self, timeout:float = 0.0) -> Tuple[Optional[Tuple], int]:
+        snapshot = None
+        events = 0
+        self.rawSock.settimeout(max(timeout, 0.0))
+        while True:
+            try:
+                data = self.rawSock.recv(MAX_DATAGRAM)
+            except OSError:
+                # Covers the timeout, nothing left to read, and ICMP errors while the server is unreachable
+                break
+            self.rawSock.setblocking(False)
+            decoded = self.decodeSnapshot(data)
+            if decoded is not None:
+                snapshot = decoded
+                events |= decoded[11]
+        self.rawSock.setblocking(False)
+        return snapshot, events
+
+    def close(self) -> None:
+        self.rawSock.close()
@@ -0,0 +1,177 @@
+# This file holds the binary wire protocol shared by pongClient.py and pongServer.py
+# Every message on the socket is a frame: a fixed header followed by a fixed layout body
+#
+#   header  = body length (uint16), protocol version (uint8), message type (uint8)
+#   body    = packed with struct in network byte order, layout decided by the message type
+#
+# Because TCP is a byte stream, a single recv can hold half a frame or several frames glued
+# together, so both ends push whatever they read through a FrameDecoder which hands back
+# only complete frames.
+#
+# A connection starts with one HELLO from the server (screen size, side and session id) answered by
+# one READY from the client, so joining takes a single round trip. The protocol version is in every
+# header, a client built for another version fails on the HELLO instead of misreading the game.
+# A client that lost its connection mid match answers the HELLO of its new connection with RESUME and
+# the session id of the old one instead, and the server puts it back into its match.
+import struct
+from typing import List, Optional, Tuple
+
+PROTOCOL_VERSION = 5
+
+# Message types
+MSG_START = 1       # Server -> client, both players are ready
+MSG_HELLO = 2       # Server -> client, the first message on a connection, everything the client needs to join
+MSG_INPUT = 3       # Client -> server, the direction the player's paddle is moving
+MSG_SNAPSHOT = 4    # Server -> client, the authoritative state of the game after a tick
+MSG_UDP_OFFER = 5   # Server -> client, the port and token to use for playing over UDP (see udpTransport)
+MSG_READY = 6       # Client -> server, the answer to HELLO, the client is waiting for its match to start
+MSG_RESUME = 7      # Client -> server, the answer to HELLO of a client reconnecting to its match
+
+HEADER = struct.Struct("!HBB")
+
+START_FRAME = HEADER
+# screen width, screen height, side, session id
+HELLO_FRAME = struct.Struct("!HBB" + "HHBQ")
+# room to watch for a spectator, 0 for the newest match (players send 0)
+READY_FRAME = struct.Struct("!HBB" + "I")
+# session id from the HELLO of the lost connection
+RESUME_FRAME = struct.Struct("!HBB" + "Q")
+# direction, input sequence number
+INPUT_FRAME = struct.Struct("!HBB" + "BI")
+# tick, ball x, ball y, ball x vel, ball y vel, left paddle y, right paddle y,
+# left moving, right moving, left score, right score, event flags,
+# newest input sequence applied for the left player, the same for the right player
+SNAPSHOT_FRAME = struct.Struct("!HBB" + "IhhhhhhBBBBBII")
+# udp port, session token
+UDP_OFFER_FRAME = struct.Struct("!HBB" + "HQ")
+
+# Expected body size of each message type, anything else is rejected by the decoder
+BODY_SIZES = {
+    MSG_START: START_FRAME.size - HEADER.size,
+    MSG_HELLO: HELLO_FRAME.size - HEADER.size,
+    MSG_READY: READY_FRAME.size - HEADER.size,
+    MSG_RESUME: RESUME_FRAME.size - HEADER.size,
+    MSG_INPUT: INPUT_FRAME.size - HEADER.size,
+    MSG_SNAPSHOT: SNAPSHOT_FRAME.size - HEADER.size,
+    MSG_UDP_OFFER: UDP_OFFER_FRAME.size - HEADER.size,
+}
+
+SIDES = ("left", "right", "spectator")
+SIDE_CODES = {"left": 0, "right": 1, "spectator": 2}
+DIRECTIONS = ("", "up", "down")
+DIRECTION_CODES = {"": 0, "up": 1, "down": 2}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def frameType(frame:bytes) -> int:
+    return frame[3]
+
+
+def encodeStart() -> bytes:
+    return START_FRAME.pack(BODY_SIZES[MSG_START], PROTOCOL_VERSION, MSG_START)
+
+
+def encodeHello(screenWidth:int, screenHeight:int, side:str, sessionId:int) -> bytes:
+    return HELLO_FRAME.pack(BODY_SIZES[MSG_HELLO], PROTOCOL_VERSION, MSG_HELLO, screenWidth, screenHeight,
+                            SIDE_CODES[side], sessionId)
+
+
+# Returns (screenWidth, screenHeight, side, sessionId)
+def decodeHello(frame:bytes) -> Tuple[int, int, str, int]:
+    _, _, _, screenWidth, screenHeight, side, sessionId = HELLO_FRAME.unpack_from(frame)
+    if side >= len(SIDES):
+        raise ProtocolError(f"Bad side {side}")
+    return screenWidth, screenHeight, SIDES[side], sessionId
+
+
+def encodeReady(roomId:int = 0) -> bytes:
+    return READY_FRAME.pack(BODY_SIZES[MSG_READY], PROTOCOL_VERSION, MSG_READY, roomId)
+
+
+# Returns the room a spectator asked to watch, None for the newest match
+def decodeReady(frame:bytes) -> Optional[int]:
+    return READY_FRAME.unpack_from(frame)[3] or None
+
+
+def encodeResume(sessionId:int) -> bytes:
+    return RESUME_FRAME.pack(BODY_SIZES[MSG_RESUME], PROTOCOL_VERSION, MSG_RESUME, sessionId)
+
+
+def decodeResume(frame:bytes) -> int:
+    return RESUME_FRAME.unpack_from(frame)[3]
+
+
+def encodeInput(direction:str, sequence:int) -> bytes:
+    return INPUT_FRAME.pack(BODY_SIZES[MSG_INPUT], PROTOCOL_VERSION, MSG_INPUT,
+                            DIRECTION_CODES[direction], sequence)
+
+
+# Returns (direction, sequence)
+def decodeInput(frame:bytes) -> Tuple[str, int]:
+    _, _, _, direction, sequence = INPUT_FRAME.unpack_from(frame)
+    if direction >= len(DIRECTIONS):
+        raise ProtocolError(f"Bad direction {direction}")
+    return DIRECTIONS[direction], sequence
+
+
+# state is a gameEngine.GameState, events the EVENT_ flags gathered since the last snapshot and
+# leftAck/rightAck the newest input sequence applied for each player, used by clients to predict
+def encodeSnapshot(state, events:int, leftAck:int, rightAck:int) -> bytes:
+    return SNAPSHOT_FRAME.pack(BODY_SIZES[MSG_SNAPSHOT], PROTOCOL_VERSION, MSG_SNAPSHOT,
+                               state.tick, state.ballX, state.ballY, state.ballXVel, state.ballYVel,
+                               state.leftY, state.rightY, DIRECTION_CODES[state.leftMoving],
+                               DIRECTION_CODES[state.rightMoving], state.lScore, state.rScore, events,
+                               leftAck, rightAck)
+
+
+# Returns (tick, ballX, ballY, ballXVel, ballYVel, leftY, rightY, leftMoving, rightMoving, lScore, rScore, events,
+#          leftAck, rightAck)
+def decodeSnapshot(frame:bytes) -> Tuple:
+    fields = SNAPSHOT_FRAME.unpack_from(frame)
+    if fields[10] >= len(DIRECTIONS) or fields[11] >= len(DIRECTIONS):
+        raise ProtocolError("Bad paddle direction in snapshot")
+    return fields[3:10] + (DIRECTIONS[fields[10]], DIRECTIONS[fields[11]]) + fields[12:]
+
+
+
+def encodeUdpOffer(port:int, token:int) -> bytes:
+    return UDP_OFFER_FRAME.pack(BODY_SIZES[MSG_UDP_OFFER], PROTOCOL_VERSION, MSG_UDP_OFFER, port, token)
+
+
+# Returns (port, token)
+def decodeUdpOffer(frame:bytes) -> Tuple[int, int]:
+    return UDP_OFFER_FRAME.unpack_from(frame)[3:]
+
+
+class FrameDecoder:
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    # Add newly received bytes and return every complete frame (header included) now available
+    def feed(self, data:bytes) -> List[bytes]:
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        end = len(buffer)
+        view = memoryview(buffer)
+        try:
+            while end - offset >= HEADER.size:
+                length, version, msgType = HEADER.unpack_from(view, offset)
+                if version != PROTOCOL_VERSION:
+                    raise ProtocolError(f"Unsupported protocol version {version}")
+                if BODY_SIZES.get(msgType) != length:
+                    raise ProtocolError(f"Bad frame, type {msgType} length {length}")
+                frameEnd = offset + HEADER.size + length
+                if frameEnd > end:
+                    break
+                frames.append(bytes(view[offset:frameEnd]))
+                offset = frameEnd
+        finally:
+            view.release()
+        if offset:
+            del buffer[:offset]
+        return frames
@@ -0,0 +1,302 @@
+# =================================================================================================
+# Purpose: This program times the code that runs every frame or every tick: the ball rules in
+#          helperCode.py and gameEngine.py, the wire protocol and the server's input to snapshot
+#          relay over loopback socket pairs. Results can be saved as a JSON baseline and later runs
+#          compared against it, failing when anything got slower than the threshold allows.
+#
+# Example: python pongBenchmark.py --save benchmarks.json        (record a baseline)
+#          python pongBenchmark.py --compare benchmarks.json     (exit code 1 on a regression)
+# =================================================================================================
+
+import argparse
+import gc
+import json
+import platform
+import socket
+import statistics
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from assets.code.wireProtocol import FrameDecoder, encodeInput, decodeInput, encodeSnapshot, decodeSnapshot
+from assets.code.gameEngine import GameEngine, PADDLE_HEIGHT, EVENT_BOUNCE
+from assets.code.udpTransport import UdpClientChannel, encodeSnapshotDatagram, stateFields
+
+SCREEN_WIDTH = 640
+SCREEN_HEIGHT = 480
+REPEATS = 50                # Timed runs per benchmark, the best one is compared against the baseline
+TARGET_SECONDS = 0.02       # Each timed run is made about this long
+DEFAULT_THRESHOLD = 0.3     # Slower than the baseline by more than this fraction is a regression, above the
+                            # run to run spread of the best runs on a shared machine
+
+# name -> function that does the setup and returns (run, opsPerCall), run() doing opsPerCall operations
+benchmarks: Dict[str, Callable[[], Tuple[Callable[[], None], int]]] = {}
+
+
+def benchmark(name:str):
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+
+# A game where both paddles follow the ball, so it bounces off everything instead of just scoring
+def follow(paddleY:int, ballY:int) -> str:
+    center = paddleY + PADDLE_HEIGHT//2
+    return "up" if ballY < center - 5 else "down" if ballY > center + 5 else ""
+
+
+def trackingInputs(state) -> None:
+    state.leftMoving = follow(state.leftY, state.ballY)
+    state.rightMoving = follow(state.rightY, state.ballY)
+
+
+# The per frame ball rules playGame used to run on helperCode's Ball, Paddle and pygame.Rect
+@benchmark("helperCode.ballFrame")
+def ballFrame():
+    import pygame
+    from assets.code.helperCode import Ball, Paddle
+    ball = Ball(pygame.Rect(SCREEN_WIDTH/2, SCREEN_HEIGHT/2, 5, 5), -5, 3)
+    leftPaddle = Paddle(pygame.Rect(10, 215, 10, 50))
+    rightPaddle = Paddle(pygame.Rect(SCREEN_WIDTH-20, 215, 10, 50))
+    topWall = pygame.Rect(-10, 0, SCREEN_WIDTH+20, 10)
+    bottomWall = pygame.Rect(-10, SCREEN_HEIGHT-10, SCREEN_WIDTH+20, 10)
+
+    def run() -> None:
+        for _ in range(100):
+            ball.updatePos()
+            if ball.rect.x > SCREEN_WIDTH:
+                ball.reset(nowGoing="left")
+            elif ball.rect.x < 0:
+                ball.reset(nowGoing="right")
+            if ball.rect.colliderect(leftPaddle.rect):
+                ball.hitPaddle(leftPaddle.rect.center[1])
+            elif ball.rect.colliderect(rightPaddle.rect):
+                ball.hitPaddle(rightPaddle.rect.center[1])
+            if ball.rect.colliderect(topWall) or ball.rect.colliderect(bottomWall):
+                ball.hitWall()
+    return run, 100
+
+
+@benchmark("gameEngine.step")
+def engineStep():
+    engine = GameEngine(SCREEN_WIDTH, SCREEN_HEIGHT)
+    state = engine.newState()
+
+    def run() -> None:
+        for _ in range(100):
+            trackingInputs(state)
+            engine.step(state)
+            if engine.isOver(state):
+                state.lScore = state.rScore = 0
+    return run, 100
+
+
+# Per game cost of stepping 1024 games at once
+@benchmark("batchSimulator.step")
+def batchStep():
+    from assets.code.batchSimulator import BatchSimulator
+    batch = BatchSimulator(1024, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+    def run() -> None:
+        batch.step()
+        batch.reset(batch.isOver())
+    return run, 1024
+
+
+@benchmark("wireProtocol.snapshot")
+def snapshotCodec():
+    engine = GameEngine(SCREEN_WIDTH, SCREEN_HEIGHT)
+    state = engine.newState()
+
+    def run() -> None:
+        for _ in range(100):
+            decodeSnapshot(encodeSnapshot(state, EVENT_BOUNCE, 10, 12))
+    return run, 100
+
+
+@benchmark("wireProtocol.input")
+def inputCodec():
+    def run() -> None:
+        for sequence in range(100):
+            decodeInput(encodeInput("up", sequence))
+    return run, 100
+
+
+# One second of a client's inputs arriving in a single read, split into frames
+@benchmark("wireProtocol.frameDecoder")
+def frameDecoder():
+    decoder = FrameDecoder()
+    data = b"".join(encodeInput("down", sequence) for sequence in range(60))
+
+    def run() -> None:
+        decoder.feed(data)
+    return run, 60
+
+
+@benchmark("udpTransport.snapshotDelta")
+def snapshotDelta():
+    engine = GameEngine(SCREEN_WIDTH, SCREEN_HEIGHT)
+    state = engine.newState()
+    channel = UdpClientChannel(("127.0.0.1", 9), 0)
+    channel.rawSock.close()
+
+    def run() -> None:
+        channel.ackTick = 0
+        base = stateFields(state, 0, 0)
+        channel.decodeSnapshot(encodeSnapshotDatagram(1, base, 0, None, 0))
+        for tick in range(2, 101):
+            engine.step(state)
+            fields = stateFields(state, tick, tick)
+            channel.decodeSnapshot(encodeSnapshotDatagram(tick, fields, tick - 1, base, 0))
+            base = fields
+        state.tick = 0
+    return run, 100
+
+
+# A client input crossing a socket pair into ThreadedServer.HandleFrameData, then the room's snapshot crossing
+# a second socket pair back out to the client, what the server does for every frame of every client
+# The server is built bare, with only what HandleFrameData uses, so no UDP or spectator threads run alongside
+@benchmark("pongServer.relay")
+def serverRelay():
+    import pongServer
+    server = object.__new__(pongServer.ThreadedServer)
+    server.registry = pongServer.RoomRegistry()
+    server.registry_lock = threading.Lock()
+    server.metrics = pongServer.ServerMetrics()
+    leftClient, leftServer = socket.socketpair()
+    rightClient, rightServer = socket.socketpair()
+    for member in (leftServer, rightServer):
+        server.registry.join(member)
+        server.registry.markReady(member)
+    room = server.registry.roomOf(leftServer)
+    room.state = pongServer.engine.newState()
+    decoder = FrameDecoder()
+    clientDecoder = FrameDecoder()
+    sequence = [0]
+
+    def run() -> None:
+        for _ in range(100):
+            sequence[0] += 1
+            leftClient.sendall(encodeInput("up" if sequence[0] & 32 else "down", sequence[0]))
+            frames = decoder.feed(leftServer.recv(4096))
+            server.HandleFrameData(frames, leftServer)
+            pongServer.engine.step(room.state)
+            rightServer.sendall(encodeSnapshot(room.state, 0, room.leftSeq, room.rightSeq))
+            for frame in clientDecoder.feed(rightClient.recv(4096)):
+                decodeSnapshot(frame)
+    return run, 100
+
+
+# Seconds one run of calls calls takes, with the garbage collector off like timeit does so a collection
+# started by some earlier garbage isn't charged to whichever run it lands in
+def timeCalls(run:Callable[[], None], calls:int) -> float:
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        return time.perf_counter() - start
+    finally:
+        if enabled:
+            gc.enable()
+
+
+#==================================================================================================================
+# Purpose: The purpose of this function is to time the given benchmarks. The timed runs take turns, one run of
+#          each benchmark per round, so a stretch where the machine is busy with something else slows a run of
+#          every benchmark instead of all the runs of one
+# Preconditions: Every setup returns the function to time and how many operations one call of it does
+# Postconditions: Returns the median and best nanoseconds per operation over REPEATS timed runs of each
+#                 benchmark, and the benchmarks that couldn't run with the reason why
+#==================================================================================================================
+def measure(setups:Dict[str, Callable[[], Tuple[Callable[[], None], int]]]) -> Tuple[Dict[str, dict], Dict[str, str]]:
+    runs = {}
+    skipped = {}
+    for name, setup in setups.items():
+        try:
+            run, opsPerCall = setup()
+        except ImportError as e:
+            # pygame and numpy are only needed by the benchmarks that use them
+            skipped[name] = str(e)
+            continue
+        run()   # Warm up caches and lazily built structs
+
+        # Make each timed run about TARGET_SECONDS long
+        calls = 1
+        while True:
+            elapsed = timeCalls(run, calls)
+            if elapsed >= TARGET_SECONDS/4:
+                break
+            calls *= 2
+        runs[name] = (run, opsPerCall, max(1, int(calls*TARGET_SECONDS/elapsed)))
+
+    samples = {name: [] for name in runs}
+    for _ in range(REPEATS):
+        for name, (run, opsPerCall, calls) in runs.items():
+            samples[name].append(timeCalls(run, calls)/(calls*opsPerCall)*1e9)
+    results = {}
+    for name, (run, opsPerCall, calls) in runs.items():
+        results[name] = {"nsPerOp": round(statistics.median(samples[name]), 2),
+                         "bestNsPerOp": round(min(samples[name]), 2), "ops": calls*opsPerCall}
+    return results, skipped
+
+
+# Returns the benchmarks that are slower than the baseline by more than threshold, as (name, ratio)
+# The best runs are compared, the median moves with whatever else the machine is doing but the best run
+# only gets slower when the code does
+def compare(results:Dict[str, dict], baseline:Dict[str, dict], threshold:float) -> List[Tuple[str, float]]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        # Baselines saved before bestNsPerOp was recorded only have the median
+        base = baseline[name].get("bestNsPerOp", baseline[name]["nsPerOp"])
+        ratio = result["bestNsPerOp"]/base
+        result["baselineBestNsPerOp"] = base
+        result["ratio"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the pong hot paths and compare them against a baseline")
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose name starts with one of these")
+    parser.add_argument("--save", metavar="FILE", help="write the results as the new baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a baseline written by --save")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown as a fraction, 0.3 fails anything more than 30%% slower")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON instead of a table")
+    args = parser.parse_args()
+
+    results, skipped = measure({name: setup for name, setup in benchmarks.items()
+                                if not args.names or name.startswith(tuple(args.names))})
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+
+    report = {"python": platform.python_version(), "machine": platform.machine(), "results": results,
+              "skipped": skipped}
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name, result in results.items():
+            line = f"{name:<30}{result['bestNsPerOp']:>12.1f} ns/op best{result['nsPerOp']:>12.1f} median"
+            if "ratio" in result:
+                line += f"{result['ratio']:>9.2f}x baseline"
+            print(line)
+        for name, reason in skipped.items():
+            print(f"{name:<30}     skipped ({reason})")
+    if args.save:
+        with open(args.save, "w") as file:
+            file.write(json.dumps(report, indent=2) + "\n")
+
+    for name, ratio in regressions:
+        print(f"REGRESSION {name}: {ratio:.2f}x the baseline (threshold {1 + args.threshold:.2f}x)", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
@@ -11,35 +11,54 @@ import pygame
 import tkinter as tk
 import sys
 import socket
-import pickle
+import atexit
 import threading
 import time
 
 from assets.code.helperCode import *
+from assets.code.wireProtocol import (FrameDecoder, ProtocolError, decodeHello, encodeReady, decodeUdpOffer, frameType,
+                                      MSG_HELLO, MSG_START, MSG_UDP_OFFER)
+from assets.code.gameEngine import GameEngine, TickScheduler, EVENT_BOUNCE, EVENT_POINT, TICK_RATE
+from assets.code.udpTransport import UdpClientChannel
+from assets.code.netcode import InputPredictor, SnapshotInterpolator, blend
+from assets.code.clientNetwork import NetworkClient
+from assets.code.renderer import Renderer, displayRefreshRate
+from assets.code.spectators import SPECTATOR_PORT_OFFSET
+from assets.code.rollback import RollbackSession
+from assets.code.assetBundle import AssetBundle, loadBundle, startMixer
+from assets.code.frameProfiler import profilerFromEnv, HUD_POSITION
+
+# Steps the client runs in one frame to catch up after a slow one, a quarter of a second at 60 ticks per second
+MAX_CATCH_UP = 15
 
 # This is the main game loop.
-def playGame(screenWidth:int, screenHeight:int, playerPaddle:str, client:socket.socket) -> None:
+def playGame(screenWidth:int, screenHeight:int, playerPaddle:str, client:socket.socket, decoder:FrameDecoder,
+             udpOffer:tuple = None, useRollback:bool = False, sessionId:int = None,
+             assets:AssetBundle = None) -> None:
     
-    # Pygame inits
-    pygame.mixer.pre_init(44100, -16, 2, 2048)
-    pygame.init()
+    # Pygame inits, only the display, the mixer opens in the background and sounds play once it is open
+    pygame.display.init()
+    startMixer()
+    if assets is None:
+        assets = loadBundle()
 
     # Constants
     WHITE = (255,255,255)
     clock = pygame.time.Clock()
-    scoreFont = pygame.font.Font("./assets/fonts/pong-score.ttf", 32)
-    winFont = pygame.font.Font("./assets/fonts/visitor.ttf", 48)
-    pointSound = pygame.mixer.Sound("./assets/sounds/point.wav")
-    bounceSound = pygame.mixer.Sound("./assets/sounds/bounce.wav")
+    # Pre-rendered glyphs and pre-decoded sounds from the asset bundle, see assetBundle.py
+    scoreFont = assets.font("score")
+    winFont = assets.font("win")
+    pointSound = assets.sound("point")
+    bounceSound = assets.sound("bounce")
 
-    # Display objects
+    # Display objects, the walls and center line are drawn once by the renderer's background
     screen = pygame.display.set_mode((screenWidth, screenHeight))
-    winMessage = pygame.Rect(0,0,0,0)
-    topWall = pygame.Rect(-10,0,screenWidth+20, 10)
-    bottomWall = pygame.Rect(-10, screenHeight-10, screenWidth+20, 10)
-    centerLine = []
-    for i in range(0, screenHeight, 10):
-        centerLine.append(pygame.Rect((screenWidth/2)-5,i,5,5))
+    # Set PONG_PROFILE to time every phase of every frame, see frameProfiler.py, F3 shows the timings
+    profiler = profilerFromEnv()
+    if profiler is not None:
+        # The game ends with sys.exit or by returning to a window that closes, the trace is written either way
+        atexit.register(profiler.dump)
+    renderer = Renderer(screen, scoreFont, WHITE, profiler)
 
     # Paddle properties and init
     paddleHeight = 50
@@ -50,6 +69,8 @@ def playGame(screenWidth:int, screenHeight:int, playerPaddle:str, client:socket.
 
     ball = Ball(pygame.Rect(screenWidth/2, screenHeight/2, 5, 5), -5, 0)
 
+    # A spectator doesn't play, both paddles are drawn from the snapshots like the opponent's normally is
+    spectating = playerPaddle == "spectator"
     if playerPaddle == "left":
         opponentPaddleObj = rightPaddle
         playerPaddleObj = leftPaddle
@@ -60,15 +81,45 @@ def playGame(screenWidth:int, screenHeight:int, playerPaddle:str, client:socket.
     lScore = 0
     rScore = 0
 
-    sync = 0
+    # The input of every frame is sent with the next sequence number and moves the player's paddle right
+    # away, the ball and opponent are drawn from snapshots interpolated a few ticks in the past
+    engine = GameEngine(screenWidth, screenHeight)
+    predictor = InputPredictor(engine, playerPaddleObj.rect.y)
+    interpolator = SnapshotInterpolator()
+    # In rollback mode the client runs the whole game ahead of the server instead, see rollback.py
+    rollback = RollbackSession(engine, playerPaddle) if useRollback and not spectating else None
+    lastTick = 0
+
+    # The game steps at the server's tick rate however often frames are drawn, each step sends one input.
+    # Frames are drawn at the display's refresh rate, between where the step before and the last step put
+    # things, and a slow frame is made up for with more steps in the next one instead of slowing the game
+    scheduler = TickScheduler(TICK_RATE, MAX_CATCH_UP)
+    scheduler.start()
+    refreshRate = displayRefreshRate()
+    previousY = currentY = playerPaddleObj.rect.y
+    if rollback is not None:
+        predicted = rollback.state
+        previousState = currentState = (predicted.ballX, predicted.ballY, predicted.leftY, predicted.rightY)
+
+    # When the server offered UDP and the user asked for it, inputs and snapshots go over UDP while the
+    # TCP connection stays open so the server knows the client is still there
+    udp = None
+    if udpOffer is not None:
+        udp = UdpClientChannel((client.getpeername()[0], udpOffer[0]), udpOffer[1])
+
+    # Sockets are read and written by background threads, the loop below never waits on the network
+    # Players reconnect by themselves with their session id when the connection drops
+    network = NetworkClient(client, decoder, udp, None if playerPaddle == "spectator" else sessionId)
+    network.start()
 
     while True:
-        # Wiping the screen
-        screen.fill((0,0,0))
+        if profiler is not None:
+            profiler.begin()
 
         # Getting keypress events
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                network.stop()
                 pygame.quit()
                 sys.exit()
             elif event.type == pygame.KEYDOWN:
@@ -78,88 +129,100 @@ def playGame(screenWidth:int, screenHeight:int, playerPaddle:str, client:socket.
                 elif event.key == pygame.K_UP:
                     playerPaddleObj.moving = "up"
 
+                elif event.key == pygame.K_F3 and profiler is not None:
+                    profiler.showHud = not profiler.showHud
+
             elif event.type == pygame.KEYUP:
                 playerPaddleObj.moving = ""
+        if profiler is not None:
+            profiler.mark("events")
 
         # =======================================================================================================
-        #Purpose: The Purpose of this section of code is to take the users inputs and send them to the server
-        #         Then it takes the data of the other client from the server and decodes it
-        #         It then takes this data and uses it to update the game state. It also compares
-        #         The sync values of itself and the other client, and if it has lagged behind it uses
-        #         The other clients data to update the game
-        #Preconditions: The section of code expects the client to beconnected to the server and and
-        #               for the another client to be connected to the server and running the play game function       
-        #Postconditions: After this section of code is run the score, opponents paddle movement and the sync num
-        #                are updated, and if the client is out of sync, the ball pos and movement, the users score
-        #                paddle position, and sync num are updated to catch up to the other client.
-        #=========================================================================================================       
-        
-        # Determine which score to send based on the client's paddle side
-        if playerPaddle == "left":
-            # scoreTemp is the User's score needing to be sent to the opponent, 
-            # and altScore is the Opponent's score being sent to verify the opponent isn't behind
-            scoreTemp = lScore
-            altScore = rScore
-        else:
-            scoreTemp = rScore
-            altScore = lScore
-
-        # Store the direction the paddle is moving as a variable to send
-        direction = playerPaddleObj.moving
+        #Purpose: The Purpose of this section of code is to queue the direction the user's paddle is moving for the
+        #         server, then take the newest snapshot of the game the network threads received and use it to
+        #         update the ball, both paddles and the score. The server runs the game for both clients so the
+        #         two can't drift apart
+        #Preconditions: The section of code expects the client to be connected to the server and the server to
+        #               have started the game for this client's room
+        #Postconditions: After this section of code is run the ball, paddles and score match the server's latest
+        #                tick, and the sounds for anything that happened since the last snapshot have been played
+        #=========================================================================================================
+
+        # Send the direction the paddle is moving and predict where it takes the paddle, once for every step due
+        if not spectating:
+            for _ in range(scheduler.due(time.monotonic())):
+                direction = playerPaddleObj.moving
+                sequence = network.sendInput(direction)
+                if rollback is not None:
+                    predicted = rollback.advance(sequence, direction)
+                    previousState = currentState
+                    currentState = (predicted.ballX, predicted.ballY, predicted.leftY, predicted.rightY)
+                else:
+                    previousY, currentY = currentY, predictor.record(sequence, direction)
+        if profiler is not None:
+            profiler.mark("simulate")
         
-        # Create a list including all data necessary for the opponenet client to receive
-        data_list = [playerPaddle, direction, scoreTemp, sync, opponentPaddleObj, ball, altScore]
-
-        # Put the list in Pickled format and send it to the server
-        encoded_list = pickle.dumps(data_list)
+        # Take whatever arrived since the last frame, this never blocks
+        snapshot, receivedAt, events, connected = network.take()
+        if profiler is not None:
+            profiler.mark("network")
+
+        if snapshot is not None and snapshot[0] > lastTick:
+            lastTick = snapshot[0]
+            interpolator.push(snapshot, receivedAt)
+            (_, _, _, ball.xVel, ball.yVel, leftY, rightY, leftMoving, rightMoving, lScore, rScore, _,
+             leftAck, rightAck) = snapshot
+            # Correct the prediction with the server's position and replay what it hasn't applied yet
+            # A correction moves both steps the frame is drawn between, so it shows up at once without a jump back
+            if rollback is not None:
+                if rollback.confirm(snapshot):
+                    predicted = rollback.state
+                    previousState = currentState = (predicted.ballX, predicted.ballY, predicted.leftY, predicted.rightY)
+            elif playerPaddle == "left":
+                corrected = predictor.reconcile(leftY, leftAck)
+                previousY, currentY = previousY + corrected - currentY, corrected
+                opponentPaddleObj.moving = rightMoving
+            elif playerPaddle == "right":
+                corrected = predictor.reconcile(rightY, rightAck)
+                previousY, currentY = previousY + corrected - currentY, corrected
+                opponentPaddleObj.moving = leftMoving
+
+            if events & EVENT_POINT:
+                pointSound.play()
+            if events & EVENT_BOUNCE:
+                bounceSound.play()
+        if profiler is not None:
+            profiler.mark("reconcile")
 
-        client.send(encoded_list)
-        
-        try: 
-            # Try to receive data from server
-            rec_list = client.recv(1024)
-        except:
-            print("Error receiving data.")
-        else:
-            # Check if the data received isn't empty
-            if len(rec_list) > 0:
-                # Load data
-                opp_list = pickle.loads(rec_list)
-
-                if opp_list[0] == "left" or "right":
-                    # Update the direction in which the opponent paddle is moving
-                    opponentPaddleObj.moving = opp_list[1]
-
-                    # Update the opponent score based on what it sends
-                    if playerPaddle == "left":
-                        rScore = opp_list[2]
-                    else:
-                        lScore = opp_list[2]
-                else: 
-                    break
-                
-                # Check if the client's are out of sync
-                if opp_list[3] > sync:
-                    # If they are, manually update each variable to match the client that is ahead
-                    if playerPaddle == "left":
-                        lScore == opp_list[6]
-                    else:
-                        rScore = opp_list[6]
-                    playerPaddleObj = opp_list[4]
-                    ball = opp_list[5]
-                    sync = opp_list[3]
+        # Spectators are disconnected right after the last snapshot of a match, that one still shows who won
+        if not connected and lScore <= 4 and rScore <= 4:
+            # The server closed the connection, the opponent left or the server went down
+            print("Lost connection to the server.")
+            network.stop()
+            pygame.quit()
+            return
 
 
       ## =========================================================================================
 
-        # Update the player paddle and opponent paddle's location on the screen
-        for paddle in [playerPaddleObj, opponentPaddleObj]:
-            if paddle.moving == "down":
-                if paddle.rect.bottomleft[1] < screenHeight-10:
-                    paddle.rect.y += paddle.speed
-            elif paddle.moving == "up":
-                if paddle.rect.topleft[1] > 10:
-                    paddle.rect.y -= paddle.speed
+        # Place the ball and the opponent's paddle where they were a few ticks ago, or where the rollback
+        # prediction has them now, and the player's paddle between its last two predicted steps
+        now = time.monotonic()
+        sample = interpolator.sample(now)
+        alpha = scheduler.alpha(now)
+        if rollback is not None:
+            ball.rect.x, ball.rect.y, leftPaddle.rect.y, rightPaddle.rect.y = blend(previousState, currentState, alpha)
+        else:
+            if not spectating:
+                playerPaddleObj.rect.y = round(previousY + (currentY - previousY)*alpha)
+            if sample is not None:
+                ball.rect.x, ball.rect.y, leftY, rightY = sample
+                if spectating:
+                    leftPaddle.rect.y, rightPaddle.rect.y = leftY, rightY
+                else:
+                    opponentPaddleObj.rect.y = rightY if playerPaddle == "left" else leftY
+        if profiler is not None:
+            profiler.mark("interpolate")
 
         # If the game is over, display the win message
         if lScore > 4 or rScore > 4:
@@ -167,8 +230,12 @@ def playGame(screenWidth:int, screenHeight:int, playerPaddle:str, client:socket.
             textSurface = winFont.render(winText, False, WHITE, (0,0,0))
             textRect = textSurface.get_rect()
             textRect.center = ((screenWidth/2), screenHeight/2)
-            winMessage = screen.blit(textSurface, textRect)
+            screen.blit(textSurface, textRect)
+            if profiler is not None:
+                profiler.mark("draw")
             pygame.display.flip()  # Update the display to show the message
+            if profiler is not None:
+                profiler.mark("present")
 
             time.sleep(3) # Show the win message for 3 seconds
 
@@ -176,66 +243,34 @@ def playGame(screenWidth:int, screenHeight:int, playerPaddle:str, client:socket.
             for i in range(5, 0, -1):
                 print("Game will end in: ", i)
                 time.sleep(1)
+            if profiler is not None:
+                profiler.mark("gameOver")
             sys.exit()
-        else:
-
-            # ==== Ball Logic =====================================================================
-            ball.updatePos()
 
-            # If the ball makes it past the edge of the screen, update score, etc.
-            if ball.rect.x > screenWidth:
-                lScore += 1
-                pointSound.play()
-                ball.reset(nowGoing="left")
-            elif ball.rect.x < 0:
-                rScore += 1
-                pointSound.play()
-                ball.reset(nowGoing="right")
-                
-            # If the ball hits a paddle
-            if ball.rect.colliderect(playerPaddleObj.rect):
-                bounceSound.play()
-                ball.hitPaddle(playerPaddleObj.rect.center[1])
-            elif ball.rect.colliderect(opponentPaddleObj.rect):
-                bounceSound.play()
-                ball.hitPaddle(opponentPaddleObj.rect.center[1])
-                
-            # If the ball hits a wall
-            if ball.rect.colliderect(topWall) or ball.rect.colliderect(bottomWall):
-                bounceSound.play()
-                ball.hitWall()
-            
-            pygame.draw.rect(screen, WHITE, ball)
-            # ==== End Ball Logic =================================================================
-
-        # Drawing the dotted line in the center
-        for i in centerLine:
-            pygame.draw.rect(screen, WHITE, i)
-        
-        # Drawing the player's new location
-        for paddle in [playerPaddleObj, opponentPaddleObj]:
-            pygame.draw.rect(screen, WHITE, paddle)
-
-        pygame.draw.rect(screen, WHITE, topWall)
-        pygame.draw.rect(screen, WHITE, bottomWall)
-        scoreRect = updateScore(lScore, rScore, screen, WHITE, scoreFont)
-        pygame.display.update([topWall, bottomWall, ball, leftPaddle, rightPaddle, scoreRect, winMessage])
-        clock.tick(60)
-        
-        # This number should be synchronized between you and your opponent.  If your number is larger
-        # then you are ahead of them in time, if theirs is larger, they are ahead of you, and you need to
-        # catch up (use their info)
-        sync += 1
+        # Drawing the ball, both paddles and the score, only the pixels that changed reach the display
+        # The profiler's overlay, when it is shown, goes on top
+        overlay = profiler.overlay() if profiler is not None else None
+        renderer.draw([ball.rect, leftPaddle.rect, rightPaddle.rect], lScore, rScore, overlay, HUD_POSITION)
+        if profiler is not None:
+            profiler.mark("present")
+        clock.tick(refreshRate)
+        if profiler is not None:
+            profiler.mark("wait")
+            profiler.end()
 
 
 # This is where you will connect to the server to get the info required to call the game loop.
-def joinServer(ip:str, port:str, errorLabel:tk.Label, app:tk.Tk) -> None:
+def joinServer(ip:str, port:str, errorLabel:tk.Label, app:tk.Tk, useUdp:bool = False, watch:bool = False,
+               useRollback:bool = False) -> None:
     # Purpose:      This method is fired when the join button is clicked
     # Arguments:
     # ip            A string holding the IP address of the server
     # port          A string holding the port the server is using
     # errorLabel    A tk label widget, modify it's text to display messages to the user (example below)
     # app           The tk window object, needed to kill the window
+    # useUdp        Play over UDP once the game starts if the server offers it
+    # watch         Watch the newest match being played instead of playing
+    # useRollback   Predict the whole game and roll it back on mispredictions instead of interpolating
     
     # Create a socket and connect to the server
     #===================================================================================================================
@@ -248,14 +283,29 @@ def joinServer(ip:str, port:str, errorLabel:tk.Label, app:tk.Tk) -> None:
     # Initiate client object and connect to the server
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     port = int(port)
-    client.connect((ip, port))
-
-    # Get the required information from the server (screen width, height & player paddle, "left" or "right")
-    screenWidth = client.recv(1024).decode()
-    screenWidth = int(screenWidth)
-    screenHeight = client.recv(1024).decode()
-    screenHeight = int(screenHeight)
-    paddleSide = client.recv(1024).decode()
+    # Spectators use the next port up
+    client.connect((ip, port + SPECTATOR_PORT_OFFSET if watch else port))
+
+    # Get the required information from the server in its HELLO (screen width, height, player paddle "left" or
+    # "right" and the session id), the first frame on the connection
+    # The decoder is handed to playGame so no bytes that arrived right behind the start frame are lost
+    decoder = FrameDecoder()
+    try:
+        frames = []
+        while not frames:
+            data = client.recv(1024)
+            if not data:
+                raise ProtocolError("the server closed the connection")
+            frames = decoder.feed(data)
+        if frameType(frames[0]) != MSG_HELLO:
+            raise ProtocolError("expected HELLO")
+        screenWidth, screenHeight, paddleSide, sessionId = decodeHello(frames[0])
+    except ProtocolError as e:
+        # Also what a server running another protocol version ends up as
+        errorLabel.config(text=f"Can't join: {e}")
+        errorLabel.update()
+        client.close()
+        return
 
     # If you have messages you'd like to show the user use the errorLabel widget like so
     errorLabel.config(text=f"Some update text. Your input: IP: {ip}, Port: {port}")
@@ -265,21 +315,42 @@ def joinServer(ip:str, port:str, errorLabel:tk.Label, app:tk.Tk) -> None:
     
     # Close this window and start the game with the info passed to you from the server
 
-    # Send a message to the server that the client is ready to start the game
-    client.send(b"ready")
+    # Send a message to the server that the client is ready to start the game, or wants to watch one
+    client.sendall(encodeReady())
 
     errorLabel.config(text = f"Waiting for another user to start the game...")
     errorLabel.update()
 
-    flag = 0
+    # Get the game ready while the server finds an opponent, so it can begin as soon as the start message arrives
+    pygame.display.init()
+    startMixer()
+    assets = loadBundle()
+
     # Wait until the client receives confirmation from the server that both clients are ready before starting the game
-    while flag == 0:
-        if client.recv(1024).decode() == "start":
-            flag = 1
+    # The server's UDP offer comes just before the start message
+    udpOffer = None
+    started = False
+    while not started:
+        try:
+            data = client.recv(1024)
+        except OSError:
+            data = b""
+        if not data:
+            # The server closed the connection, it is shutting down or the handshake timed out
+            errorLabel.config(text="The server closed the connection before the game started")
+            errorLabel.update()
+            client.close()
+            return
+        for frame in decoder.feed(data):
+            if frameType(frame) == MSG_UDP_OFFER:
+                udpOffer = decodeUdpOffer(frame)
+            elif frameType(frame) == MSG_START:
+                started = True
     
     
     app.withdraw()     # Hides the window 
-    playGame(screenWidth, screenHeight, paddleSide, client)  # User will be either left or right paddle
+    playGame(screenWidth, screenHeight, paddleSide, client, decoder,
+             udpOffer if useUdp else None, useRollback, sessionId, assets)  # User will be either left or right paddle, or a spectator
     app.quit()         # Kills the window
 
 
@@ -306,10 +377,24 @@ def startScreen():
     portEntry.grid(column=1, row=2)
 
     errorLabel = tk.Label(text="")
-    errorLabel.grid(column=0, row=4, columnspan=2)
+    errorLabel.grid(column=0, row=6, columnspan=2)
+
+    udpChoice = tk.BooleanVar(value=False)
+    udpCheck = tk.Checkbutton(text="Play over UDP", variable=udpChoice)
+    udpCheck.grid(column=0, row=3)
+
+    watchChoice = tk.BooleanVar(value=False)
+    watchCheck = tk.Checkbutton(text="Watch a match", variable=watchChoice)
+    watchCheck.grid(column=1, row=3)
+
+    rollbackChoice = tk.BooleanVar(value=False)
+    rollbackCheck = tk.Checkbutton(text="Rollback netcode", variable=rollbackChoice)
+    rollbackCheck.grid(column=0, row=4, columnspan=2)
 
-    joinButton = tk.Button(text="Join", command=lambda: joinServer(ipEntry.get(), portEntry.get(), errorLabel, app))
-    joinButton.grid(column=0, row=3, columnspan=2)
+    joinButton = tk.Button(text="Join", command=lambda: joinServer(ipEntry.get(), portEntry.get(), errorLabel, app,
+                                                                   udpChoice.get(), watchChoice.get(),
+                                                                   rollbackChoice.get()))
+    joinButton.grid(column=0, row=5, columnspan=2)
 
     app.mainloop()
 
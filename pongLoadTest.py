@@ -0,0 +1,400 @@
+# =================================================================================================
+# Purpose: This program load tests the pong server with bot clients that need no display. Every bot
+#          does the same handshake as joinServer in pongClient.py, then sends a scripted paddle input
+#          every frame and reads the snapshots that come back, like playGame does. All bots share one
+#          thread and one selector so thousands of them can run from one machine. The results are
+#          printed as JSON so runs can be compared between releases.
+#
+# Example: python pongLoadTest.py --server event --bots 500 --duration 30 --output results.json
+# =================================================================================================
+
+import argparse
+import errno
+import json
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from assets.code.wireProtocol import (FrameDecoder, ProtocolError, encodeInput, encodeReady, decodeHello,
+                                      decodeSnapshot, decodeUdpOffer, frameType, MSG_HELLO, MSG_START, MSG_SNAPSHOT,
+                                      MSG_UDP_OFFER)
+from assets.code.gameEngine import PADDLE_HEIGHT, BALL_SIZE, TICK_RATE, WIN_SCORE
+from assets.code.udpTransport import UdpClientChannel, INPUT_HEADER, MAX_DATAGRAM
+from assets.code.clientNetwork import KEEPALIVE_INPUTS
+from pongServer import raiseFileLimit
+
+SEND_WINDOW = 1024      # Unacknowledged inputs a bot remembers the send time of
+RECV_SIZE = 65536
+
+
+# Returns the p50/p95/p99, mean and max of a list of samples in seconds, as milliseconds
+def percentiles(samples:List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(samples)
+    pick = lambda fraction: round(ordered[min(len(ordered) - 1, int(fraction*len(ordered)))]*1000, 3)
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+            "mean": round(sum(ordered)/len(ordered)*1000, 3), "max": round(ordered[-1]*1000, 3)}
+
+
+#==================================================================================================================
+# Purpose: The purpose of this class is to hold the connection and game state of one bot client
+# Preconditions: Created by LoadTest when the bot is due to connect
+# Postconditions: The bot moves through connecting, handshake, waiting and playing until it is closed
+#==================================================================================================================
+class Bot(object):
+    __slots__ = ("index", "sock", "phase", "decoder", "outbuf", "side", "udp", "udpOffer", "sequence",
+                 "sent", "paddleY", "ballY", "over", "connectedAt", "readyAt", "random")
+
+    def __init__(self, index:int, sock:socket.socket, seed:int) -> None:
+        self.index = index
+        self.sock = sock
+        self.phase = "connecting"
+        self.decoder = FrameDecoder()
+        self.outbuf = bytearray()
+        self.side = ""
+        self.udp: Optional[UdpClientChannel] = None
+        self.udpOffer = None
+        self.sequence = 0
+        self.sent = deque(maxlen=SEND_WINDOW)     # (sequence, time sent) of inputs the server hasn't acked
+        self.paddleY = 0
+        self.ballY = 0
+        self.over = False
+        self.connectedAt = 0.0
+        self.readyAt = 0.0
+        self.random = random.Random(seed)
+
+
+#==================================================================================================================
+# Purpose: The purpose of this class is to run every bot from one event loop and collect the measurements
+# Preconditions: A server is listening on host and port
+# Postconditions: run returns a dictionary of the results that can be dumped as JSON
+#==================================================================================================================
+class LoadTest(object):
+    def __init__(self, host:str, port:int, bots:int, duration:float, rampRate:float, inputRate:float,
+                 useUdp:bool, script:str, handshakeTimeout:float) -> None:
+        self.host = host
+        self.port = port
+        self.botCount = bots
+        self.duration = duration
+        self.rampRate = rampRate
+        self.inputInterval = 1/inputRate
+        self.useUdp = useUdp
+        self.script = script
+        self.handshakeTimeout = handshakeTimeout
+        self.selector = selectors.DefaultSelector()
+        self.bots: List[Bot] = []
+
+        # Measurements
+        self.latencies: List[float] = []          # Input sent to the first snapshot that acknowledged it
+        self.handshakes: List[float] = []         # Connect started to HELLO received
+        self.matchWaits: List[float] = []         # Ready sent to start received
+        self.counters = {"snapshots": 0, "inputs": 0, "bytesIn": 0, "bytesOut": 0, "playing": 0,
+                         "gamesFinished": 0}
+        self.errors = {"connect": 0, "handshakeTimeout": 0, "protocol": 0, "disconnected": 0, "send": 0}
+
+    #=============================================================================================================
+    # Purpose: The purpose of this function is to start the bots at the ramp rate, send their inputs every frame
+    #          and read whatever the server sends until the duration is up
+    # Preconditions: The server is accepting connections
+    # Postconditions: Every bot's sockets are closed and the results are returned
+    #=============================================================================================================
+    def run(self) -> dict:
+        raiseFileLimit()
+        start = time.monotonic()
+        end = start + self.duration
+        nextFrame = start
+        lastTimeoutCheck = start
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            due = min(self.botCount, int((now - start)*self.rampRate) + 1)
+            while len(self.bots) < due:
+                self.startBot(len(self.bots), now)
+
+            if now >= nextFrame:
+                self.sendInputs(now)
+                nextFrame = max(nextFrame + self.inputInterval, now)
+            if now - lastTimeoutCheck >= 1:
+                self.checkTimeouts(now)
+                lastTimeoutCheck = now
+
+            timeout = min(nextFrame, end) - now
+            if len(self.bots) < self.botCount:
+                timeout = min(timeout, 1/self.rampRate)
+            for key, mask in self.selector.select(max(timeout, 0.0)):
+                bot, isUdp = key.data
+                if isUdp:
+                    self.readUdp(bot)
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.writeReady(bot)
+                if mask & selectors.EVENT_READ and bot.phase != "closed":
+                    self.readTcp(bot)
+        elapsed = time.monotonic() - start
+
+        for bot in self.bots:
+            self.closeBot(bot)
+        return self.report(elapsed)
+
+    def startBot(self, index:int, now:float) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        bot = Bot(index, sock, index)
+        bot.connectedAt = now
+        self.bots.append(bot)
+        if sock.connect_ex((self.host, self.port)) not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.errors["connect"] += 1
+            bot.phase = "closed"
+            sock.close()
+            return
+        self.selector.register(sock, selectors.EVENT_WRITE, (bot, False))
+
+    def writeReady(self, bot:Bot) -> None:
+        if bot.phase == "connecting":
+            if bot.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.errors["connect"] += 1
+                self.closeBot(bot)
+                return
+            bot.phase = "handshake"
+            self.selector.modify(bot.sock, selectors.EVENT_READ, (bot, False))
+            return
+        self.flush(bot)
+
+    def send(self, bot:Bot, data:bytes) -> None:
+        self.counters["bytesOut"] += len(data)
+        if bot.outbuf:
+            bot.outbuf += data
+            return
+        try:
+            sent = bot.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.errors["send"] += 1
+            self.closeBot(bot)
+            return
+        if sent < len(data):
+            bot.outbuf += data[sent:]
+            self.selector.modify(bot.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, (bot, False))
+
+    def flush(self, bot:Bot) -> None:
+        try:
+            sent = bot.sock.send(bot.outbuf)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.errors["send"] += 1
+            self.closeBot(bot)
+            return
+        del bot.outbuf[:sent]
+        if not bot.outbuf:
+            self.selector.modify(bot.sock, selectors.EVENT_READ, (bot, False))
+
+    #=============================================================================================================
+    # Purpose: The purpose of this function is to read from a bot's TCP connection and act on its frames, the
+    #          HELLO that ends the handshake, then the UDP offer, start and snapshots
+    # Preconditions: The bot's socket is readable
+    # Postconditions: The bot has moved on to the next phase if the data it was waiting for arrived
+    #=============================================================================================================
+    def readTcp(self, bot:Bot) -> None:
+        try:
+            data = bot.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            # The server closes both players once a game is over, anything before that is an error
+            if not bot.over:
+                self.errors["disconnected"] += 1
+            self.closeBot(bot)
+            return
+        self.counters["bytesIn"] += len(data)
+        now = time.monotonic()
+
+        try:
+            frames = bot.decoder.feed(data)
+        except ProtocolError:
+            self.errors["protocol"] += 1
+            self.closeBot(bot)
+            return
+        for frame in frames:
+            kind = frameType(frame)
+            if kind == MSG_HELLO and bot.phase == "handshake":
+                bot.side = decodeHello(frame)[2]
+                self.handshakes.append(now - bot.connectedAt)
+                bot.phase = "waiting"
+                bot.readyAt = now
+                self.send(bot, encodeReady())
+            elif kind == MSG_UDP_OFFER:
+                bot.udpOffer = decodeUdpOffer(frame)
+            elif kind == MSG_START and bot.phase == "waiting":
+                self.startPlaying(bot, now)
+            elif kind == MSG_SNAPSHOT:
+                self.handleSnapshot(bot, decodeSnapshot(frame), now)
+
+    def startPlaying(self, bot:Bot, now:float) -> None:
+        self.matchWaits.append(now - bot.readyAt)
+        bot.phase = "playing"
+        self.counters["playing"] += 1
+        if self.useUdp and bot.udpOffer is not None:
+            udpPort, token = bot.udpOffer
+            bot.udp = UdpClientChannel((self.host, udpPort), token)
+            self.selector.register(bot.udp.rawSock, selectors.EVENT_READ, (bot, True))
+
+    def readUdp(self, bot:Bot) -> None:
+        now = time.monotonic()
+        while True:
+            try:
+                data = bot.udp.rawSock.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+            self.counters["bytesIn"] += len(data)
+            snapshot = bot.udp.decodeSnapshot(data)
+            if snapshot is not None:
+                self.handleSnapshot(bot, snapshot, now)
+
+    # Time every input the snapshot acknowledges and remember where the ball and this bot's paddle are
+    def handleSnapshot(self, bot:Bot, snapshot:tuple, now:float) -> None:
+        self.counters["snapshots"] += 1
+        if bot.side == "left":
+            bot.paddleY, ack = snapshot[5], snapshot[12]
+        else:
+            bot.paddleY, ack = snapshot[6], snapshot[13]
+        bot.ballY = snapshot[2]
+        sent = bot.sent
+        while sent and sent[0][0] <= ack:
+            self.latencies.append(now - sent.popleft()[1])
+        if not bot.over and max(snapshot[9], snapshot[10]) >= WIN_SCORE:
+            bot.over = True
+            self.counters["gamesFinished"] += 1
+
+    # Every playing bot sends one input per frame, the same as playGame does
+    def sendInputs(self, now:float) -> None:
+        for bot in self.bots:
+            if bot.phase != "playing" or bot.over:
+                continue
+            bot.sequence += 1
+            direction = self.nextDirection(bot)
+            bot.sent.append((bot.sequence, now))
+            self.counters["inputs"] += 1
+            if bot.udp is not None:
+                bot.udp.sendInput(direction, bot.sequence)
+                self.counters["bytesOut"] += INPUT_HEADER.size + len(bot.udp.recent)
+                if bot.sequence % KEEPALIVE_INPUTS:
+                    continue
+            self.send(bot, encodeInput(direction, bot.sequence))
+
+    def nextDirection(self, bot:Bot) -> str:
+        if self.script == "random":
+            return bot.random.choice(("", "up", "down"))
+        # "track" follows the ball, which keeps rallies (and so the game) going for a long time
+        center = bot.paddleY + PADDLE_HEIGHT//2
+        ballCenter = bot.ballY + BALL_SIZE//2
+        if ballCenter < center - 5:
+            return "up"
+        if ballCenter > center + 5:
+            return "down"
+        return ""
+
+    def checkTimeouts(self, now:float) -> None:
+        for bot in self.bots:
+            if bot.phase in ("connecting", "handshake") and now - bot.connectedAt > self.handshakeTimeout:
+                self.errors["handshakeTimeout"] += 1
+                self.closeBot(bot)
+
+    def closeBot(self, bot:Bot) -> None:
+        if bot.phase == "closed":
+            return
+        bot.phase = "closed"
+        for sock in (bot.sock, bot.udp.rawSock if bot.udp is not None else None):
+            if sock is None:
+                continue
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            sock.close()
+
+    def report(self, elapsed:float) -> dict:
+        counters = self.counters
+        return {
+            "config": {"host": self.host, "port": self.port, "bots": self.botCount, "duration": self.duration,
+                       "rampRate": self.rampRate, "inputRate": round(1/self.inputInterval, 3),
+                       "udp": self.useUdp, "script": self.script},
+            "elapsedSeconds": round(elapsed, 3),
+            "bots": {"started": len(self.bots), "handshaked": len(self.handshakes),
+                     "playing": counters["playing"], "gamesFinished": counters["gamesFinished"]},
+            "throughput": {"snapshotsPerSecond": round(counters["snapshots"]/elapsed, 1),
+                           "inputsPerSecond": round(counters["inputs"]/elapsed, 1),
+                           "bytesInPerSecond": round(counters["bytesIn"]/elapsed, 1),
+                           "bytesOutPerSecond": round(counters["bytesOut"]/elapsed, 1)},
+            "totals": {"snapshots": counters["snapshots"], "inputs": counters["inputs"]},
+            "latencyMs": percentiles(self.latencies),
+            "handshakeMs": percentiles(self.handshakes),
+            "matchWaitMs": percentiles(self.matchWaits),
+            "errors": dict(self.errors),
+        }
+
+
+#==================================================================================================================
+# Purpose: The purpose of this function is to start a server of the given mode in its own process so the bots
+#          and the server don't share an interpreter
+# Preconditions: The port is free on host
+# Postconditions: Returns the server's process, which the caller terminates
+#==================================================================================================================
+def startServer(mode:str, host:str, port:int, workers:int) -> subprocess.Popen:
+    if mode == "sharded":
+        code = f"import pongServer; pongServer.Supervisor({host!r}, {port}, {workers}, pongServer.runWorker).listen()"
+    else:
+        serverClass = "EventLoopServer" if mode == "event" else "ThreadedServer"
+        code = f"import pongServer; pongServer.{serverClass}({host!r}, {port}).listen()"
+    return subprocess.Popen([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the pong server with headless bot clients")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--server", choices=("none", "threaded", "event", "sharded"), default="none",
+                        help="start a local server of this mode first instead of using one that is already running")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes of a sharded server")
+    parser.add_argument("--bots", type=int, default=100, help="bot clients to connect, in pairs")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for, ramp included")
+    parser.add_argument("--ramp", type=float, default=100, help="bots started per second")
+    parser.add_argument("--input-rate", type=float, default=TICK_RATE, help="inputs each bot sends per second")
+    parser.add_argument("--udp", action="store_true", help="play over UDP when the server offers it")
+    parser.add_argument("--script", choices=("track", "random"), default="track",
+                        help="how bots move, following the ball or pressing random keys")
+    parser.add_argument("--handshake-timeout", type=float, default=30)
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    server = None
+    if args.server != "none":
+        server = startServer(args.server, args.host, args.port, args.workers)
+        time.sleep(1)
+    try:
+        results = LoadTest(args.host, args.port, args.bots, args.duration, args.ramp, args.input_rate, args.udp,
+                           args.script, args.handshake_timeout).run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    results["server"] = args.server
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
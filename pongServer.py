@@ -5,11 +5,29 @@
 # Purpose: This program acts as the server with which the two clients use to communicate between each other                  
 # =================================================================================================
 
+import os
 import socket
 from _thread import *
 import threading
 import time
-import pickle
+import selectors
+import heapq
+import itertools
+import secrets
+from typing import Tuple, List, Callable, Optional
+
+from assets.code.wireProtocol import (FrameDecoder, ProtocolError, encodeStart, encodeSnapshot, decodeInput,
+                                      encodeHello, decodeReady, decodeResume, frameType, MSG_INPUT, MSG_READY,
+                                      MSG_RESUME)
+from assets.code.roomRegistry import RoomRegistry, Room
+from assets.code.gameEngine import GameEngine, TickScheduler
+from assets.code.udpTransport import UdpGameChannel
+from assets.code.replay import recorderFromEnv
+from assets.code.serverMetrics import ServerMetrics, kernelSendQueue, metricsFileFromEnv, writeMetricsFile
+from assets.code.spectators import Spectator, SPECTATOR_PORT_OFFSET, broadcast, closeAll
+from assets.code.supervisor import (Supervisor, sendControl, receiveControl, workerMetricsPath, splitSessionId,
+                                    joinSessionId, CONTROL_CLIENT, CONTROL_DRAIN, CONTROL_STATUS, CONTROL_RESUME,
+                                    SLOT_SHIFT, HEARTBEAT_INTERVAL, DRAIN_TIMEOUT)
 
 # Use this file to write your server logic
 # You will need to support at least two clients
@@ -24,13 +42,20 @@ import pickle
 # the two simultaneous clients.  It is responsible for relaying the location 
 # of the other player’s paddle to the client, the location of the ball and the current score.  
 
+# The server runs the game itself with gameEngine, one GameState per room stepped at a fixed tick rate.
+# Clients only send which way their paddle is moving and draw the snapshots the server sends back.
+# Once a game starts clients may switch to UDP on the same port number (see udpTransport), anything
+# that isn't playing over UDP keeps getting its snapshots over TCP.
+
 # Initialize all global variables
 print_lock = threading.Lock()
 screenWidth = str(640)
 screenHeight = str(480)
-counter = 0
-leftAddr = 0
-rightAddr = 0
+engine = GameEngine(int(screenWidth), int(screenHeight))
+# Seconds a client has to answer the HELLO with READY before it is dropped
+HANDSHAKE_TIMEOUT = 10
+# Seconds a match waits for a player that dropped out to reconnect before it ends
+RESUME_GRACE = 30
 
 #================================================================================================================
 # Purpose: The purpose of this class is to contain all the functions needed to connect to the clients and share
@@ -49,146 +74,942 @@ class ThreadedServer(object):
     def __init__(self,host:str,port:int) -> None:
         self.host = host
         self.port = port
-        self.ready_clients = 0
-        self.game_started = threading.Event()
-        self.client_sockets = []
+        # Pairs clients into rooms, guarded by registry_lock since every client thread uses it
+        self.registry = RoomRegistry()
+        self.registry_lock = threading.Lock()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # If the host and port are already bound, don't do anything
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host,self.port))
+        # The UDP socket has its own thread reading from it
+        self.udp = UdpGameChannel(self.host, self.port)
+        threading.Thread(target = self.udp.serveForever, args = (self.HandleUdpInput,), daemon = True).start()
+        self.metrics = ServerMetrics()
+        path, interval = metricsFileFromEnv()
+        if path is not None:
+            threading.Thread(target = self.writeMetrics, args = (path, interval), daemon = True).start()
+        # Spectators connect to the next port up, accepted by a thread of their own
+        self.spectatorSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.spectatorSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            self.sock.bind((self.host,self.port))
-        except:
-            pass
+            self.spectatorSock.bind((self.host, self.port + SPECTATOR_PORT_OFFSET if self.port else 0))
+            self.spectatorSock.listen(socket.SOMAXCONN)
+            threading.Thread(target = self.listenSpectators, daemon = True).start()
+        except OSError as e:
+            print("Spectators can't connect:", e)
     
     #===============================================================================================================
     # Purpose: The purpose of this function is to listen for clients to connect to the server. After a client
-    #          has connected the server assigns it to the left or right side and sends it the size of the game
-    #          Window. It then waits until both the left side and right side client have sent ready before calling
-    #          start_game
+    #          has connected the server puts it in a room, assigns it to the left or right side of that room and
+    #          starts a thread that does the client's handshake, so a slow client never holds up the next accept
     # Preconditions: This function expects to be called after the server has been started and for __init__ to
     #                have initialized the variables needed to connect to clients
     # Postconditions: After the function has been called any clients that have connected will have been given
-    #                 a position to play in and the size of the game window, and if two clients have connected
-    #                 and are ready to play it will call start_game so they can begin
+    #                 a position to play in and a thread that sends them the HELLO and waits for their READY
     #===============================================================================================================
     def listen(self) -> None:
-        self.sock.listen(5)
+        self.sock.listen(socket.SOMAXCONN)
         while True:
             # Accept the connection from client
             client, address = self.sock.accept()
 
-            # Add the client to a list of clients
-            self.client_sockets.append(client)
-
-            global screenHeight
-            global screenWidth
-            global counter
-            global leftAddr
-            global rightAddr
-
-            # Counter variable to determine how many current client connections there are
-            counter = counter + 1
-            
-            # Send the screenWidth and screenHeight to the client and allow time for the client to receive it
-            client.send(screenWidth.encode())
-            time.sleep(1)
-            
-            client.send(screenHeight.encode())
-            time.sleep(1)
-
-            # First client connected becomes the left paddle, second becomes the right paddle
-            if counter == 1:
-                paddleSide = "left"
-                leftAddr = address
-                client.send(paddleSide.encode())
-            elif counter == 2:
-                paddleSide = "right"
-                rightAddr = address
-                client.send(paddleSide.encode())
-                # Reset counter for next client to join
-                counter = 0
-
-            # Increment the ready_clients counter when a client confirms readiness
-            if client.recv(1024).decode() == "ready":
-                self.ready_clients += 1
-
-            # Check if both clients are ready to start the game
-            if self.ready_clients == 2:
-                self.start_game()
-            
-            client.settimeout(60)
-            threading.Thread(target = self.listenToClient, args = (client, address)).start()
+            # Pair the client with the oldest client waiting in the lobby, or open a new room for it
+            # The client that opened the room is the left paddle, the one that filled it is the right paddle
+            sessionId = secrets.randbits(64)
+            with self.registry_lock:
+                room, paddleSide = self.registry.join(client, sessionId)
+            self.metrics.add(client, room, paddleSide)
+            threading.Thread(target = self.handshakeClient, args = (client, address, paddleSide, sessionId)).start()
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to send a client the HELLO with the size of the game window, its
+    #          side and its session id, wait for its READY and then keep reading its inputs for the rest of the
+    #          game. A client that answers with RESUME instead goes back into the match it dropped out of
+    # Preconditions: This function runs on a thread of its own for a client that has just joined a room
+    # Postconditions: The client is marked ready, and its room started if the opponent was ready too, then
+    #                 listenToClient runs until it disconnects. A client that doesn't answer within
+    #                 HANDSHAKE_TIMEOUT seconds is dropped, an opponent waiting in its room goes back to the lobby
+    #===============================================================================================================
+    def handshakeClient(self, client: socket.socket, address: Tuple[str, int], paddleSide: str,
+                        sessionId: int) -> None:
+        decoder = FrameDecoder()
+        try:
+            client.settimeout(HANDSHAKE_TIMEOUT)
+            client.sendall(encodeHello(int(screenWidth), int(screenHeight), paddleSide, sessionId))
+            answer = readAnswer(client, decoder)
+            if frameType(answer) == MSG_RESUME:
+                self.resumeClient(client, address, decodeResume(answer), decoder)
+                return
+            if frameType(answer) != MSG_READY:
+                raise ProtocolError("Expected READY")
+        except (OSError, ProtocolError) as e:
+            print("Handshake failed:", e)
+            client.close()
+            self.dropClient(client)
+            return
+
+        # Start the client's room once both players are ready
+        with self.registry_lock:
+            ready_room = self.registry.markReady(client)
+        if ready_room is not None:
+            self.start_game(ready_room)
+        client.settimeout(60)
+        self.listenToClient(client, address, decoder)
 
     #=============================================================================================================
-    # Purpose: The purpose of this function is to send a start message to two clients about to play so they start
-    #          at the same time
-    # Preconditions: This function expects at least two clients to be connected to the server and for both to have
+    # Purpose: The purpose of this function is to send a start message to the two clients of a room so they start
+    #          at the same time, and start the thread that runs the room's game
+    # Preconditions: This function expects both clients of the room to be connected to the server and to have
     #                sent the ready message signifying that both are waiting in the while loop to start
     # Postconditions: After this function has run both clients will exit the while loop before playGame and
-    #                 start the game     
+    #                 start the game, and the room is being ticked by runRoom
+    #==============================================================================================================
+    def start_game(self, room: Room) -> None:
+        room.state = engine.newState()
+        room.scheduler = TickScheduler()
+        room.recorder = recorderFromEnv(room.roomId, engine)
+
+        # Offer each client UDP and signal both clients to start the game
+        start_frame = encodeStart()
+        for client in room.members():
+            client.sendall(self.udp.offer(client) + start_frame)
+
+        threading.Thread(target = self.runRoom, args = (room,), daemon = True).start()
+
     #==============================================================================================================
-    def start_game(self) -> None:
-        # Signal both clients to start the game
-        for client in self.client_sockets:
-            client.sendall(b"start")
-        
-        self.game_started.set()
+    # Purpose: The purpose of this function is to run a room's game, stepping the engine whenever a tick is due
+    #          and sending a snapshot of the new state to both players
+    # Preconditions: This function expects start_game to have given the room its state and scheduler
+    # Postconditions: The function returns once the game is over or the room has been torn down
+    #==============================================================================================================
+    def runRoom(self, room: Room) -> None:
+        state = room.state
+        scheduler = room.scheduler
+        scheduler.start()
+        recorder = room.recorder
+        try:
+            while not room.closed:
+                if room.away:
+                    # A player dropped out, hold the game until it is back or its grace period is over
+                    with self.registry_lock:
+                        expired = self.registry.expire(time.monotonic())
+                    for other in expired:
+                        shutdownAll(other.members())
+                    time.sleep(scheduler.interval)
+                    scheduler.start()
+                    continue
+                steps = scheduler.due(time.monotonic())
+                for _ in range(steps):
+                    # The input threads can't change a direction between the record and the step
+                    with room.inputLock:
+                        if recorder is not None:
+                            recorder.record(state)
+                        room.events |= engine.step(state)
+                if steps:
+                    if recorder is not None:
+                        recorder.flush()
+                    snapshot = encodeSnapshot(state, room.events, room.leftSeq, room.rightSeq)
+                    fields = self.udp.record(room)
+                    for client in room.members():
+                        size = self.udp.sendSnapshot(client, room, fields, room.events)
+                        if not size:
+                            size = len(snapshot)
+                            try:
+                                client.sendall(snapshot)
+                            except OSError:
+                                # The client's own thread notices the broken socket and tears the room down
+                                pass
+                        stats = self.metrics.of(client)
+                        if stats is not None:
+                            stats.sent(size)
+                    self.metrics.snapshotSent(room, time.monotonic())
+                    # The same snapshot bytes go to every spectator, without ever waiting on one
+                    if room.spectators:
+                        dropped = broadcast(list(room.spectators), snapshot)
+                        if dropped:
+                            with self.registry_lock:
+                                for spectator in dropped:
+                                    room.spectators.remove(spectator)
+                    room.events = 0
+                    if engine.isOver(state):
+                        return
+                time.sleep(max(0.0, scheduler.nextTick - time.monotonic()))
+        finally:
+            # The match is over or a player left, either way the replay is complete and the spectators leave
+            if recorder is not None:
+                recorder.close()
+            with self.registry_lock:
+                spectators = self.registry.endSpectating(room)
+            closeAll(spectators)
 
     #================================================================================================================
-    # Purpose: The purpose of this function is to take the data recieved by a client and send it to the other
-    #          client
-    # Preconditions: This function expects at least two clients to be connected to  the server and running playGame
-    # Postconditions: After this function has run the data sent by one client will have been sent to the other client
+    # Purpose: The purpose of this function is to take the input frames recieved from a client and apply them to
+    #          the game running in the client's room
+    # Preconditions: This function expects the client's room to have started, and for frames to hold only complete
+    #                frames that have already been checked by a FrameDecoder
+    # Postconditions: After this function has run the client's paddle will move the way its newest input says on
+    #                 the room's next tick
     #================================================================================================================
-    def HandlePickledData(self, data: bytes, client: socket.socket) -> None:
-        # Load data and send it to any client in the list besides itself
-        received_data = pickle.loads(data)
-        other_client = next(sock for sock in self.client_sockets if sock != client)
-        other_client.sendall(pickle.dumps(received_data))
+    def HandleFrameData(self, frames: List[bytes], client: socket.socket) -> None:
+        # Find the client's room, a dictionary lookup no matter how many rooms are live
+        room = self.registry.roomOf(client)
+        if room is None:
+            raise error('Room closed')
+        for frame in frames:
+            if frameType(frame) == MSG_INPUT:
+                direction, sequence = decodeInput(frame)
+                with room.inputLock:
+                    room.applyInput(client, direction, sequence)
+        stats = self.metrics.of(client)
+        if stats is not None:
+            stats.received(len(frames), 0, time.monotonic())
+
+    #================================================================================================================
+    # Purpose: The purpose of this function is to apply an input that arrived over UDP to the game in the client's
+    #          room. Every datagram repeats the last few directions but a direction holds until the next one, so
+    #          only the newest matters and older or repeated datagrams change nothing
+    # Preconditions: This function is called by the UDP channel's thread for datagrams with a known token
+    # Postconditions: The client's paddle will move the way the datagram says on the room's next tick
+    #================================================================================================================
+    def HandleUdpInput(self, client: socket.socket, sequence: int, directions: List[str], ackTick: int,
+                       size: int) -> None:
+        room = self.registry.roomOf(client)
+        if room is not None and directions:
+            with room.inputLock:
+                room.applyInput(client, directions[-1], sequence)
+        stats = self.metrics.of(client)
+        if stats is not None:
+            now = time.monotonic()
+            stats.received(1, size, now)
+            self.metrics.acked(stats, ackTick, now)
     
     #============================================================================================================
-    # Purpose: The purpose of this function is to take the data from one of the client and make sure
-    #          It is the appropriate data type before sending it to HandlePickledData to be processed
+    # Purpose: The purpose of this function is to read the byte stream from one of the clients, split it into
+    #          complete frames and make sure they are valid before sending them to HandleFrameData
     # Preconditions: This function expects there to be a client connected to the server and that client
     #                has begun the playGame function
-    # Postconditions: After this function has called the data sent by the client is sent to HandlePickled Data
-    #                 so it can be sent to the other client
+    # Postconditions: After this function has called the frames sent by the client are sent to HandleFrameData
+    #                 so they can be applied to the client's game
     #============================================================================================================
-    def listenToClient(self, client: socket.socket, address: Tuple[str, int]) -> None:
+    def listenToClient(self, client: socket.socket, address: Tuple[str, int], decoder: FrameDecoder) -> None:
         # Size of the incoming data
-        size = 1024
+        size = 4096
+        stats = self.metrics.of(client)
         # Continuously listen for messages from the clients
         while True:
             try:
                 # Try to receive the incoming data 
                 data = client.recv(size)
                 if data:
+                    if stats is not None:
+                        stats.bytesIn += len(data)
                     try:
-                        # Try to load the pickled data and have an exception for data tbat is not pickled
-                        pickle.loads(data)
-                    except:
-                        # Set the response to echo back the received data
-                        print("Error pickling data")
-                        response = data
-                        client.send(response)
-                    else:
-                        # If the data is pickled then call the function to handle it
-                        self.HandlePickledData(data, client)
+                        # Frames with a bad version, type or length mean the stream can't be trusted anymore
+                        frames = decoder.feed(data)
+                        if frames:
+                            self.HandleFrameData(frames, client)
+                    except ProtocolError:
+                        print("Error decoding data")
+                        raise
                 else:
                     # If no data is received then the client is disconnected
                     raise error('Client disconnected')
             except:
                 print("Closing client")
                 client.close()
-
-                # Remove the disconnected client from the list
-                self.client_sockets.remove(client)
-                # Check if all clients are disconnected
-                if len(self.client_sockets) == 0:
-                    print("All clients disconnected. Resuming listening...")
-                    self.__init__(self.host, self.port) # Clear any existing variables
-                    self.listen()  # Call the listen method to wait for more connections
+                rooms_left = self.dropClient(client)
+                # Check if all clients are disconnected, listen keeps accepting new ones either way
+                if rooms_left == 0:
+                    print("All clients disconnected")
                 break
 
+    #================================================================================================================
+    # Purpose: The purpose of this function is to remove a client that has been closed. A player that drops out
+    #          of a running match is parked so it can resume, an opponent still waiting for the match to start goes
+    #          back to the lobby, otherwise the room is torn down and the opponent's thread woken up so it closes
+    #          its socket too
+    # Preconditions: This function expects client to have joined a room and to be closed already
+    # Postconditions: Nothing references the client anymore, returns the number of rooms still open
+    #================================================================================================================
+    def dropClient(self, client: socket.socket) -> int:
+        others = []
+        with self.registry_lock:
+            room = self.registry.roomOf(client)
+            if room is not None and room.started and room.state is not None and not engine.isOver(room.state):
+                self.registry.park(client, time.monotonic() + RESUME_GRACE)
+                print(f"Player left room {room.roomId}, holding the match for {RESUME_GRACE} seconds")
+            else:
+                others = self.registry.leave(client)
+            rooms_left = len(self.registry)
+        for member in [client] + others:
+            self.udp.forget(member)
+        self.metrics.remove(client)
+        shutdownAll(others)
+        return rooms_left
+
+    #================================================================================================================
+    # Purpose: The purpose of this function is to put a reconnected player back into the match it dropped out of
+    # Preconditions: This function expects client to have joined a room for its HELLO and answered with RESUME
+    # Postconditions: The client has the slot of its parked session and listenToClient runs until it disconnects,
+    #                 or it has been closed if the session wasn't parked (unknown or expired)
+    #================================================================================================================
+    def resumeClient(self, client: socket.socket, address: Tuple[str, int], sessionId: int,
+                     decoder: FrameDecoder) -> None:
+        with self.registry_lock:
+            self.registry.cancelJoin(client)
+            resumed = self.registry.resume(sessionId, client)
+        self.metrics.remove(client)
+        if resumed is None:
+            print("Resume failed, no match held for that session")
+            client.close()
+            return
+        room, side = resumed
+        self.metrics.add(client, room, side)
+        # The room is paused while a player is away, its next snapshot is all the client missed
+        client.sendall(self.udp.offer(client) + encodeStart())
+        print(f"Player resumed room {room.roomId}")
+        client.settimeout(60)
+        self.listenToClient(client, address, decoder)
+
+    #================================================================================================================
+    # Purpose: The purpose of this function is to accept spectators and start a thread doing each one's handshake
+    # Preconditions: This function runs on a thread of its own, started by __init__
+    # Postconditions: The function never returns, every spectator that connects gets a handshake thread
+    #================================================================================================================
+    def listenSpectators(self) -> None:
+        while True:
+            try:
+                sock, address = self.spectatorSock.accept()
+            except OSError:
+                continue
+            threading.Thread(target = self.handshakeSpectator, args = (sock, address), daemon = True).start()
+
+    #================================================================================================================
+    # Purpose: The purpose of this function is to do a spectator's handshake, the same one a player gets but with
+    #          the side "spectator", then add it to the match it asked to watch
+    # Preconditions: This function expects sock to be a spectator that has just connected
+    # Postconditions: The spectator gets the room's snapshots from runRoom, or waits for the next match to start,
+    #                 or has been closed if it didn't answer the handshake
+    #================================================================================================================
+    def handshakeSpectator(self, sock: socket.socket, address: Tuple[str, int]) -> None:
+        try:
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            sock.sendall(encodeHello(int(screenWidth), int(screenHeight), "spectator", secrets.randbits(64)))
+            answer = readAnswer(sock, FrameDecoder())
+            if frameType(answer) != MSG_READY:
+                raise ProtocolError("Expected READY")
+            roomId = decodeReady(answer)
+        except (OSError, ProtocolError):
+            sock.close()
+            return
+        with self.registry_lock:
+            self.registry.watch(Spectator(sock, address), roomId)
+
+    #================================================================================================================
+    # Purpose: The purpose of this function is to write the server's metrics to a file every interval seconds
+    # Preconditions: This function runs on a thread of its own, started by __init__ when PONG_METRICS_FILE is set
+    # Postconditions: The file holds the metrics in the Prometheus text format, rewritten until the server exits
+    #================================================================================================================
+    def writeMetrics(self, path: str, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                writeMetricsFile(path, self.metrics.render(kernelSendQueue))
+            except OSError as e:
+                print("Error writing metrics:", e)
+
+
+
+#================================================================================================================
+# Purpose: The purpose of this class is to hold everything the event loop server knows about one client socket
+# Preconditions: The class is initialized by EventLoopServer when a client connection is accepted
+# Postconditions: The object tracks the client's handshake progress and any bytes still waiting to be written
+#                 to its socket
+#================================================================================================================
+class Connection(object):
+    __slots__ = ("sock", "address", "decoder", "outbuf", "side", "sessionId", "ready", "closed", "metrics",
+                 "spectator")
+
+    def __init__(self, sock:socket.socket, address:Tuple[str, int]) -> None:
+        self.sock = sock
+        self.address = address
+        self.decoder = FrameDecoder()
+        self.outbuf = bytearray()       # Bytes the socket could not take yet
+        self.side = ""
+        self.sessionId = 0
+        self.ready = False
+        self.closed = False
+        self.metrics = None             # serverMetrics.ConnectionMetrics, set once the client has a room
+        self.spectator = False          # Connected to the spectator port, handed to the room after READY
+
+
+#================================================================================================================
+# Purpose: The purpose of this class is to run the same accept, handshake and game steps as ThreadedServer
+#          for every client from a single thread using non-blocking sockets and the selectors module, so the
+#          server can hold thousands of connections without a thread per client
+# Preconditions: The class is intialized when the program is started in event mode
+# Postconditions: When listen is called the server runs forever, pairing clients into rooms as they join and
+#                 ticking the game of every started room from the event loop's timers
+#================================================================================================================
+class EventLoopServer(object):
+
+    RECV_SIZE = 4096
+    EXPIRE_INTERVAL = 1.0   # Seconds between checks for players that didn't resume in time
+    # A client that lets this much output back up is dropped
+    MAX_OUTBUF = 256 * 1024
+
+    #=================================================================================================================
+    # Purpose: The purpose of this function is to create the listening socket, the selector and the timer queue
+    # Preconditions: This function expects to be called after the server program has started
+    # Postconditions: After it has been called the server is bound and ready for listen to be called
+    #=================================================================================================================
+    def __init__(self, host:str, port:int) -> None:
+        self.host = host
+        self.port = port
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.timerIds = itertools.count()
+        self.registry = RoomRegistry()
+        self.connections = set()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.setblocking(False)
+        self.udp = UdpGameChannel(self.host, self.port)
+        self.udp.rawSock.setblocking(False)
+        self.metrics = ServerMetrics()
+        self.spectatorSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.spectatorSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.spectatorSock.bind((self.host, self.port + SPECTATOR_PORT_OFFSET if self.port else 0))
+        self.spectatorSock.setblocking(False)
+        # The supervisor's socket when the server runs as one of its workers, see WorkerServer
+        self.control = None
+        self.stopped = False
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to run the event loop. It waits on every socket at once and wakes
+    #          up either when a socket is readable/writable or when the next handshake or room tick timer is due
+    # Preconditions: This function expects __init__ to have bound the listening socket
+    # Postconditions: The function never returns, clients are served until the process is stopped
+    #===============================================================================================================
+    def listen(self) -> None:
+        raiseFileLimit()
+        self.sock.listen(socket.SOMAXCONN)
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.selector.register(self.udp.rawSock, selectors.EVENT_READ, self.udp)
+        self.spectatorSock.listen(socket.SOMAXCONN)
+        self.selector.register(self.spectatorSock, selectors.EVENT_READ, self.spectatorSock)
+        path, interval = metricsFileFromEnv()
+        if path is not None:
+            self.callLater(interval, self.writeMetrics, path, interval)
+        self.serve()
+
+    # The event loop itself, runs until stopped is set
+    def serve(self) -> None:
+        self.callLater(self.EXPIRE_INTERVAL, self.expireSessions)
+        while not self.stopped:
+            timeout = None
+            if self.timers:
+                timeout = max(0.0, self.timers[0][0] - time.monotonic())
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self.acceptClients()
+                    continue
+                if key.data is self.udp:
+                    self.readDatagrams()
+                    continue
+                if key.data is self.spectatorSock:
+                    self.acceptSpectators()
+                    continue
+                if key.data is self.control:
+                    self.readControl()
+                    continue
+                conn = key.data
+                if mask & selectors.EVENT_READ:
+                    self.readClient(conn)
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    self.flushClient(conn)
+            self.runTimers(time.monotonic())
+
+    # Schedule callback(*args) to run from the event loop after delay seconds
+    def callLater(self, delay:float, callback:Callable, *args) -> None:
+        self.callAt(time.monotonic() + delay, callback, *args)
+
+    # Schedule callback(*args) to run from the event loop at the given time.monotonic() deadline
+    def callAt(self, deadline:float, callback:Callable, *args) -> None:
+        heapq.heappush(self.timers, (deadline, next(self.timerIds), callback, args))
+
+    def runTimers(self, now:float) -> None:
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to accept every client waiting on the listening socket, give each
+    #          one a side and send it the HELLO, with a timer that drops it if no READY comes back in time
+    # Preconditions: This function expects the listening socket to be readable
+    # Postconditions: Each new client is registered with the selector and has joined a room
+    #===============================================================================================================
+    def acceptClients(self) -> None:
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors or similar, stop accepting until the next wake up
+                print("Error accepting client:", e)
+                return
+            self.addClient(sock, address)
+
+    # Start serving a client that has just connected
+    def addClient(self, sock:socket.socket, address:Tuple[str, int]) -> Connection:
+        conn = self.addConnection(sock, address)
+        conn.sessionId = self.newSessionId()
+
+        # The client that opens a room is the left paddle, the one that fills it is the right paddle
+        room, conn.side = self.registry.join(conn, conn.sessionId)
+        conn.metrics = self.metrics.add(conn, room, conn.side)
+
+        self.sendTo(conn, encodeHello(int(screenWidth), int(screenHeight), conn.side, conn.sessionId))
+        self.callLater(HANDSHAKE_TIMEOUT, self.checkHandshake, conn)
+        return conn
+
+    def acceptSpectators(self) -> None:
+        while True:
+            try:
+                sock, address = self.spectatorSock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print("Error accepting spectator:", e)
+                return
+            self.addSpectator(sock, address)
+
+    # Spectators get the same handshake as players, with "spectator" where the side goes
+    def addSpectator(self, sock:socket.socket, address:Tuple[str, int]) -> Connection:
+        conn = self.addConnection(sock, address)
+        conn.spectator = True
+        conn.sessionId = self.newSessionId()
+        self.sendTo(conn, encodeHello(int(screenWidth), int(screenHeight), "spectator", conn.sessionId))
+        self.callLater(HANDSHAKE_TIMEOUT, self.checkHandshake, conn)
+        return conn
+
+    def addConnection(self, sock:socket.socket, address:Tuple[str, int]) -> Connection:
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock, address)
+        self.connections.add(conn)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+        return conn
+
+    def newSessionId(self) -> int:
+        return secrets.randbits(64)
+
+    # Only the stalled client is closed, an opponent that is already waiting in its room goes back to the lobby
+    def checkHandshake(self, conn:Connection) -> None:
+        if not conn.ready and not conn.closed:
+            print("Handshake timed out")
+            self.closeClient(conn)
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to read whatever a client sent. Before the game starts that is the
+    #          READY (or RESUME) answering the HELLO, afterwards it is input frames for the game in the client's room
+    # Preconditions: This function expects the client socket to be readable
+    # Postconditions: The client is marked ready, or its inputs have been applied to its room, or it has been
+    #                 closed if it disconnected or sent something invalid
+    #===============================================================================================================
+    def readClient(self, conn:Connection) -> None:
+        try:
+            data = conn.sock.recv(self.RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            print("Closing client")
+            self.closeClient(conn)
+            return
+        if not conn.spectator:
+            conn.metrics.bytesIn += len(data)
+
+        try:
+            frames = conn.decoder.feed(data)
+            if frames and not conn.ready:
+                if frameType(frames[0]) == MSG_RESUME and not conn.spectator:
+                    conn.ready = True
+                    self.resumeClient(conn, decodeResume(frames[0]))
+                    return
+                if frameType(frames[0]) != MSG_READY:
+                    raise ProtocolError("Expected READY")
+                conn.ready = True
+                if conn.spectator:
+                    self.startWatching(conn, decodeReady(frames[0]))
+                    return
+                # Start the room once both of its players have confirmed readiness
+                room = self.registry.markReady(conn)
+                if room is not None:
+                    self.startRoom(room)
+                frames = frames[1:]
+            room = self.registry.roomOf(conn)
+            for frame in frames:
+                if frameType(frame) == MSG_INPUT and room is not None:
+                    direction, sequence = decodeInput(frame)
+                    room.applyInput(conn, direction, sequence)
+            if frames:
+                conn.metrics.received(len(frames), 0, time.monotonic())
+        except ProtocolError:
+            print("Error decoding data")
+            self.closeClient(conn)
+
+    # A client answered its HELLO with RESUME, it isn't joining the room it was given but going back to its match
+    def resumeClient(self, conn:Connection, sessionId:int) -> None:
+        self.registry.cancelJoin(conn)
+        self.metrics.remove(conn)
+        self.resumeSession(conn, sessionId)
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to put a reconnected player back into the match it dropped out of
+    # Preconditions: This function expects conn to be a connection not in any room that asked to resume sessionId
+    # Postconditions: The client has the slot of its parked session and its room is ticking again once nobody is
+    #                 away, or the client has been closed if the session wasn't parked (unknown or expired)
+    #===============================================================================================================
+    def resumeSession(self, conn:Connection, sessionId:int) -> None:
+        resumed = self.registry.resume(sessionId, conn)
+        if resumed is None:
+            print("Resume failed, no match held for that session")
+            self.closeClient(conn)
+            return
+        room, conn.side = resumed
+        conn.ready = True
+        conn.sessionId = sessionId
+        conn.metrics = self.metrics.add(conn, room, conn.side)
+        # The room is paused while a player is away, its next snapshot is all the client missed
+        self.sendTo(conn, self.udp.offer(conn) + encodeStart())
+        print(f"Player resumed room {room.roomId}")
+        if not room.away and room.scheduler.nextTick is None:
+            room.scheduler.start()
+            self.callAt(room.scheduler.nextTick, self.tickRoom, room)
+
+    # End the matches whose dropped out player didn't come back in time
+    def expireSessions(self) -> None:
+        for room in self.registry.expire(time.monotonic()):
+            for member in room.members():
+                self.closeClient(member)
+            self.endRoom(room)
+        self.callLater(self.EXPIRE_INTERVAL, self.expireSessions)
+
+    # Once a spectator says which match it wants to watch its socket leaves the event loop and belongs to the room
+    def startWatching(self, conn:Connection, roomId:Optional[int]) -> None:
+        conn.closed = True
+        self.connections.discard(conn)
+        self.selector.unregister(conn.sock)
+        self.registry.watch(Spectator(conn.sock, conn.address), roomId)
+
+    # Apply the newest direction of every input datagram waiting on the UDP socket, see HandleUdpInput
+    def readDatagrams(self) -> None:
+        now = time.monotonic()
+        for conn, sequence, directions, ackTick, size in self.udp.receiveAll():
+            room = self.registry.roomOf(conn)
+            if room is not None and directions:
+                room.applyInput(conn, directions[-1], sequence)
+            if not conn.closed:
+                conn.metrics.received(1, size, now)
+                self.metrics.acked(conn.metrics, ackTick, now)
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to start a room whose players are both ready and schedule its
+    #          first tick
+    # Preconditions: This function expects both players of the room to have sent ready
+    # Postconditions: Both players have been sent the start message and tickRoom will run for the room
+    #===============================================================================================================
+    def startRoom(self, room:Room) -> None:
+        room.state = engine.newState()
+        room.scheduler = TickScheduler()
+        room.scheduler.start()
+        room.recorder = recorderFromEnv(room.roomId, engine)
+        startFrame = encodeStart()
+        for member in room.members():
+            self.sendTo(member, self.udp.offer(member) + startFrame)
+        self.callAt(room.scheduler.nextTick, self.tickRoom, room)
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to step a room's game for every tick that is due and send the
+    #          players a snapshot of the new state
+    # Preconditions: This function expects startRoom to have given the room its state and scheduler
+    # Postconditions: The room's next tick is scheduled unless the game is over or the room has been torn down
+    #===============================================================================================================
+    def tickRoom(self, room:Room) -> None:
+        recorder = room.recorder
+        if room.closed:
+            self.endRoom(room)
+            return
+        if room.away:
+            # Hold the game until the player that dropped out is back, resumeSession schedules the next tick
+            room.scheduler.nextTick = None
+            return
+        state = room.state
+        steps = room.scheduler.due(time.monotonic())
+        for _ in range(steps):
+            if recorder is not None:
+                recorder.record(state)
+            room.events |= engine.step(state)
+        if steps:
+            if recorder is not None:
+                recorder.flush()
+            snapshot = encodeSnapshot(state, room.events, room.leftSeq, room.rightSeq)
+            fields = self.udp.record(room)
+            for member in room.members():
+                size = self.udp.sendSnapshot(member, room, fields, room.events)
+                if not size:
+                    size = len(snapshot)
+                    self.sendTo(member, snapshot)
+                member.metrics.sent(size)
+            self.metrics.snapshotSent(room, time.monotonic())
+            # The same snapshot bytes go to every spectator, without ever waiting on one
+            if room.spectators:
+                for spectator in broadcast(room.spectators, snapshot):
+                    room.spectators.remove(spectator)
+            room.events = 0
+            if engine.isOver(state):
+                self.endRoom(room)
+                return
+        self.callAt(room.scheduler.nextTick, self.tickRoom, room)
+
+    # The match is over or torn down, either way the replay is complete and the spectators leave
+    def endRoom(self, room:Room) -> None:
+        if room.recorder is not None:
+            room.recorder.close()
+        closeAll(self.registry.endSpectating(room))
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to write data to a client without ever blocking the event loop
+    # Preconditions: This function expects conn to have been accepted by this server
+    # Postconditions: Whatever the socket could not take right away is buffered and written once it is writable
+    #===============================================================================================================
+    def sendTo(self, conn:Connection, data:bytes) -> None:
+        if conn.closed:
+            return
+        if conn.outbuf:
+            conn.outbuf += data
+            if len(conn.outbuf) > self.MAX_OUTBUF:
+                print("Closing slow client")
+                self.closeClient(conn)
+            return
+        try:
+            sent = conn.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.closeClient(conn)
+            return
+        if sent < len(data):
+            conn.outbuf += memoryview(data)[sent:]
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+
+    def flushClient(self, conn:Connection) -> None:
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.closeClient(conn)
+            return
+        del conn.outbuf[:sent]
+        if not conn.outbuf:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    #===============================================================================================================
+    # Purpose: The purpose of this function is to remove a client from the server. A player that drops out of a
+    #          running match is parked so it can resume, an opponent still waiting for the match to start goes back
+    #          to the lobby, otherwise the room is torn down and its opponent can't keep playing alone so it is
+    #          closed as well, other rooms are not affected
+    # Preconditions: This function expects conn to have been accepted by this server
+    # Postconditions: The socket is closed and nothing references the connection anymore
+    #===============================================================================================================
+    def closeClient(self, conn:Connection) -> None:
+        if conn.closed:
+            return
+        conn.closed = True
+        self.connections.discard(conn)
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        self.udp.forget(conn)
+        self.metrics.remove(conn)
+        room = self.registry.roomOf(conn)
+        if room is not None and room.started and room.state is not None and not engine.isOver(room.state):
+            self.registry.park(conn, time.monotonic() + RESUME_GRACE)
+            print(f"Player left room {room.roomId}, holding the match for {RESUME_GRACE} seconds")
+            return
+        for other in self.registry.leave(conn):
+            self.closeClient(other)
+
+    # Bytes waiting in the connection's buffer and in the kernel's send queue
+    def backlog(self, conn:Connection) -> int:
+        if conn.closed:
+            return 0
+        return len(conn.outbuf) + (kernelSendQueue(conn.sock) or 0)
+
+    # Write the metrics file and schedule the next write, the render takes a few milliseconds for thousands of
+    # connections so it is fine to do from the event loop
+    def writeMetrics(self, path:str, interval:float) -> None:
+        try:
+            writeMetricsFile(path, self.metrics.render(self.backlog))
+        except OSError as e:
+            print("Error writing metrics:", e)
+        self.callLater(interval, self.writeMetrics, path, interval)
+
+
+#================================================================================================================
+# Purpose: The purpose of this class is to run an EventLoopServer as one worker of a sharded server. Instead of
+#          listening itself it is handed client sockets by the supervisor, and reports back how busy it is
+# Preconditions: The class is initialized by runWorker in a process started by supervisor.Supervisor
+# Postconditions: When listen is called the worker serves the clients it is given until it has been drained
+#================================================================================================================
+class WorkerServer(EventLoopServer):
+
+    def __init__(self, host:str, slot:int, slots:int, control:socket.socket) -> None:
+        # Bound to free ports only because EventLoopServer binds, the supervisor does the listening
+        super().__init__(host, 0)
+        self.sock.close()
+        self.spectatorSock.close()
+        self.registry = RoomRegistry(slot + 1, slots)
+        self.slot = slot
+        self.control = control
+        self.received = 0
+        self.draining = False
+        self.drainDeadline = 0.0
+
+    def listen(self) -> None:
+        raiseFileLimit()
+        self.control.setblocking(False)
+        self.selector.register(self.control, selectors.EVENT_READ, self.control)
+        self.selector.register(self.udp.rawSock, selectors.EVENT_READ, self.udp)
+        path, interval = metricsFileFromEnv()
+        if path is not None:
+            self.callLater(interval, self.writeMetrics, workerMetricsPath(path, self.slot), interval)
+        self.heartbeat()
+        self.serve()
+
+    # Take in the clients and orders the supervisor sent
+    def readControl(self) -> None:
+        while True:
+            message = receiveControl(self.control)
+            if message is None:
+                return
+            kind, values, sock = message
+            if sock is None:
+                if kind == CONTROL_DRAIN:
+                    self.drain()
+                continue
+            try:
+                address = sock.getpeername()
+            except OSError:
+                # Gone again before it got here
+                sock.close()
+                address = None
+            if kind == CONTROL_CLIENT:
+                self.received += 1
+                if address is not None:
+                    self.addClient(sock, address)
+                self.report()
+            elif kind == CONTROL_RESUME:
+                if address is not None:
+                    self.resumeSession(self.addConnection(sock, address), joinSessionId(values))
+            elif address is not None:
+                self.addSpectator(sock, address)
+
+    def newSessionId(self) -> int:
+        return self.slot << SLOT_SHIFT | secrets.randbits(SLOT_SHIFT)
+
+    # A session held by another worker goes back up to the supervisor to be passed on to that worker
+    def resumeClient(self, conn:Connection, sessionId:int) -> None:
+        if sessionId >> SLOT_SHIFT == self.slot:
+            super().resumeClient(conn, sessionId)
+            return
+        self.registry.cancelJoin(conn)
+        self.metrics.remove(conn)
+        conn.closed = True
+        self.connections.discard(conn)
+        self.selector.unregister(conn.sock)
+        try:
+            sendControl(self.control, CONTROL_RESUME, splitSessionId(sessionId), conn.sock)
+        except OSError as e:
+            print("Error passing resuming client to the supervisor:", e)
+        conn.sock.close()
+        self.report()
+
+    def report(self) -> None:
+        try:
+            sendControl(self.control, CONTROL_STATUS, (self.received, len(self.registry), len(self.connections),
+                                                       len(self.registry.lobby)))
+        except OSError:
+            # The supervisor is behind on reading, the next heartbeat tells it the same
+            pass
+
+    def heartbeat(self) -> None:
+        self.report()
+        if self.draining and (len(self.registry) == 0 or time.monotonic() > self.drainDeadline):
+            self.stopped = True
+            return
+        self.callLater(HEARTBEAT_INTERVAL, self.heartbeat)
+
+    # Take no new matches, players still waiting for an opponent won't get one here anymore
+    def drain(self) -> None:
+        self.draining = True
+        self.drainDeadline = time.monotonic() + DRAIN_TIMEOUT
+        for room in list(self.registry.lobby.values()):
+            for member in room.members():
+                self.closeClient(member)
+
+    # A player leaving can open up or close a room in the lobby, which decides where the supervisor sends the
+    # next client
+    def closeClient(self, conn:Connection) -> None:
+        if conn.closed:
+            return
+        super().closeClient(conn)
+        if not conn.spectator:
+            self.report()
+
+
+# Runs one worker of a sharded server, the target supervisor.Supervisor starts in every worker process
+def runWorker(host:str, slot:int, slots:int, control:socket.socket) -> None:
+    WorkerServer(host, slot, slots, control).listen()
+
+
+# Block until the client's answer to the HELLO (READY or RESUME) arrives on sock and return it
+# Clients send nothing else until their match starts, so only the first frame matters
+def readAnswer(sock:socket.socket, decoder:FrameDecoder) -> bytes:
+    while True:
+        data = sock.recv(1024)
+        if not data:
+            raise ConnectionError("Client disconnected during the handshake")
+        frames = decoder.feed(data)
+        if frames:
+            return frames[0]
+
+
+# Shut down the sockets of ThreadedServer clients, their threads notice and clean up after them
+def shutdownAll(clients:List[socket.socket]) -> None:
+    for client in clients:
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# Let the process hold as many sockets as the operating system allows
+def raiseFileLimit() -> None:
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
     
 #===================================================================================================================
 # Purpose: This section of code asks the user to select a port for the server to use. Then if the user selects
@@ -208,6 +1029,16 @@ if __name__ == '__main__':
             break
         except ValueError:
             pass
+
+    # "event" serves every client from one thread, "sharded" runs event servers in several processes, anything
+    # else keeps the thread per client server
+    mode = input("Server mode (threaded/event/sharded): ").strip().lower()
     
     #### TO TEST IT WITH ANOTHER CLIENT MAKE SURE YOU ARE ON THE SAME CONNECTION ####
-    ThreadedServer(IP,port_num).listen()
+    if mode == "event":
+        EventLoopServer(IP,port_num).listen()
+    elif mode == "sharded":
+        workers = input(f"Workers ({os.cpu_count()}): ").strip()
+        Supervisor(IP, port_num, int(workers) if workers.isdigit() else os.cpu_count(), runWorker).listen()
+    else:
+        ThreadedServer(IP,port_num).listen()
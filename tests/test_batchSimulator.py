@@ -0,0 +1,59 @@
+# BatchSimulator has to play every game exactly like GameEngine, rollback clients, replays and batch hosted
+# rooms all rely on the two never drifting apart
+import random
+
+import numpy as np
+
+from assets.code.batchSimulator import BatchSimulator, MOVE_NAMES
+from assets.code.gameEngine import PADDLE_HEIGHT, WALL_THICKNESS
+
+SCREEN_WIDTH = 640
+SCREEN_HEIGHT = 480
+GAMES = 256
+TICKS = 300
+
+
+def fields(state):
+    return (state.tick, state.ballX, state.ballY, state.ballXVel, state.ballYVel, state.leftY, state.rightY,
+            state.lScore, state.rScore)
+
+
+def randomState(engine, rng):
+    state = engine.newState()
+    state.ballX = rng.randrange(20, SCREEN_WIDTH - 20)
+    state.ballY = rng.randrange(WALL_THICKNESS, SCREEN_HEIGHT - WALL_THICKNESS - 5)
+    state.ballXVel = rng.choice((-1, 1))*rng.randrange(1, 101)
+    state.ballYVel = rng.randrange(-100, 101)
+    # Paddles anywhere, often pressed against a wall
+    edges = (WALL_THICKNESS, SCREEN_HEIGHT - WALL_THICKNESS - PADDLE_HEIGHT)
+    state.leftY = rng.choice(edges) if rng.random() < 0.3 else rng.randrange(edges[0], edges[1] + 1)
+    state.rightY = rng.choice(edges) if rng.random() < 0.3 else rng.randrange(edges[0], edges[1] + 1)
+    return state
+
+
+def runBoth(batch, states, rng):
+    engine = batch.engine
+    for _ in range(TICKS):
+        leftMoving = np.array([rng.randrange(3) for _ in states], dtype=np.int8)
+        rightMoving = np.array([rng.randrange(3) for _ in states], dtype=np.int8)
+        events = batch.step(leftMoving, rightMoving)
+        for i, state in enumerate(states):
+            state.leftMoving = MOVE_NAMES[leftMoving[i]]
+            state.rightMoving = MOVE_NAMES[rightMoving[i]]
+            assert engine.step(state) == events[i]
+            assert fields(batch.getState(i)) == fields(state)
+
+
+def testMatchesEngineFromStart():
+    rng = random.Random(5)
+    batch = BatchSimulator(GAMES, SCREEN_WIDTH, SCREEN_HEIGHT)
+    runBoth(batch, [batch.engine.newState() for _ in range(GAMES)], rng)
+
+
+def testMatchesEngineAtHighSpeeds():
+    rng = random.Random(7)
+    batch = BatchSimulator(GAMES, SCREEN_WIDTH, SCREEN_HEIGHT)
+    states = [randomState(batch.engine, rng) for _ in range(GAMES)]
+    for i, state in enumerate(states):
+        batch.setState(i, state)
+    runBoth(batch, states, rng)
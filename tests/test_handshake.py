@@ -0,0 +1,70 @@
+# A client that never finishes its handshake is dropped on its own, the player waiting in its room isn't
+import socket
+import threading
+import time
+
+import pytest
+
+import pongServer
+from assets.code.wireProtocol import FrameDecoder, decodeHello, encodeReady, frameType, MSG_START
+
+TIMEOUT = 0.5
+
+
+@pytest.fixture(params=["threaded", "event"])
+def server(request, monkeypatch):
+    monkeypatch.setattr(pongServer, "HANDSHAKE_TIMEOUT", TIMEOUT)
+    if request.param == "threaded":
+        server = pongServer.ThreadedServer("127.0.0.1", 0)
+    else:
+        server = pongServer.EventLoopServer("127.0.0.1", 0)
+    threading.Thread(target=server.listen, daemon=True).start()
+    yield server.sock.getsockname()[1]
+    server.stopped = True
+
+
+def connect(port):
+    for _ in range(50):
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=2)
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.02)
+    decoder = FrameDecoder()
+    frames = []
+    while not frames:
+        frames = decoder.feed(sock.recv(1024))
+    return sock, decoder, decodeHello(frames[0])[2]
+
+
+def waitForStart(sock, decoder):
+    while True:
+        data = sock.recv(1024)
+        assert data, "closed before the match started"
+        if any(frameType(frame) == MSG_START for frame in decoder.feed(data)):
+            return
+
+
+def testStalledOpponentOnlyDropsItself(server):
+    waiting, waitingDecoder, side = connect(server)
+    assert side == "left"
+    waiting.sendall(encodeReady())
+    stalled, _, side = connect(server)
+    assert side == "right"
+
+    # The stalled client is closed once its handshake times out, the waiting player stays connected
+    stalled.settimeout(TIMEOUT*4)
+    assert stalled.recv(1024) == b""
+    waiting.settimeout(TIMEOUT*2)
+    with pytest.raises(socket.timeout):
+        waiting.recv(1024)
+
+    # and is paired with the next client to join
+    opponent, opponentDecoder, side = connect(server)
+    assert side == "right"
+    opponent.sendall(encodeReady())
+    waiting.settimeout(2)
+    waitForStart(waiting, waitingDecoder)
+    waitForStart(opponent, opponentDecoder)
+    for sock in (waiting, stalled, opponent):
+        sock.close()
@@ -0,0 +1,40 @@
+# Tests for recording and playing back replays
+import random
+import shutil
+
+from assets.code.gameEngine import GameEngine
+from assets.code.replay import ReplayPlayer, ReplayRecorder
+
+
+def recordMatch(path, copyAt=None, copyPath=None):
+    engine = GameEngine(640, 480)
+    state = engine.newState()
+    recorder = ReplayRecorder(str(path), engine)
+    rng = random.Random(3)
+    while not engine.isOver(state):
+        state.leftMoving = rng.choice(("", "up", "down"))
+        recorder.record(state)
+        engine.step(state)
+        recorder.flush()
+        if state.tick == copyAt:
+            shutil.copy(path, copyPath)
+    recorder.close()
+    return state
+
+
+def testSeekPastTheEndGivesLastState(tmp_path):
+    final = recordMatch(tmp_path / "match.pongreplay")
+    player = ReplayPlayer(str(tmp_path / "match.pongreplay"))
+    state = player.seek(final.tick + 5000)
+    assert state.tick == player.lastTick() == final.tick
+    assert (state.lScore, state.rScore) == (final.lScore, final.rScore)
+    player.close()
+
+
+# A server that dies before closing the recorder still leaves every flushed tick readable
+def testUnclosedRecordingKeepsFlushedTicks(tmp_path):
+    recordMatch(tmp_path / "match.pongreplay", 200, tmp_path / "killed.pongreplay")
+    player = ReplayPlayer(str(tmp_path / "killed.pongreplay"))
+    assert player.lastTick() == 200
+    assert player.seek(150).tick == 150
+    player.close()
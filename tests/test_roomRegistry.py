@@ -0,0 +1,74 @@
+# Tests for RoomRegistry, members are plain strings
+from assets.code.roomRegistry import RoomRegistry
+
+
+# A resuming client is joined like a new one until its RESUME arrives. When an opponent filled its room in
+# the meantime, that opponent has to get the next client instead of being left in a room nobody can join
+def testCancelJoinKeepsOpponentWaiting():
+    registry = RoomRegistry()
+    room, side = registry.join("resumer", 1)
+    assert side == "left"
+    assert registry.join("waiting", 2) == (room, "right")
+    assert registry.markReady("waiting") is None
+
+    registry.cancelJoin("resumer")
+    assert registry.roomOf("resumer") is None
+    assert registry.roomOf("waiting") is room
+    assert room.left is None and room.right == "waiting"
+    assert list(registry.lobby) == [room.roomId]
+
+    # The next client takes the empty slot, and the match starts without the waiting player readying again
+    assert registry.join("next", 3) == (room, "left")
+    assert not registry.lobby
+    assert registry.markReady("next") is room
+    assert room.started
+
+
+def testCancelJoinGoesToFrontOfLobby():
+    registry = RoomRegistry()
+    first, _ = registry.join("resumer")
+    registry.join("waiting")
+    older, _ = registry.join("other")
+    registry.cancelJoin("resumer")
+    assert list(registry.lobby) == [first.roomId, older.roomId]
+    assert registry.join("next") == (first, "left")
+
+
+def testCancelJoinOfOnlyPlayerRemovesRoom():
+    registry = RoomRegistry()
+    room, _ = registry.join("resumer")
+    registry.cancelJoin("resumer")
+    assert len(registry) == 0
+    assert not registry.lobby
+    assert registry.join("next")[0] is not room
+
+
+# A player leaving a room whose match hasn't started doesn't take the opponent with it
+def testLeaveBeforeStartKeepsOpponentInLobby():
+    registry = RoomRegistry()
+    room, _ = registry.join("left", 1)
+    registry.join("right", 2)
+    assert registry.markReady("left") is None
+
+    assert registry.leave("right") == []
+    assert registry.roomOf("left") is room
+    assert list(registry.lobby) == [room.roomId]
+
+    # The READY of the player that left doesn't count towards the next pairing
+    registry.join("next", 3)
+    assert registry.leave("left") == []
+    assert room.left is None and room.right == "next"
+    registry.join("last", 4)
+    assert registry.markReady("next") is None
+    assert registry.markReady("last") is room
+
+
+def testLeaveAfterStartClosesOpponent():
+    registry = RoomRegistry()
+    room, _ = registry.join("left")
+    registry.join("right")
+    registry.markReady("left")
+    registry.markReady("right")
+    assert registry.leave("left") == ["right"]
+    assert room.closed
+    assert len(registry) == 0
@@ -0,0 +1,106 @@
+# Tests for broadcasting to spectators, each viewer is one end of a socket pair the test reads from
+import socket
+
+import pytest
+
+from assets.code.spectators import MAX_SKIPPED, Spectator, broadcast
+from assets.code.wireProtocol import encodeStart
+
+# Far more than the socket pair buffers, so the first broadcast can only write part of it
+BIG_FRAME = bytes(range(256))*1024
+
+
+@pytest.fixture
+def viewer():
+    serverSide, clientSide = socket.socketpair()
+    spectator = Spectator(serverSide, ("viewer", 0))
+    clientSide.setblocking(False)
+    yield spectator, clientSide
+    spectator.close()
+    clientSide.close()
+
+
+# Everything the viewer can read right now
+def drain(sock:socket.socket) -> bytes:
+    chunks = []
+    while True:
+        try:
+            chunk = sock.recv(65536)
+        except BlockingIOError:
+            break
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+# Read while broadcasting empty frames until the spectator has nothing left pending, returns what it read
+def catchUp(spectator:Spectator, sock:socket.socket) -> bytes:
+    received = b""
+    while spectator.pending is not None:
+        received += drain(sock)
+        assert broadcast([spectator], b"") == []
+    return received + drain(sock)
+
+
+# A frame that doesn't fit is kept as a view into the shared bytes and finished before the next frame goes out
+def testPartialWriteLeavesPendingView(viewer):
+    spectator, clientSide = viewer
+    start = encodeStart()
+    assert broadcast([spectator], BIG_FRAME) == []
+    pending = spectator.pending
+    assert isinstance(pending, memoryview)
+    assert pending.obj is BIG_FRAME
+    assert 0 < len(pending) < len(BIG_FRAME)
+    assert spectator.skipped == 0
+
+    assert catchUp(spectator, clientSide) == start + BIG_FRAME
+    assert spectator.skipped == 0
+    assert broadcast([spectator], b"next") == []
+    assert spectator.pending is None
+    assert drain(clientSide) == b"next"
+
+
+# Frames sent while a viewer is still behind are skipped and counted, nothing of them is queued
+def testSkippedFramesAreCounted(viewer):
+    spectator, clientSide = viewer
+    broadcast([spectator], BIG_FRAME)
+    pending = bytes(spectator.pending)
+    for skipped in range(1, 11):
+        assert broadcast([spectator], b"skipped") == []
+        assert spectator.skipped == skipped
+    assert bytes(spectator.pending) == pending
+
+    # Once it caught up the count starts over and the next frame goes out whole
+    received = catchUp(spectator, clientSide)
+    assert spectator.skipped == 0
+    assert received == encodeStart() + BIG_FRAME
+    broadcast([spectator], b"caught up")
+    assert drain(clientSide) == b"caught up"
+
+
+def testStuckViewerDroppedAfterMaxSkipped(viewer):
+    spectator, clientSide = viewer
+    broadcast([spectator], BIG_FRAME)
+    for _ in range(MAX_SKIPPED):
+        assert broadcast([spectator], b"frame") == []
+    assert spectator.skipped == MAX_SKIPPED
+    assert spectator.sock.fileno() != -1
+
+    assert broadcast([spectator], b"frame") == [spectator]
+    assert spectator.sock.fileno() == -1
+
+
+# A viewer that closed its end is dropped without holding up the others
+def testClosedViewerDropped(viewer):
+    spectator, clientSide = viewer
+    otherServer, otherClient = socket.socketpair()
+    other = Spectator(otherServer, ("other", 0))
+    clientSide.close()
+    try:
+        assert broadcast([spectator, other], b"frame") == [spectator]
+        assert other.pending is None
+        assert otherClient.recv(1024) == encodeStart() + b"frame"
+    finally:
+        other.close()
+        otherClient.close()
@@ -0,0 +1,37 @@
+# Tests for the swept ball movement
+from assets.code.gameEngine import GameEngine, PADDLE_HEIGHT, WALL_THICKNESS, EVENT_BOUNCE, EVENT_POINT
+
+SCREEN_WIDTH = 640
+SCREEN_HEIGHT = 480
+
+
+# A ball much faster than a paddle is wide still bounces off its face instead of passing through
+def testFastBallDoesNotTunnelThroughPaddle():
+    engine = GameEngine(SCREEN_WIDTH, SCREEN_HEIGHT)
+    for speed in range(5, 101, 5):
+        for side in ("left", "right"):
+            state = engine.newState()
+            state.ballY = state.leftY + PADDLE_HEIGHT//2
+            state.ballXVel = -speed if side == "left" else speed
+            bounced = False
+            for _ in range(SCREEN_WIDTH):
+                events = engine.step(state)
+                assert not events & EVENT_POINT, f"{speed} px/tick went through the {side} paddle"
+                if events & EVENT_BOUNCE:
+                    bounced = True
+                    break
+            assert bounced
+            assert (state.ballXVel > 0) == (side == "left")
+            assert engine.leftX < state.ballX < engine.rightX
+
+
+# However fast it goes up or down, the ball never ends a tick inside or past a wall
+def testFastBallStaysBetweenWalls():
+    engine = GameEngine(SCREEN_WIDTH, SCREEN_HEIGHT)
+    for yVel in (-100, -37, 41, 100):
+        state = engine.newState()
+        state.ballXVel = 1
+        state.ballYVel = yVel
+        for _ in range(100):
+            engine.step(state)
+            assert WALL_THICKNESS <= state.ballY <= SCREEN_HEIGHT - WALL_THICKNESS - 5
@@ -0,0 +1,150 @@
+# Tests for delta encoded snapshots and the loss shim, over loopback UDP sockets
+import random
+import socket
+
+import pytest
+
+from assets.code.gameEngine import GameEngine
+from assets.code.roomRegistry import Room
+from assets.code.udpTransport import (FULL_MASK, HISTORY_SIZE, SNAPSHOT_HEADER, LossShim, UdpClientChannel,
+                                      UdpGameChannel, deltaStruct, encodeSnapshotDatagram, stateFields)
+
+FULL_SIZE = SNAPSHOT_HEADER.size + deltaStruct(FULL_MASK).size
+
+
+# What UdpClientChannel.decodeSnapshot returns for fields, the same layout as wireProtocol.decodeSnapshot
+def decoded(tick, fields, events=0):
+    directions = ("", "up", "down")
+    return (tick,) + fields[:6] + (directions[fields[6]], directions[fields[7]]) + fields[8:10] + (events,) + \
+        fields[10:]
+
+
+@pytest.fixture
+def client():
+    channel = UdpClientChannel(("127.0.0.1", 9), 0)
+    yield channel
+    channel.close()
+
+
+def testDeltaRoundTrip(client):
+    engine = GameEngine(640, 480)
+    state = engine.newState()
+    engine.step(state)
+    base = stateFields(state, 1, 1)
+    assert client.decodeSnapshot(encodeSnapshotDatagram(state.tick, base, 0, None, 0)) == decoded(state.tick, base)
+
+    baseTick = state.tick
+    for tick in range(2, 30):
+        state.leftMoving = "up" if tick & 4 else "down"
+        events = engine.step(state)
+        fields = stateFields(state, tick, tick - 1)
+        datagram = encodeSnapshotDatagram(state.tick, fields, baseTick, base, events)
+        # Only the fields that moved are sent, the scores and most of the rest stay put
+        assert len(datagram) < FULL_SIZE
+        assert client.decodeSnapshot(datagram) == decoded(state.tick, fields, events)
+        base, baseTick = fields, state.tick
+
+    # Nothing changed since the base, the datagram is just the header
+    datagram = encodeSnapshotDatagram(state.tick + 1, base, baseTick, base, 0)
+    assert len(datagram) == SNAPSHOT_HEADER.size
+    assert client.decodeSnapshot(datagram) == decoded(state.tick + 1, base)
+
+
+def testDeltaAgainstUnknownBaseIgnored(client):
+    engine = GameEngine(640, 480)
+    state = engine.newState()
+    engine.step(state)
+    base = stateFields(state, 0, 0)
+    engine.step(state)
+    # The client never got the base tick, it can't rebuild the snapshot and waits for one it can
+    datagram = encodeSnapshotDatagram(state.tick, stateFields(state, 0, 0), state.tick - 1, base, 0)
+    assert client.decodeSnapshot(datagram) is None
+    assert client.ackTick == 0
+
+
+# The server sends deltas against the newest snapshot the client acknowledged, and a full snapshot once that one
+# has dropped out of its history
+def testServerFallsBackToFullSnapshot():
+    engine = GameEngine(640, 480)
+    server = UdpGameChannel("127.0.0.1", 0)
+    server.rawSock.settimeout(1)
+    server.offer("player")
+    client = UdpClientChannel(("127.0.0.1", server.port), server.peersByMember["player"].token)
+    room = Room(1, "player")
+    room.state = engine.newState()
+
+    def acknowledge():
+        client.sendInput("up")
+        assert server.receive(*server.rawSock.recvfrom(512)) is not None
+
+    def sendTick():
+        engine.step(room.state)
+        size = server.sendSnapshot("player", room, server.record(room), 0)
+        snapshot, _ = client.poll(1)
+        assert snapshot is not None and snapshot[0] == room.state.tick
+        return size
+
+    try:
+        acknowledge()
+        assert sendTick() == FULL_SIZE
+        acknowledge()
+        assert sendTick() < FULL_SIZE
+
+        # The client stops acknowledging while the server's history moves on past its last snapshot
+        for _ in range(HISTORY_SIZE):
+            engine.step(room.state)
+            server.record(room)
+        assert room.history.get(client.ackTick) is None
+        assert sendTick() == FULL_SIZE
+    finally:
+        client.close()
+        server.rawSock.close()
+
+
+@pytest.fixture
+def loopback():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(2)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+
+# The same seed drops the same datagrams
+def testLossShimSeededLoss(loopback):
+    sender, receiver = loopback
+    shim = LossShim(sender, loss=0.3, seed=7)
+    for number in range(200):
+        shim.sendto(b"%d" % number, receiver.getsockname())
+    received = []
+    receiver.settimeout(0.2)
+    while True:
+        try:
+            received.append(int(receiver.recv(64)))
+        except socket.timeout:
+            break
+
+    draws = random.Random(7)
+    expected = [number for number in range(200) if draws.random() >= 0.3]
+    assert received == expected
+    assert 100 < len(received) < 180
+
+
+# Jitter reorders datagrams, each is held back for the delay its draw gave it
+def testLossShimSeededReorder(loopback):
+    sender, receiver = loopback
+    shim = LossShim(sender, jitter=0.5, seed=11)
+    for number in range(20):
+        shim.sendto(b"%d" % number, receiver.getsockname())
+    received = [int(receiver.recv(64)) for _ in range(20)]
+
+    draws = random.Random(11)
+    delays = []
+    for number in range(20):
+        draws.random()      # The loss draw
+        delays.append((draws.uniform(0, 0.5), number))
+    expected = [number for _, number in sorted(delays)]
+    assert received == expected
+    assert received != list(range(20))
@@ -0,0 +1,78 @@
+# Tests for splitting a TCP stream back into frames
+import pytest
+
+from assets.code.gameEngine import GameEngine, EVENT_BOUNCE
+from assets.code.wireProtocol import (HEADER, MSG_INPUT, MSG_SNAPSHOT, PROTOCOL_VERSION, FrameDecoder, ProtocolError,
+                                      decodeInput, decodeSnapshot, encodeHello, encodeInput, encodeSnapshot,
+                                      encodeStart, frameType)
+
+
+def stream():
+    state = GameEngine(640, 480).newState()
+    return [encodeHello(640, 480, "left", 12), encodeStart(), encodeInput("up", 1),
+            encodeSnapshot(state, EVENT_BOUNCE, 1, 0), encodeInput("down", 2)]
+
+
+# However recv happens to cut the stream, every frame comes out whole and in order
+@pytest.mark.parametrize("chunkSize", [1, 2, 3, 5, 7, 64])
+def testFramesSplitAcrossReads(chunkSize):
+    frames = stream()
+    data = b"".join(frames)
+    decoder = FrameDecoder()
+    received = []
+    for i in range(0, len(data), chunkSize):
+        received += decoder.feed(data[i:i + chunkSize])
+    assert received == frames
+    assert not decoder.buffer
+
+
+def testSeveralFramesInOneRead():
+    frames = stream()
+    decoder = FrameDecoder()
+    # The start of the next frame stays buffered until the rest of it arrives
+    partial = encodeInput("up", 3)
+    assert decoder.feed(b"".join(frames) + partial[:4]) == frames
+    assert decoder.feed(b"") == []
+    assert decoder.feed(partial[4:]) == [partial]
+    assert decodeInput(partial) == ("up", 3)
+
+
+def testFramesDecodeAfterReassembly():
+    snapshot = encodeSnapshot(GameEngine(640, 480).newState(), 0, 5, 6)
+    decoder = FrameDecoder()
+    assert decoder.feed(snapshot[:3]) == []
+    frames = decoder.feed(snapshot[3:])
+    assert [frameType(frame) for frame in frames] == [MSG_SNAPSHOT]
+    assert decodeSnapshot(frames[0]) == decodeSnapshot(snapshot)
+
+
+# A client of another version is turned away as soon as its first header arrives, without waiting for a body
+def testBadVersionRejected():
+    frame = bytearray(encodeInput("up", 1))
+    frame[2] = PROTOCOL_VERSION + 1
+    decoder = FrameDecoder()
+    with pytest.raises(ProtocolError):
+        decoder.feed(bytes(frame[:HEADER.size]))
+
+
+def testBadVersionAfterGoodFrameRejected():
+    frame = bytearray(encodeInput("up", 2))
+    frame[2] = PROTOCOL_VERSION - 1
+    decoder = FrameDecoder()
+    with pytest.raises(ProtocolError):
+        decoder.feed(encodeInput("up", 1) + bytes(frame))
+
+
+# A length that doesn't match the frame's type would leave the decoder out of step with the stream
+@pytest.mark.parametrize("length", [0, 4, 6, 65535])
+def testBadLengthRejected(length):
+    header = HEADER.pack(length, PROTOCOL_VERSION, MSG_INPUT)
+    decoder = FrameDecoder()
+    with pytest.raises(ProtocolError):
+        decoder.feed(header)
+
+
+def testUnknownTypeRejected():
+    decoder = FrameDecoder()
+    with pytest.raises(ProtocolError):
+        decoder.feed(HEADER.pack(0, PROTOCOL_VERSION, 99))